@@ -10,6 +10,4 @@ webserver.tasks_runner = ThreadPool()
 
 webserver.tasks_runner.start()
 
-webserver.job_counter = 1
-
 from app import routes
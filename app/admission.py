@@ -0,0 +1,230 @@
+'''
+This module contains the admission control of the server: the limits on the jobs
+that can wait or run at the same time, and the priorities of the routes in the
+task queue.
+'''
+from collections import Counter, deque
+from queue import Queue
+from threading import Lock
+import heapq
+import itertools
+import math
+import os
+import time
+
+# number of recent completions used to estimate the service rate
+RATE_WINDOW = 256
+
+# bounds, in seconds, of the Retry-After sent to the rejected requests
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+# priority of the routes that are not given one; lower priorities are run first
+DEFAULT_PRIORITY = 1
+
+# maximum number of requests in a batch, when TP_MAX_BATCH is not set
+DEFAULT_MAX_BATCH = 1000
+
+
+def parse_route_values(value: str, cast):
+    '''
+    Parses a "route:value,route:value" environment variable into a dictionary.
+    '''
+    values = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            route, route_value = item.split(':')
+            values[route.strip()] = cast(route_value)
+    return values
+
+
+def job_routes(task):
+    '''
+    Returns the routes a task is counted for: its own route, and the route of
+    every item of a batch, so a batch counts as many jobs as it runs.
+    '''
+    return [task.route] + [item.route for item in getattr(task, 'items', ())]
+
+
+class Overloaded(Exception):
+    '''
+    Raised when a job is not admitted. The status is 503 when the server is full
+    and 429 when the route is at its limit, and retry_after is the number of seconds
+    after which the client should try again.
+    '''
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    '''
+    Thread-safe counters of the admitted jobs that are waiting or running,
+    which reject the new jobs that go over the limits.
+    Attributes:
+        max_jobs: maximum number of jobs waiting or running, None for no limit
+        route_limits: route -> maximum number of jobs of the route waiting or running
+        max_batch: maximum number of requests in a batch
+        lock: protects the counters and the completion times
+        in_flight: number of jobs waiting or running
+        route_in_flight: route -> number of jobs of the route waiting or running
+        completions: times when the last RATE_WINDOW jobs were done
+        rejected: number of rejected jobs, by status
+    '''
+    def __init__(self, max_jobs: int = None, route_limits: dict = None,
+                 max_batch: int = DEFAULT_MAX_BATCH):
+        self.max_jobs = max_jobs
+        self.route_limits = route_limits or {}
+        self.max_batch = max_batch
+        self.lock = Lock()
+        self.in_flight = 0
+        self.route_in_flight = {}
+        self.completions = deque(maxlen=RATE_WINDOW)
+        self.rejected = {429: 0, 503: 0}
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Creates the admission control from the TP_MAX_QUEUE environment variable
+        (the maximum number of jobs waiting or running) and the TP_ROUTE_LIMITS
+        environment variable (ex. "mean_by_category:4,state_mean_by_category:8").
+        The batches have at most TP_MAX_BATCH requests (1000 by default).
+        '''
+        max_jobs = os.environ.get('TP_MAX_QUEUE')
+
+        return cls(int(max_jobs) if max_jobs else None,
+                   parse_route_values(os.environ.get('TP_ROUTE_LIMITS'), int),
+                   int(os.environ.get('TP_MAX_BATCH', DEFAULT_MAX_BATCH)))
+
+    def service_rate(self):
+        '''
+        Returns the number of jobs done per second, estimated from the recent
+        completions, or None if there are not enough of them. Called with the lock held.
+        '''
+        if len(self.completions) < 2:
+            return None
+
+        elapsed = self.completions[-1] - self.completions[0]
+        if elapsed <= 0:
+            return None
+        return (len(self.completions) - 1) / elapsed
+
+    def retry_after(self, waiting: int):
+        '''
+        Returns in how many seconds the given number of waiting jobs should be done,
+        at the observed service rate. Called with the lock held.
+        '''
+        rate = self.service_rate()
+        if rate is None:
+            return MIN_RETRY_AFTER
+        return min(max(math.ceil(waiting / rate), MIN_RETRY_AFTER), MAX_RETRY_AFTER)
+
+    def admit(self, route: str):
+        '''
+        Counts a new job of the route, or raises Overloaded if it goes over the limits.
+        '''
+        self.admit_all([route])
+
+    def admit_all(self, routes: list):
+        '''
+        Counts a new job for every given route (see job_routes), or raises Overloaded
+        without counting any of them if they go over the limits.
+        '''
+        counts = Counter(routes)
+        with self.lock:
+            if self.max_jobs is not None and self.in_flight + len(routes) > self.max_jobs:
+                self.rejected[503] += 1
+                raise Overloaded(503, "Server is overloaded", self.retry_after(self.in_flight))
+
+            for route, count in counts.items():
+                limit = self.route_limits.get(route)
+                route_in_flight = self.route_in_flight.get(route, 0)
+                if limit is not None and route_in_flight + count > limit:
+                    self.rejected[429] += 1
+                    raise Overloaded(429, f"Too many {route} jobs",
+                                     self.retry_after(route_in_flight))
+
+            self.count(counts)
+
+    def add_all(self, routes: list):
+        '''
+        Counts a job for every given route without checking the limits, ex. a job
+        restored after a restart.
+        '''
+        with self.lock:
+            self.count(Counter(routes))
+
+    def count(self, counts: Counter):
+        '''
+        Adds the route -> number of jobs counts to the counters. Called with the lock held.
+        '''
+        for route, count in counts.items():
+            self.in_flight += count
+            self.route_in_flight[route] = self.route_in_flight.get(route, 0) + count
+
+    def release_all(self, routes: list):
+        '''
+        Stops counting the jobs of the given routes once they are done.
+        '''
+        with self.lock:
+            for route in routes:
+                self.in_flight -= 1
+                self.route_in_flight[route] -= 1
+            self.completions.append(time.monotonic())
+
+    def stats(self):
+        '''
+        Returns the number of jobs waiting or running, the estimated service rate
+        and the number of rejected jobs.
+        '''
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'service_rate': self.service_rate(),
+                'rejected_429': self.rejected[429],
+                'rejected_503': self.rejected[503],
+            }
+
+
+class PriorityTaskQueue(Queue):
+    '''
+    Task queue that gives the tasks of some routes priority over the others.
+    The tasks with the same priority are taken in the order they were put,
+    so without priorities it behaves like a Queue. The None stop sentinels are
+    taken after all the tasks.
+    Attributes:
+        priorities: route -> priority, the lower priorities are taken first
+    '''
+    def __init__(self, priorities: dict = None):
+        self.priorities = priorities or {}
+        self.counter = itertools.count()
+        super().__init__()
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Creates the queue with the priorities from the TP_ROUTE_PRIORITIES environment
+        variable (ex. "global_mean:0,state_mean:0,mean_by_category:2"). The routes
+        that are not given have priority 1.
+        '''
+        return cls(parse_route_values(os.environ.get('TP_ROUTE_PRIORITIES'), int))
+
+    # pylint: disable=invalid-name, attribute-defined-outside-init
+    # the methods overridden from Queue, which are called with its lock held
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        if item is None:
+            priority = math.inf
+        else:
+            priority = self.priorities.get(item.route, DEFAULT_PRIORITY)
+        heapq.heappush(self.queue, (priority, next(self.counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
@@ -0,0 +1,316 @@
+'''
+This module contains the AggregateIndex class, the aggregates of the dataset
+precomputed at load time, and the functions that group the rows for it.
+'''
+from bisect import bisect_left, bisect_right
+import copy
+import numpy as np
+import pandas as pd
+
+# the groups whose running sums and counts are kept by the AggregateIndex:
+# level -> the columns of the group besides the question
+GROUP_LEVELS = {
+    'all': [],
+    'states': ['LocationDesc'],
+    'categories': ['LocationDesc', 'StratificationCategory1', 'Stratification1'],
+    'years': ['YearStart'],
+    'state_years': ['LocationDesc', 'YearStart'],
+}
+
+# the levels of GROUP_LEVELS whose distributions of Data_Value are kept by the
+# AggregateIndex, for the percentiles and the standard deviations
+DISTRIBUTION_LEVELS = ('all', 'states', 'categories')
+
+# the values of a group without any
+EMPTY_VALUES = np.empty(0)
+
+
+def key_to_str(key: tuple):
+    '''
+    Converts a tuple key to a string to be able to put it in a json format later.
+    '''
+    return "('" + "', '".join(key) + "')"
+
+
+def sample_stddev(values: np.ndarray):
+    '''
+    Returns the sample standard deviation of the values, like pandas, or NaN if
+    there are less than two of them.
+    '''
+    return float(np.std(values, ddof=1)) if len(values) > 1 else float('nan')
+
+
+def group_totals(panda_data: pd.DataFrame):
+    '''
+    Returns the sum, the count and the mean of Data_Value for every group of
+    GROUP_LEVELS, as question -> level -> {group: (sum, count, mean)}.
+    The groups are the tuples of the values of the level's columns, sorted.
+    '''
+    totals = {}
+    for level, columns in GROUP_LEVELS.items():
+        grouped = panda_data.groupby(['Question'] + columns, observed=True)['Data_Value'] \
+            .agg(['sum', 'count', 'mean']).sort_index()
+
+        for key, total, count, mean in zip(grouped.index, grouped['sum'].tolist(),
+                                           grouped['count'].tolist(), grouped['mean'].tolist()):
+            key = key if isinstance(key, tuple) else (key,)
+            totals.setdefault(key[0], {level: {} for level in GROUP_LEVELS}) \
+                [level][key[1:]] = (total, count, mean)
+
+    return totals
+
+
+def group_distributions(panda_data: pd.DataFrame):
+    '''
+    Returns the sorted non-missing values of Data_Value and their standard deviation
+    for every group of DISTRIBUTION_LEVELS, as question -> level -> {group: (values, stddev)}.
+    The groups are the tuples of the values of the level's columns, sorted.
+    '''
+    data = panda_data[panda_data['Data_Value'].notna()]
+    distributions = {}
+
+    for level in DISTRIBUTION_LEVELS:
+        grouped = data.groupby(['Question'] + GROUP_LEVELS[level], observed=True)
+        keys = grouped.size().index
+        codes = grouped.ngroup().to_numpy()
+        # the rows with a missing group column aren't in any group
+        present = codes >= 0
+        if not len(keys):
+            continue
+
+        # the values are sorted by group and then by value, so every group is a slice
+        codes, values = codes[present], data['Data_Value'].to_numpy()[present]
+        order = np.lexsort((values, codes))
+        values = values[order]
+        starts = np.searchsorted(codes[order], np.arange(len(keys)))
+        counts = np.diff(np.append(starts, len(values)))
+
+        means = np.add.reduceat(values, starts) / counts
+        squares = np.add.reduceat((values - np.repeat(means, counts)) ** 2, starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stddevs = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+
+        for key, start, count, stddev in zip(keys, starts.tolist(), counts.tolist(),
+                                             stddevs.tolist()):
+            key = key if isinstance(key, tuple) else (key,)
+            distributions.setdefault(key[0], {level: {} for level in DISTRIBUTION_LEVELS}) \
+                [level][key[1:]] = (values[start:start + count], stddev)
+
+    return distributions
+
+
+class AggregateIndex:
+    '''
+    Class that precomputes, at load time, every aggregate the tasks need, so that
+    answering a request is a dictionary lookup instead of a scan of the dataframe.
+    Attributes:
+        global_means: question -> global average
+        states_means: question -> {state: average}, sorted in ascending order
+        states_means_desc: question -> {state: average}, sorted in descending order
+        categories_means: question -> {"(state, category, stratification)": average}
+        state_categories_means: (question, state) -> {"(category, stratification)": average}
+        totals: question -> level -> {group: (sum, count)} of Data_Value for the groups
+            of GROUP_LEVELS, used to update the averages when rows are appended
+        years_prefix: question -> {"years": sorted years, "all": prefix sums,
+            "states": {state: prefix sums}}, where the prefix sums are the (sums, counts)
+            lists of Data_Value over the years before each position, so the totals of
+            a year range are the difference of two positions
+        distributions: question -> {"all": (values, stddev), "states": {state: (values, stddev)},
+            "categories": {state: {(category, stratification): (values, stddev)}}},
+            where values are the sorted non-missing values of Data_Value of the group,
+            so a percentile is found by its position, and stddev is their standard deviation
+    '''
+    def __init__(self, panda_data: pd.DataFrame):
+        self.global_means = {}
+        self.states_means = {}
+        self.states_means_desc = {}
+        self.categories_means = {}
+        self.state_categories_means = {}
+        self.totals = {}
+        self.years_prefix = {}
+        self.distributions = {}
+
+        for question, levels in group_distributions(panda_data).items():
+            self.add_distributions(question, levels)
+
+        for question, levels in group_totals(panda_data).items():
+            self.totals[question] = {
+                level: {group: (total, count) for group, (total, count, _) in groups.items()}
+                for level, groups in levels.items()
+            }
+            self.build(question, {
+                level: {group: mean for group, (_, _, mean) in groups.items()}
+                for level, groups in levels.items()
+            })
+            self.build_years(question)
+
+    def build(self, question: str, means: dict):
+        '''
+        Builds the aggregates of the question from the level -> {group: average}
+        averages of its groups.
+        '''
+        self.global_means[question] = means['all'][()]
+
+        states_means = pd.Series({group[0]: mean for group, mean in means['states'].items()},
+                                 dtype='float64')
+        self.states_means[question] = states_means.sort_values(ascending=True).to_dict()
+        self.states_means_desc[question] = states_means.sort_values(ascending=False).to_dict()
+
+        categories_means = {}
+        state_categories_means = {}
+        for (state, category, stratification) in sorted(means['categories']):
+            value = means['categories'][(state, category, stratification)]
+            categories_means[key_to_str((state, category, stratification))] = value
+            state_categories_means.setdefault(state, {}) \
+                [key_to_str((category, stratification))] = value
+
+        self.categories_means[question] = categories_means
+        for state, values in state_categories_means.items():
+            self.state_categories_means[(question, state)] = values
+
+    def build_years(self, question: str):
+        '''
+        Builds the prefix sums over the years of the question from its totals.
+        '''
+        totals = self.totals[question]
+        years = sorted({int(year) for (year,) in totals['years']})
+
+        def prefix_sums(year_totals: dict):
+            sums, counts = [0.0], [0]
+            for year in years:
+                total, count = year_totals.get(year, (0.0, 0))
+                sums.append(sums[-1] + total)
+                counts.append(counts[-1] + count)
+            return sums, counts
+
+        states = {}
+        for (state, year), year_total in totals['state_years'].items():
+            states.setdefault(state, {})[int(year)] = year_total
+
+        self.years_prefix[question] = {
+            'years': years,
+            'all': prefix_sums({int(year): year_total
+                                for (year,), year_total in totals['years'].items()}),
+            'states': {state: prefix_sums(state_totals)
+                       for state, state_totals in states.items()},
+        }
+
+    def add_distributions(self, question: str, levels: dict):
+        '''
+        Adds the level -> {group: (sorted values, stddev)} of group_distributions to the
+        distributions of the question, merging the values of the groups it already has.
+        The dictionaries of the question are copied, so an index sharing them is unchanged.
+        '''
+        old = self.distributions.get(question, {})
+        distributions = {
+            'all': old.get('all', (EMPTY_VALUES, float('nan'))),
+            'states': dict(old.get('states', {})),
+            'categories': dict(old.get('categories', {})),
+        }
+
+        def add(groups: dict, key, values: np.ndarray, stddev: float):
+            if key in groups:
+                old_values = groups[key][0]
+                # both are sorted, so the new values are inserted at their positions
+                values = np.insert(old_values, np.searchsorted(old_values, values), values)
+                stddev = sample_stddev(values)
+            groups[key] = (values, stddev)
+
+        changed_states = set()
+        for level, groups in levels.items():
+            for group, (values, stddev) in groups.items():
+                if level == 'all':
+                    add(distributions, 'all', values, stddev)
+                elif level == 'states':
+                    add(distributions['states'], group[0], values, stddev)
+                else:
+                    state = group[0]
+                    if state not in changed_states:
+                        changed_states.add(state)
+                        distributions['categories'][state] = \
+                            dict(distributions['categories'].get(state, {}))
+                    add(distributions['categories'][state], group[1:], values, stddev)
+
+        # the categories of a state are kept sorted, like in state_categories_means
+        for state in changed_states:
+            distributions['categories'][state] = dict(sorted(
+                distributions['categories'][state].items()))
+
+        self.distributions[question] = distributions
+
+    def year_positions(self, question: str, years: tuple):
+        '''
+        Returns the positions, in the prefix sums of the question, of the start and
+        the end of the (start, end) year range.
+        '''
+        question_years = self.years_prefix[question]['years']
+        start, end = years
+        first = 0 if start is None else bisect_left(question_years, start)
+        last = len(question_years) if end is None else bisect_right(question_years, end)
+        return first, max(first, last)
+
+    def range_totals(self, question: str, state: str, years: tuple):
+        '''
+        Returns the (sum, count) of Data_Value for the question, in the given state
+        or in all of them if state is None, over the (start, end) year range.
+        '''
+        prefix = self.years_prefix.get(question)
+        if prefix is None:
+            return 0.0, 0
+
+        sums, counts = prefix['all'] if state is None else \
+            prefix['states'].get(state, ([0.0], [0]))
+        if len(sums) == 1:
+            return 0.0, 0
+
+        first, last = self.year_positions(question, years)
+        return sums[last] - sums[first], counts[last] - counts[first]
+
+    def year_totals(self, question: str, state: str, years: tuple):
+        '''
+        Returns the (year, (sum, count)) of Data_Value for the question and state,
+        for every year of the question in the (start, end) year range.
+        '''
+        prefix = self.years_prefix.get(question)
+        if prefix is None or state not in prefix['states']:
+            return []
+
+        sums, counts = prefix['states'][state]
+        first, last = self.year_positions(question, years)
+        return [(prefix['years'][position],
+                 (sums[position + 1] - sums[position], counts[position + 1] - counts[position]))
+                for position in range(first, last)]
+
+    def appended(self, rows: pd.DataFrame):
+        '''
+        Returns a new index with the given rows added, and the questions they changed.
+        The running sums and counts of the groups of the rows are updated and only
+        the aggregates of their questions are rebuilt, so the cost depends on the
+        number of rows appended and not on the size of the dataset.
+        '''
+        index = copy.copy(self)
+        for name in ('global_means', 'states_means', 'states_means_desc', 'categories_means',
+                     'state_categories_means', 'totals', 'years_prefix', 'distributions'):
+            setattr(index, name, dict(getattr(self, name)))
+
+        for question, levels in group_distributions(rows).items():
+            index.add_distributions(question, levels)
+
+        changed = group_totals(rows)
+        for question, levels in changed.items():
+            totals = {level: dict(self.totals.get(question, {}).get(level, {}))
+                      for level in GROUP_LEVELS}
+            for level, groups in levels.items():
+                for group, (total, count, _) in groups.items():
+                    old_total, old_count = totals[level].get(group, (0.0, 0))
+                    totals[level][group] = (old_total + total, old_count + count)
+
+            index.totals[question] = totals
+            index.build(question, {
+                level: {group: total / count if count else float('nan')
+                        for group, (total, count) in groups.items()}
+                for level, groups in totals.items()
+            })
+            index.build_years(question)
+
+        return index, set(changed)
@@ -0,0 +1,259 @@
+'''
+This module contains the asyncio serving mode of the webserver: an ASGI
+application for the job submission and result polling endpoints.
+A request waiting for a result doesn't hold a thread, so many more polling
+connections can be kept open. The tasks still run on the existing ThreadPool.
+Run it with an ASGI server, ex. "uvicorn app.asgi:application".
+'''
+from threading import Lock
+from urllib.parse import parse_qs
+import asyncio
+import json
+from app import webserver
+from .job_registry import format_job_id, parse_job_id
+from .routes import logger, requested_percentile, requested_query, requested_years, \
+    submit_task, InvalidRequest, MAX_WAIT_MS
+from .task_runner import ROUTES
+from .admission import Overloaded
+from .encoding import done_response, with_fields
+
+
+class CompletionWaiters:
+    '''
+    Class that lets coroutines wait for tasks to be done without blocking a thread.
+    The worker threads resolve the futures through the event loop of each waiter.
+    Attributes:
+        lock: protects the waiters, which are changed by the loop and the worker threads
+        waiters: task id -> list of futures waiting for the task
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.waiters = {}
+
+    def notify(self, task):
+        '''
+        Wakes up the coroutines waiting for the task. Called by the worker threads.
+        '''
+        with self.lock:
+            futures = self.waiters.pop(task.task_id, [])
+
+        for future in futures:
+            future.get_loop().call_soon_threadsafe(resolve, future)
+
+    async def wait(self, task, timeout: float):
+        '''
+        Waits at most timeout seconds for the task to be done.
+        Returns True if the task is done.
+        '''
+        if task.done or timeout <= 0:
+            return task.done
+
+        future = asyncio.get_running_loop().create_future()
+        with self.lock:
+            self.waiters.setdefault(task.task_id, []).append(future)
+
+        # the task may have been done before the future was registered
+        if not task.done:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        with self.lock:
+            futures = self.waiters.get(task.task_id, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                self.waiters.pop(task.task_id, None)
+
+        return task.done
+
+
+def resolve(future):
+    '''
+    Marks the future as done, unless its waiter already gave up.
+    '''
+    if not future.done():
+        future.set_result(None)
+
+
+completion_waiters = CompletionWaiters()
+webserver.tasks_runner.jobs.add_done_listener(completion_waiters.notify)
+
+
+def requested_wait(query: dict, headers: dict):
+    '''
+    Returns how many seconds the user is willing to wait for the result, given
+    in milliseconds by the "wait" query parameter or the "X-Wait-Ms" header.
+    '''
+    wait_ms = query.get('wait', [headers.get(b'x-wait-ms', b'0').decode()])[0]
+    try:
+        wait_ms = int(wait_ms)
+    except ValueError:
+        wait_ms = 0
+
+    return min(max(wait_ms, 0), MAX_WAIT_MS) / 1000
+
+
+async def submit(route: str, body: bytes, wait: float):
+    '''
+    Handles the submission of a task for the given route.
+    '''
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return {"message": "Can't send anymore requests. Server is shutting down."}
+
+    data = json.loads(body)
+
+    if route == 'query':
+        try:
+            query = requested_query(data)
+        except ValueError as error:
+            return {"reason": str(error), "status": "error"}
+        new_task = submit_task(route, None, query=query)
+    else:
+        try:
+            years = requested_years(data)
+        except (TypeError, ValueError):
+            return {"reason": "Invalid year range", "status": "error"}
+        try:
+            percentile = requested_percentile(data)
+        except ValueError as error:
+            return {"reason": str(error), "status": "error"}
+        # the state_* routes need a state, like their Flask routes; the others don't use one
+        state = data['state'] if route.startswith('state_') else None
+        new_task = submit_task(route, data['question'], state, years, percentile=percentile)
+
+    response = {"job_id": format_job_id(new_task.task_id)}
+
+    if await completion_waiters.wait(new_task, wait):
+        # the response of the task was encoded once, when it was done
+        return with_fields(response, new_task.response)
+
+    return response
+
+
+async def get_results(job_id: str, wait: float):
+    '''
+    Handles the polling of a result. If the user asked to wait, the response is
+    sent as soon as the task is done, instead of answering "running" right away.
+    The response of a done task is returned as the bytes encoded when it was done.
+    '''
+    jobs = webserver.tasks_runner.jobs
+    task_id = parse_job_id(job_id)
+    task = jobs.get(task_id) if task_id is not None else None
+
+    if task is not None:
+        if await completion_waiters.wait(task, wait):
+            logger.info(f"Returning result for job_id: {job_id}", extra={'job_id': job_id})
+            return task.response
+
+        logger.info(f"Task with job_id: {job_id} is still running", extra={'job_id': job_id})
+        return {"status": "running"}
+
+    if task_id is not None and jobs.is_expired(task_id):
+        if (data := webserver.tasks_runner.store.read(task_id)) is not None:
+            logger.info(f"Returning stored result for job_id: {job_id}", extra={'job_id': job_id})
+            return done_response(data)
+
+        logger.info(f"Expired job_id: {job_id}", extra={'job_id': job_id})
+        return {"reason": "Expired job_id", "status": "expired"}
+
+    logger.info(f"Invalid job_id: {job_id}", extra={'job_id': job_id})
+    return {"reason": "Invalid job_id", "status": "error"}
+
+
+async def graceful_shutdown():
+    '''
+    Stops the ThreadPool once its queued tasks are done. The workers are joined
+    on the default executor, so the event loop keeps serving the other requests.
+    '''
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        logger.info("Already shutted down.")
+        return {"message": "Already shutted down."}
+
+    logger.info("Shutting down gracefully")
+    await asyncio.get_running_loop().run_in_executor(None, webserver.tasks_runner.stop)
+    return {"message": "Shutting down gracefully"}
+
+
+async def dispatch(method: str, path: str, query: dict, headers: dict, body: bytes):
+    '''
+    Calls the handler of the request and returns the HTTP status and the response.
+    '''
+    parts = path.strip('/').split('/')
+    wait = requested_wait(query, headers)
+
+    if method == 'POST' and len(parts) == 2 and parts[0] == 'api' and parts[1] in ROUTES:
+        return 200, await submit(parts[1], body, wait)
+
+    if method == 'GET' and len(parts) == 3 and parts[:2] == ['api', 'get_results']:
+        return 200, await get_results(parts[2], wait)
+
+    if method == 'GET' and parts == ['api', 'num_jobs']:
+        jobs_running = webserver.tasks_runner.jobs.pending()
+        logger.info(f"Number of jobs running: {jobs_running}")
+        return 200, {'num_jobs': jobs_running}
+
+    if method == 'GET' and parts == ['api', 'graceful_shutdown']:
+        return 200, await graceful_shutdown()
+
+    return 404, {"reason": "Not found", "status": "error"}
+
+
+async def read_body(receive):
+    '''
+    Reads the whole body of the request.
+    '''
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def application(scope, receive, send):
+    '''
+    The ASGI application.
+    '''
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # the worker threads would keep the process running after the server stops
+                await graceful_shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    query = parse_qs(scope.get('query_string', b'').decode())
+    headers = dict(scope.get('headers', []))
+
+    extra_headers = []
+    try:
+        status, response = await dispatch(scope['method'], scope['path'], query, headers, body)
+    except Overloaded as error:
+        logger.info(f"Rejected job: {error.reason}")
+        status, response = error.status, {"reason": error.reason, "status": "error"}
+        extra_headers.append((b'retry-after', str(error.retry_after).encode()))
+    except InvalidRequest as error:
+        logger.info(f"Invalid request: {error.reason}")
+        status, response = 200, {"reason": error.reason, "status": "error"}
+    except (ValueError, KeyError, TypeError) as error:
+        logger.error(f"Bad request on {scope['path']}: {error}")
+        status, response = 400, {"reason": "Bad request", "status": "error"}
+
+    # the results of the done tasks are already encoded
+    payload = response if isinstance(response, bytes) else json.dumps(response).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode())] + extra_headers,
+    })
+    await send({'type': 'http.response.body', 'body': payload})
@@ -1,9 +1,37 @@
 '''
 This module handles the data ingestion.
-It reads the data from a csv file and returns a list of dictionaries.
+It reads the columns needed by the queries from a csv file into a pandas dataframe.
 '''
-import csv
+from itertools import islice
+from threading import Event
+import copy
+import logging
+import math
+import resource
+import time
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from .snapshot import load_snapshot, save_snapshot
+from .aggregate_index import AggregateIndex, EMPTY_VALUES, key_to_str
+from .query_index import QueryIndex
+
+# the records go to the structured log set up by the routes (see request_log)
+logger = logging.getLogger("webserver")
+
+# the only columns used by the queries; the string columns have a small number of
+# distinct values, so they are stored as categoricals
+CSV_COLUMNS = {
+    'Question': 'category',
+    'LocationDesc': 'category',
+    'StratificationCategory1': 'category',
+    'Stratification1': 'category',
+    'Data_Value': 'float64',
+    'YearStart': 'int16',
+}
+
+# the percentile computed when a request doesn't give one, the median
+DEFAULT_PERCENTILE = 50
 
 
 class DataIngestor:
@@ -11,16 +39,45 @@ class DataIngestor:
     Class that reads the data from a csv file and provides methods to
     obtain the data needed for each task.
     Attributes:
-        csv_data: list of dictionaries
         csv_path: path to the csv file
-        panda_data: pandas dataframe to easily manipulate the data
+        panda_data: pandas dataframe with the columns used by the queries
         questions_best_is_min: list of questions where the best value is the minimum
         questions_best_is_max: list of questions where the best value is the maximum
+        index: aggregates precomputed at load time for every question
+        load_stats: how long the loading took and how much memory it uses
+        base_data: the dataframe loaded from the csv file
+        deltas: the dataframes of the rows appended since then (see appended)
+        base_version: the dataset version the csv file was loaded as
+        revisions: question -> dataset version of the last append that changed it
+        query_index: the row ids used by the generic queries, built on the first one
+    If snapshot_dir is given, the data and the aggregates are loaded from the snapshot
+    of the csv file when there is a valid one, and a snapshot is saved otherwise.
     '''
-    def __init__(self, csv_path: str):
-        self.csv_data = []
+    def __init__(self, csv_path: str, snapshot_dir: str = None):
+        start = time.perf_counter()
+
         self.csv_path = csv_path
-        self.panda_data = pd.read_csv(csv_path)
+        snapshot = load_snapshot(csv_path, snapshot_dir) if snapshot_dir else None
+
+        if snapshot is not None:
+            self.base_data, self.index = snapshot
+        else:
+            self.base_data = read_csv_rows(csv_path)
+            # precompute the aggregates so that every task is a dictionary lookup
+            self.index = AggregateIndex(self.base_data)
+
+            if snapshot_dir:
+                try:
+                    save_snapshot(csv_path, snapshot_dir, self.base_data, self.index)
+                except OSError as error:
+                    # the data is loaded anyway, only the next start is slower
+                    logger.warning(f"Can't save the snapshot of {csv_path}: {error}")
+
+        self.deltas = ()
+        self.merged_data = None
+        self.base_version = 0
+        self.revisions = {}
+        self.query_index = None
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -37,32 +94,129 @@ class DataIngestor:
             'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
         ]
 
-        # read the csv file and store the data in a list of dictionaries
-        with open(self.csv_path, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                self.csv_data.append(dict(row))
+        self.load_stats = {
+            'load_seconds': time.perf_counter() - start,
+            'from_snapshot': snapshot is not None,
+            'rows': len(self.base_data),
+            'data_bytes': int(self.base_data.memory_usage(deep=True).sum()),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+    @property
+    def panda_data(self):
+        '''
+        The dataframe with all the rows, the loaded and the appended ones.
+        The appended rows are merged into it only when it is needed.
+        '''
+        if not self.deltas:
+            return self.base_data
+        if self.merged_data is None:
+            self.merged_data = concat_rows((self.base_data,) + self.deltas)
+        return self.merged_data
 
-    def get_states_mean(self, question: str):
+    def revision(self, question: str):
+        '''
+        Returns the dataset version of the aggregates of the question, which changes
+        only when the dataset is reloaded or rows of the question are appended.
+        Without a question, it is the version of the whole dataset.
+        '''
+        if question is None:
+            return max(self.revisions.values(), default=self.base_version)
+        return self.revisions.get(question, self.base_version)
+
+    def appended(self, rows: pd.DataFrame, version: int):
+        '''
+        Returns a new DataIngestor with the given rows appended, as the given dataset
+        version, and the questions the rows changed.
+        Only the aggregates of those questions are updated, from their running sums
+        and counts, and everything else is shared with this DataIngestor, which is
+        left unchanged for the tasks that still use it.
+        '''
+        data_ingestor = copy.copy(self)
+        data_ingestor.deltas = self.deltas + (rows,)
+        data_ingestor.merged_data = None
+        data_ingestor.query_index = None
+        data_ingestor.index, questions = self.index.appended(rows)
+
+        data_ingestor.revisions = dict(self.revisions)
+        for question in questions:
+            data_ingestor.revisions[question] = version
+
+        data_ingestor.load_stats = dict(self.load_stats)
+        data_ingestor.load_stats['rows'] += len(rows)
+        data_ingestor.load_stats['appended_rows'] = \
+            self.load_stats.get('appended_rows', 0) + len(rows)
+
+        return data_ingestor, questions
+
+    def compute_result(self, route: str, question: str, state: str, years: tuple = None,
+                       query: dict = None, percentile: float = None):
         '''
-        Calculates the average of the data_value for each state for the given question,
-        grouped by state and sorts the values in ascending order.
+        Checks the route of a task and calls the appropriate
+        method that will handle the data.
+        The routes that take a year range use years, a (start, end) tuple where
+        None means the range isn't bounded on that side.
+        The query route uses query, see QueryIndex.run.
+        The percentile routes use percentile, between 0 and 100, the median by default.
         '''
-        pd_data = self.panda_data[self.panda_data['Question'] == question]. \
-            groupby(['LocationDesc'])['Data_Value'].mean().sort_values(ascending=True)
+        years = years or (None, None)
+        percentile = DEFAULT_PERCENTILE if percentile is None else percentile
+        if route == 'states_mean':
+            return self.get_states_mean(question)
+        if route == 'state_mean':
+            return self.get_state_mean(state, question)
+        if route == 'best5':
+            return self.get_best5(question)
+        if route == 'worst5':
+            return self.get_worst5(question)
+        if route == 'global_mean':
+            return self.get_global_mean(question)
+        if route == 'diff_from_mean':
+            return self.get_diff_from_mean(question)
+        if route == 'state_diff_from_mean':
+            return self.get_state_diff_from_mean(state, question)
+        if route == 'mean_by_category':
+            return self.get_mean_by_category(question)
+        if route == 'state_mean_by_category':
+            return self.get_state_mean_by_category(state, question)
+        if route == 'states_mean_range':
+            return self.get_states_mean_range(question, years)
+        if route == 'state_mean_range':
+            return self.get_state_mean_range(state, question, years)
+        if route == 'global_mean_range':
+            return self.get_global_mean_range(question, years)
+        if route == 'state_trend':
+            return self.get_state_trend(state, question, years)
+        if route == 'query':
+            return self.get_query(query)
+        if route == 'states_percentile':
+            return self.get_states_percentile(question, percentile)
+        if route == 'state_percentile':
+            return self.get_state_percentile(state, question, percentile)
+        if route == 'state_percentile_by_category':
+            return self.get_state_percentile_by_category(state, question, percentile)
+        if route == 'states_stddev':
+            return self.get_states_stddev(question)
+        if route == 'state_stddev':
+            return self.get_state_stddev(state, question)
+        return None
 
-        # converts the pandas dataframe to a dictionary
-        return pd_data.to_dict()
+    def get_states_mean(self, question: str):
+        '''
+        Returns the average of the data_value for each state for the given question,
+        sorted in ascending order.
+        '''
+        # copying the precomputed dictionary so the callers can't alter the index
+        return dict(self.index.states_means.get(question, {}))
 
     def get_state_mean(self, state: str, question: str):
         '''
-        Calculates the average of the data_value for the given state and question
-        and returns the result as a dictionary.
+        Returns the average of the data_value for the given state and question
+        as a dictionary.
         '''
         result = {}
-
-        result[state] = self.panda_data[(self.panda_data['LocationDesc'] == state) \
-                & (self.panda_data['Question'] == question)]['Data_Value'].mean()
+        result[state] = self.index.states_means.get(question, {}).get(state, float('nan'))
 
         return result
 
@@ -71,37 +225,24 @@ class DataIngestor:
         Returns the top 5 states with the best values for the given question.
         '''
         if question in self.questions_best_is_min:
-            # if the best value is the minimum, we sort the values in ascending order
-            pd_data = self.panda_data[self.panda_data['Question'] == question]. \
-                groupby(['LocationDesc'])['Data_Value'].mean().sort_values(ascending=True)
+            # if the best value is the minimum, we take the states in ascending order
+            return take_first(self.index.states_means.get(question, {}), 5)
 
-            # returns a dictionary
-            return pd_data.head(5).to_dict()
-
-        elif question in self.questions_best_is_max:
-            # if the best value is the maximum, we sort the values in descending order
-            pd_data = self.panda_data[self.panda_data['Question'] == question]. \
-                groupby(['LocationDesc'])['Data_Value'].mean().sort_values(ascending=False)
-
-            # returns a dictionary
-            return pd_data.head(5).to_dict()
+        if question in self.questions_best_is_max:
+            # if the best value is the maximum, we take the states in descending order
+            return take_first(self.index.states_means_desc.get(question, {}), 5)
 
         return None
 
     def get_worst5(self, question: str):
         '''
-        Similar to best5 but we sort the values in the opposite order.
+        Similar to best5 but we take the states in the opposite order.
         '''
         if question in self.questions_best_is_min:
-            pd_data = self.panda_data[self.panda_data['Question'] == question]. \
-                groupby(['LocationDesc'])['Data_Value'].mean().sort_values(ascending=False)
+            return take_first(self.index.states_means_desc.get(question, {}), 5)
 
-            return pd_data.head(5).to_dict()
-        elif question in self.questions_best_is_max:
-            pd_data = self.panda_data[self.panda_data['Question'] == question]. \
-                groupby(['LocationDesc'])['Data_Value'].mean().sort_values(ascending=True)
-
-            return pd_data.head(5).to_dict()
+        if question in self.questions_best_is_max:
+            return take_first(self.index.states_means.get(question, {}), 5)
 
         return None
 
@@ -110,8 +251,7 @@ class DataIngestor:
         Creating a dictionary with the global average value for the given question.
         '''
         result = {}
-        result['global_mean'] = self.panda_data[self.panda_data['Question']== question] \
-            ['Data_Value'].mean()
+        result['global_mean'] = self.index.global_means.get(question, float('nan'))
 
         return result
 
@@ -119,11 +259,12 @@ class DataIngestor:
         '''
         Returning the difference between the global mean and each's states mean.
         '''
-        result = self.get_states_mean(question)
+        states_means = self.index.states_means.get(question, {})
         global_mean = self.get_global_mean(question)['global_mean']
 
-        for state in result:
-            result[state] = global_mean - result[state]
+        result = {}
+        for state, state_mean in states_means.items():
+            result[state] = global_mean - state_mean
 
         return result
 
@@ -142,49 +283,248 @@ class DataIngestor:
         '''
         Returning the average value for each category for the given question.
         '''
-        pd_data = self.panda_data[self.panda_data['Question'] == question].groupby \
-            (['LocationDesc', 'StratificationCategory1', 'Stratification1'])['Data_Value']. \
-                mean().sort_index()
+        return dict(self.index.categories_means.get(question, {}))
 
-        # convert tuples keys to strings to be able to put them in a json format later
-        result_dict = pd_data.to_dict()
+    def get_state_mean_by_category(self, state: str, question: str):
+        '''
+        Similar to previous function but for only one certain state.
+        '''
         result = {}
+        result[state] = dict(self.index.state_categories_means.get((question, state), {}))
+        return result
 
-        for key in result_dict:
-            new_key = "('" + "', '".join(key) + "')"
-            result[new_key] = result_dict[key]
+    def get_states_mean_range(self, question: str, years: tuple):
+        '''
+        Returns the average of the data_value for each state for the given question,
+        over the rows of the given years, sorted in ascending order.
+        The states without values in those years are left out.
+        '''
+        means = {}
+        for state in self.index.states_means.get(question, {}):
+            total, count = self.index.range_totals(question, state, years)
+            if count > 0:
+                means[state] = total / count
+
+        return dict(sorted(means.items(), key=lambda item: item[1]))
+
+    def get_state_mean_range(self, state: str, question: str, years: tuple):
+        '''
+        Returns the average of the data_value for the given state and question,
+        over the rows of the given years.
+        '''
+        total, count = self.index.range_totals(question, state, years)
 
+        result = {}
+        result[state] = total / count if count > 0 else float('nan')
         return result
 
-    def get_state_mean_by_category(self, state: str, question: str):
+    def get_global_mean_range(self, question: str, years: tuple):
         '''
-        Similar to previous function but for only one certain state.
+        Returns the global average value for the given question, over the rows
+        of the given years.
+        '''
+        total, count = self.index.range_totals(question, None, years)
+
+        result = {}
+        result['global_mean'] = total / count if count > 0 else float('nan')
+        return result
+
+    def get_state_trend(self, state: str, question: str, years: tuple):
+        '''
+        Returns the average of the data_value for the given state and question
+        for every year of the given range that has values, as {year: average}.
+        '''
+        result = {}
+        for year, (total, count) in self.index.year_totals(question, state, years):
+            if count > 0:
+                result[str(year)] = total / count
+
+        result = {state: result}
+        return result
+
+    def get_states_percentile(self, question: str, percentile: float):
+        '''
+        Returns the given percentile of the data_value for each state for the given
+        question, sorted in ascending order.
+        '''
+        states = self.index.distributions.get(question, {}).get('states', {})
+        return sort_by_value({state: percentile_of(values, percentile)
+                              for state, (values, _) in states.items()})
+
+    def get_state_percentile(self, state: str, question: str, percentile: float):
+        '''
+        Returns the given percentile of the data_value for the given state and question.
+        '''
+        states = self.index.distributions.get(question, {}).get('states', {})
+        values, _ = states.get(state, (EMPTY_VALUES, float('nan')))
+
+        result = {}
+        result[state] = percentile_of(values, percentile)
+        return result
+
+    def get_state_percentile_by_category(self, state: str, question: str, percentile: float):
         '''
-        pd_data = self.panda_data[(self.panda_data['Question'] == question) & \
-            (self.panda_data['LocationDesc'] == state)].groupby \
-            (['StratificationCategory1', 'Stratification1'])['Data_Value'].mean().sort_index()
+        Returns the given percentile of the data_value for the given state and question
+        for each (category, stratification), like get_state_mean_by_category.
+        '''
+        categories = self.index.distributions.get(question, {}).get('categories', {})
+
+        result = {}
+        result[state] = {key_to_str(group): percentile_of(values, percentile)
+                         for group, (values, _) in categories.get(state, {}).items()}
+        return result
 
-        result_dict = pd_data.to_dict()
-        value_dict = {}
+    def get_states_stddev(self, question: str):
+        '''
+        Returns the standard deviation of the data_value for each state for the given
+        question, sorted in ascending order. It is NaN for the states with only one value.
+        '''
+        states = self.index.distributions.get(question, {}).get('states', {})
+        return sort_by_value({state: stddev for state, (_, stddev) in states.items()})
 
-        for key in result_dict:
-            new_key = "('" + "', '".join(key) + "')"
-            value_dict[new_key] = result_dict[key]
+    def get_state_stddev(self, state: str, question: str):
+        '''
+        Returns the standard deviation of the data_value for the given state and question.
+        '''
+        states = self.index.distributions.get(question, {}).get('states', {})
 
         result = {}
-        result[state] = value_dict
+        result[state] = states.get(state, (EMPTY_VALUES, float('nan')))[1]
         return result
 
+    def get_query(self, query: dict):
+        '''
+        Returns the result of a generic query, see QueryIndex.run.
+        The row ids used by the queries are built on the first one, from all the rows.
+        '''
+        if self.query_index is None:
+            self.query_index = QueryIndex(self.panda_data)
+        return self.query_index.run(query)
+
+
+def take_first(values: dict, count: int):
+    '''
+    Returns a new dictionary with the first count entries of the given one.
+    '''
+    return dict(islice(values.items(), count))
+
+
+def sort_by_value(values: dict):
+    '''
+    Returns the dictionary sorted by its values in ascending order, with the NaN last.
+    '''
+    return dict(sorted(values.items(), key=lambda item: (math.isnan(item[1]), item[1])))
+
+
+def percentile_of(values: np.ndarray, percentile: float):
+    '''
+    Returns the percentile of the sorted values, interpolated linearly between the
+    closest two like numpy.percentile, or NaN if there are no values.
+    '''
+    if not len(values):
+        return float('nan')
+
+    position = percentile / 100 * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return float(values[lower] + (values[upper] - values[lower]) * (position - lower))
+
+
+def read_csv_rows(csv_path: str):
+    '''
+    Reads the csv file once, keeping only the columns we need.
+    '''
+    return pd.read_csv(csv_path, usecols=list(CSV_COLUMNS), dtype=CSV_COLUMNS)
+
+
+def read_rows(records: list):
+    '''
+    Returns a dataframe, with the columns and types of the loaded data, from a list
+    of {column: value} rows. Raises ValueError if a row misses one of the columns.
+    '''
+    for record in records:
+        missing = [column for column in CSV_COLUMNS if column not in record]
+        if missing:
+            raise ValueError(f"Missing columns: {missing}")
+
+    return pd.DataFrame(records, columns=list(CSV_COLUMNS)).astype(CSV_COLUMNS)
+
+
+def concat_rows(frames: tuple):
+    '''
+    Concatenates dataframes with the CSV_COLUMNS columns, keeping the string columns
+    as categoricals with the union of their categories.
+    '''
+    columns = {}
+    for column, dtype in CSV_COLUMNS.items():
+        if dtype == 'category':
+            columns[column] = union_categoricals([frame[column] for frame in frames])
+        else:
+            columns[column] = pd.concat([frame[column] for frame in frames], ignore_index=True)
+
+    return pd.DataFrame(columns)
+
 
 class Task:
     '''
     Class that represents a task that needs to be done.
     We keep track of the question, state, task_id, route, its status and its result.
+    The routes that take a year range get it as years, a (start, end) tuple,
+    the query route gets its query (see QueryIndex.run) and the percentile
+    routes get their percentile.
+    The timestamps dictionary records when the task went through each stage
+    (enqueue, dequeue, compute_start, compute_end, persisted, done)
+    using time.perf_counter().
+    The completed event is set once the result is available, so threads can
+    wait for the task to be done. The response sent for the done task is
+    encoded once, when the result is written (see encoding).
+    A task that failed is done with the reason in error and no result.
     '''
-    def __init__(self, question: str, state_name: str, task_id: int, route: str):
+    def __init__(self, question: str, state_name: str, task_id: int, route: str,
+                 years: tuple = None, query: dict = None, percentile: float = None):
         self.question = question
         self.state_name = state_name
         self.task_id = task_id
         self.route = route
-        self.done = False
+        self.years = years
+        self.query = query
+        self.percentile = percentile
+        self.completed = Event()
         self.result = None
+        self.response = None
+        self.error = None
+        self.timestamps = {}
+
+    @property
+    def done(self):
+        '''
+        Checks if the result of the task is available.
+        '''
+        return self.completed.is_set()
+
+    def wait(self, timeout: float):
+        '''
+        Waits at most timeout seconds for the task to be done.
+        Returns True if the task is done.
+        '''
+        return self.completed.wait(timeout)
+
+    def queue_wait(self):
+        '''
+        Returns how long the task waited in the queue before a worker picked it up,
+        or None if it wasn't picked up yet.
+        '''
+        if 'dequeue' not in self.timestamps:
+            return None
+        return self.timestamps['dequeue'] - self.timestamps['enqueue']
+
+
+class BatchTask(Task):
+    '''
+    Class that represents a batch of tasks that are queued and executed together.
+    Every item is a Task with its own task id, so it can also be polled on its own.
+    The result of the batch maps the job id of every item to its result.
+    '''
+    def __init__(self, items: list, task_id: int):
+        super().__init__(None, None, task_id, 'batch')
+        self.items = items
@@ -0,0 +1,185 @@
+'''
+This module contains the Dataset class that owns the DataIngestor used by the
+workers and replaces it, without downtime, when the csv file is reloaded.
+'''
+from threading import Thread, Lock
+import logging
+import os
+import time
+from .data_ingestor import DataIngestor
+
+DEFAULT_DATASET_PATH = "./nutrition_activity_obesity_usa_subset.csv"
+
+# the records go to the structured log set up by the routes (see request_log)
+logger = logging.getLogger("webserver")
+
+
+def current_rss_bytes():
+    '''
+    Returns the resident memory of the process, in bytes.
+    '''
+    with open('/proc/self/statm', 'r', encoding='utf-8') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def file_mtime(path: str):
+    '''
+    Returns the modification time of the file, or None if it can't be read.
+    '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Dataset:
+    '''
+    Class that keeps the current DataIngestor and reloads it in the background.
+    The new DataIngestor is built while the old one keeps serving the tasks and
+    then swapped in with a single assignment, so the tasks that already started
+    finish on the data they started with.
+    Attributes:
+        path: path to the csv file that is currently loaded
+        snapshot_dir: directory of the snapshots of the csv file
+        data_dir: directory of the csv files that can be reloaded or appended
+        current: (version, DataIngestor) pair the new tasks use; the version is
+            incremented on every reload and append and is read together with the data
+        reload_lock: makes sure only one reload or append runs at a time
+        reload_stats: duration and memory overlap of the last reload
+        on_reload: function called after the new DataIngestor is swapped in
+        on_append: function called with the questions changed by an append
+    '''
+    def __init__(self, path: str, snapshot_dir: str, on_reload=None, on_append=None,
+                 data_dir: str = None):
+        self.path = path
+        self.snapshot_dir = snapshot_dir
+        self.data_dir = data_dir or os.path.dirname(path) or '.'
+        self.current = (0, DataIngestor(path, snapshot_dir))
+        self.reload_lock = Lock()
+        self.reload_stats = None
+        self.on_reload = on_reload
+        self.on_append = on_append
+
+    @property
+    def data_ingestor(self):
+        '''
+        The DataIngestor the new tasks use.
+        '''
+        return self.current[1]
+
+    @classmethod
+    def from_env(cls, on_reload=None, on_append=None):
+        '''
+        Creates the dataset from the TP_DATASET_PATH and TP_SNAPSHOT_DIR
+        environment variables. The csv files that can be reloaded or appended are the
+        ones of the TP_DATA_DIR directory, by default the one of TP_DATASET_PATH.
+        '''
+        return cls(os.environ.get('TP_DATASET_PATH', DEFAULT_DATASET_PATH),
+                   os.environ.get('TP_SNAPSHOT_DIR', 'snapshots'), on_reload, on_append,
+                   os.environ.get('TP_DATA_DIR'))
+
+    def data_path(self, path):
+        '''
+        Returns the absolute path of a csv file of the data directory, given relative
+        to it, or None if it isn't a csv file or it leads outside of the data directory.
+        The links put in the data directory are followed, like the dataset path itself.
+        '''
+        if not isinstance(path, str) or not path.endswith('.csv'):
+            return None
+
+        data_dir = os.path.abspath(self.data_dir)
+        full_path = os.path.abspath(os.path.join(data_dir, path))
+        if os.path.commonpath([data_dir, full_path]) != data_dir:
+            return None
+        return full_path
+
+    def start_reload(self, path: str = None):
+        '''
+        Starts reloading the dataset from the given path (or the current one)
+        in a background thread. Returns False if a reload is already running.
+        '''
+        if not self.reload_lock.acquire(blocking=False):
+            return False
+
+        Thread(target=self.reload, args=(path or self.path,), daemon=True).start()
+        return True
+
+    def reload(self, path: str):
+        '''
+        Builds a new DataIngestor from the given path and swaps it in.
+        Must be called with the reload lock held, which it releases.
+        '''
+        try:
+            start = time.perf_counter()
+            rss_before = current_rss_bytes()
+
+            data_ingestor = DataIngestor(path, self.snapshot_dir)
+            # both datasets are in memory at this point
+            rss_overlap = current_rss_bytes() - rss_before
+
+            data_ingestor.base_version = self.current[0] + 1
+            self.current = (data_ingestor.base_version, data_ingestor)
+            self.path = path
+            if self.on_reload is not None:
+                self.on_reload()
+
+            self.reload_stats = {
+                'path': path,
+                'reload_seconds': time.perf_counter() - start,
+                'overlap_rss_bytes': rss_overlap,
+            }
+        except (OSError, ValueError) as error:
+            logger.error(f"Reload of the csv file {path} failed: {error}")
+            # the details of the error aren't sent back, they may describe the server files
+            self.reload_stats = {'path': path, 'error': "Can't load the csv file"}
+        finally:
+            self.reload_lock.release()
+
+
+    def append(self, rows):
+        '''
+        Appends the rows (a dataframe with the CSV_COLUMNS columns) to the dataset,
+        in memory, and swaps in the new DataIngestor. Waits for a running reload.
+        Returns the new version and the questions the rows changed.
+        '''
+        with self.reload_lock:
+            version = self.current[0] + 1
+            data_ingestor, questions = self.current[1].appended(rows, version)
+            self.current = (version, data_ingestor)
+
+        if self.on_append is not None:
+            self.on_append(questions)
+
+        return version, questions
+
+
+class DatasetWatcher(Thread):
+    '''
+    Thread that reloads the dataset when its csv file changes on disk,
+    checking every interval seconds until the stop event is set.
+    '''
+    def __init__(self, dataset: Dataset, interval: float, stop_event):
+        Thread.__init__(self, daemon=True)
+
+        self.dataset = dataset
+        self.interval = interval
+        self.stop_event = stop_event
+
+    def run(self):
+        '''
+        Loop that checks the modification time of the csv file.
+        '''
+        last_path = self.dataset.path
+        last_mtime = file_mtime(last_path)
+
+        while not self.stop_event.wait(self.interval):
+            path = self.dataset.path
+            mtime = file_mtime(path)
+
+            # a reload to another path isn't a change of the watched file
+            if path == last_path and mtime not in (last_mtime, None):
+                if not self.dataset.start_reload():
+                    # a reload is already running, we try again next time
+                    continue
+
+            last_path, last_mtime = path, mtime
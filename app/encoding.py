@@ -0,0 +1,51 @@
+'''
+This module encodes the results of the tasks to JSON once, when they are done,
+so the polls and the persistence path send the same bytes without encoding them again.
+'''
+import json
+
+# compact separators make the payloads smaller, and the results never contain
+# reference cycles, so the encoder doesn't need to check for them
+ENCODER = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+# the response sent for a done task is DONE_PREFIX + the encoded result + DONE_SUFFIX
+DONE_PREFIX = b'{"data":'
+DONE_SUFFIX = b',"status":"done"}'
+
+
+def encode_result(result):
+    '''
+    Returns the JSON encoding of a result.
+    '''
+    return ENCODER.encode(result)
+
+
+def done_response(data: str):
+    '''
+    Returns the bytes of the response of a done task, from its encoded result.
+    '''
+    return DONE_PREFIX + data.encode() + DONE_SUFFIX
+
+
+def error_response(reason: str):
+    '''
+    Returns the bytes of the response of a task that failed.
+    '''
+    return encode_result({"reason": reason, "status": "error"}).encode()
+
+
+def with_fields(fields: dict, response: bytes):
+    '''
+    Returns the bytes of the response of a done task with the given fields put
+    before its own, ex. its job id, without decoding the response.
+    '''
+    if not fields:
+        return response
+    return b'{' + encode_result(fields)[1:-1].encode() + b',' + response[1:]
+
+
+def response_data(response: bytes):
+    '''
+    Returns the encoded result from the response of a done task.
+    '''
+    return response[len(DONE_PREFIX):-len(DONE_SUFFIX)].decode()
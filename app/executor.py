@@ -0,0 +1,254 @@
+'''
+This module contains the backends that compute the results of the tasks:
+on the worker threads themselves, or on a pool of processes.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, Thread
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import pandas as pd
+from .data_ingestor import DataIngestor
+from .encoding import encode_result
+
+# the dataset of the current worker process, set by its initializer: the csv file,
+# the snapshot directory and the DataIngestors by their number of appended deltas
+PROCESS_DATA = {}
+
+# number of dataset versions a worker process keeps, so the tasks that started
+# before an append don't load the dataset again
+KEPT_VERSIONS = 2
+
+
+def delta_path(deltas_dir: str, delta: int):
+    '''
+    Returns the path of the file of the rows of the given append.
+    '''
+    return os.path.join(deltas_dir, f'delta_{delta:06d}.pkl')
+
+
+def init_process(csv_path: str, snapshot_dir: str):
+    '''
+    Loads the dataset in a worker process. When the snapshot is enabled the columns
+    are memory-mapped, so all the processes share the same pages.
+    '''
+    PROCESS_DATA['csv_path'] = csv_path
+    PROCESS_DATA['snapshot_dir'] = snapshot_dir
+    PROCESS_DATA['versions'] = {0: DataIngestor(csv_path, snapshot_dir)}
+
+
+def process_data_ingestor(deltas_dir: str, num_deltas: int):
+    '''
+    Returns the DataIngestor of the worker process with the first num_deltas
+    appends applied. The appends the process doesn't have yet are read from the
+    files of deltas_dir and applied to the closest version it has, or to the
+    dataset loaded again if it doesn't keep an older one.
+    '''
+    versions = PROCESS_DATA['versions']
+    if num_deltas in versions:
+        return versions[num_deltas]
+
+    delta = max((count for count in versions if count < num_deltas), default=None)
+    if delta is None:
+        delta = 0
+        data_ingestor = DataIngestor(PROCESS_DATA['csv_path'], PROCESS_DATA['snapshot_dir'])
+    else:
+        data_ingestor = versions[delta]
+
+    for delta in range(delta, num_deltas):
+        data_ingestor, _ = data_ingestor.appended(pd.read_pickle(delta_path(deltas_dir, delta)),
+                                                  delta + 1)
+
+    versions[num_deltas] = data_ingestor
+    while len(versions) > KEPT_VERSIONS:
+        del versions[min(versions)]
+    return data_ingestor
+
+
+def compute_in_process(deltas_dir: str, num_deltas: int, route: str, question: str,
+                       state: str, years: tuple = None, query: dict = None,
+                       percentile: float = None):
+    '''
+    Computes the result of a task in a worker process, on the dataset with the
+    first num_deltas appends applied, and returns it encoded as JSON, which is
+    more compact to send back than a pickle.
+    '''
+    data_ingestor = process_data_ingestor(deltas_dir, num_deltas)
+    return encode_result(data_ingestor.compute_result(route, question, state, years, query,
+                                                      percentile))
+
+
+def retire_pool(executor: ProcessPoolExecutor, deltas_dir: str):
+    '''
+    Waits for the tasks already submitted to an old pool, then stops its
+    processes and removes the files of its appends.
+    '''
+    executor.shutdown()
+    shutil.rmtree(deltas_dir, ignore_errors=True)
+
+
+class ThreadBackend:
+    '''
+    Backend that computes the results on the calling worker thread.
+    '''
+    def compute(self, task, data_ingestor):
+        '''
+        Computes the result of the task from the given dataset and returns it
+        along with its JSON encoding.
+        '''
+        result = data_ingestor.compute_result(task.route, task.question, task.state_name,
+                                              task.years, task.query, task.percentile)
+        return result, encode_result(result)
+
+    def shutdown(self):
+        '''
+        Nothing to release for the threads backend.
+        '''
+
+
+class VersionPool:
+    '''
+    A pool of processes started with one version of the dataset.
+    Attributes:
+        executor: the pool of processes
+        deltas_dir: directory of the files of the appends
+        num_deltas: number of appends written to deltas_dir
+        running: number of tasks submitted to the pool that haven't finished yet
+    '''
+    def __init__(self, executor: ProcessPoolExecutor):
+        self.executor = executor
+        self.deltas_dir = tempfile.mkdtemp(prefix='deltas_')
+        self.num_deltas = 0
+        self.running = 0
+
+    def write_deltas(self, data_ingestor):
+        '''
+        Writes the appends of the given DataIngestor the processes may not have yet.
+        '''
+        for delta in range(self.num_deltas, len(data_ingestor.deltas)):
+            data_ingestor.deltas[delta].to_pickle(delta_path(self.deltas_dir, delta))
+        self.num_deltas = max(self.num_deltas, len(data_ingestor.deltas))
+
+    def submit(self, task, data_ingestor):
+        '''
+        Submits the task to the processes, on the dataset of the given DataIngestor,
+        and returns the future of its encoded result.
+        '''
+        self.running += 1
+        return self.executor.submit(compute_in_process, self.deltas_dir,
+                                    len(data_ingestor.deltas), task.route, task.question,
+                                    task.state_name, task.years, task.query, task.percentile)
+
+
+class ProcessBackend:
+    '''
+    Backend that computes the results on a pool of processes, so the aggregations
+    aren't serialized on the GIL. The worker threads only wait for the results.
+    A pool is started (forked) only for the first task and after the dataset is
+    reloaded. The pools of the older versions of the dataset are retired once their
+    tasks have finished; the tasks that still use such a version afterwards are
+    computed on the worker thread, so they don't start a pool again.
+    The rows appended to the dataset are written once to a file of the deltas_dir
+    of the pool, and every process applies the ones it doesn't have yet before its
+    next task, so an append doesn't load the dataset again.
+    Attributes:
+        num_processes: number of worker processes of a pool
+        snapshot_dir: directory of the dataset snapshots the processes load
+        lock: protects the pools, the submissions to them and the writing of the deltas
+        pools: the running pools, by the base version of the dataset they loaded
+        current: the base version of the newest dataset a pool was started for
+    '''
+    def __init__(self, num_processes: int, snapshot_dir: str):
+        self.num_processes = num_processes
+        self.snapshot_dir = snapshot_dir
+        self.lock = Lock()
+        self.pools = {}
+        self.current = None
+
+    def submit(self, task, data_ingestor):
+        '''
+        Submits the task to the pool of processes that loaded the dataset of the given
+        DataIngestor, after writing the appends they may not have yet. Returns the
+        pool and the future of the encoded result, or None when the pool of that
+        version of the dataset was already retired.
+        '''
+        with self.lock:
+            version = data_ingestor.base_version
+            pool = self.pools.get(version)
+            if pool is None:
+                if self.current is not None and version <= self.current:
+                    return None
+                # forking doesn't import the app again in the children
+                pool = VersionPool(ProcessPoolExecutor(
+                    self.num_processes, mp_context=multiprocessing.get_context('fork'),
+                    initializer=init_process,
+                    initargs=(data_ingestor.csv_path, self.snapshot_dir)))
+                self.pools[version] = pool
+                self.current = version
+                for old_version in [old for old in self.pools if old != version]:
+                    self.retire_idle(old_version)
+
+            # submitted under the lock, so the pool can't be retired in between
+            pool.write_deltas(data_ingestor)
+            return pool, pool.submit(task, data_ingestor)
+
+    def finished(self, version: int, pool: VersionPool):
+        '''
+        Counts a task of the pool as finished, and retires the pool if it was the
+        last one and the dataset was reloaded since.
+        '''
+        with self.lock:
+            pool.running -= 1
+            self.retire_idle(version)
+
+    def retire_idle(self, version: int):
+        '''
+        Retires the pool of an older version of the dataset if it has no task
+        running. Called with the lock held.
+        '''
+        pool = self.pools[version]
+        if version != self.current and pool.running == 0:
+            del self.pools[version]
+            Thread(target=retire_pool, args=(pool.executor, pool.deltas_dir),
+                   daemon=True).start()
+
+    def compute(self, task, data_ingestor):
+        '''
+        Computes the result of the task in a worker process, on the same dataset
+        as the given one, and returns it along with the JSON encoding the process
+        sent back.
+        '''
+        submitted = self.submit(task, data_ingestor)
+        if submitted is None:
+            return ThreadBackend().compute(task, data_ingestor)
+
+        pool, future = submitted
+        try:
+            data = future.result()
+        finally:
+            self.finished(data_ingestor.base_version, pool)
+        return json.loads(data), data
+
+    def shutdown(self):
+        '''
+        Stops the worker processes and removes the files of the appends.
+        '''
+        with self.lock:
+            for pool in self.pools.values():
+                retire_pool(pool.executor, pool.deltas_dir)
+            self.pools.clear()
+
+
+def backend_from_env(snapshot_dir: str):
+    '''
+    Creates the backend selected by the TP_EXECUTOR environment variable:
+    "threads" (the default) or "processes". The number of processes is given by
+    TP_NUM_OF_PROCESSES, or the number of CPUs on the machine.
+    '''
+    if os.environ.get('TP_EXECUTOR', 'threads') == 'processes':
+        num_processes = int(os.environ.get('TP_NUM_OF_PROCESSES', os.cpu_count()))
+        return ProcessBackend(num_processes, snapshot_dir)
+
+    return ThreadBackend()
@@ -0,0 +1,299 @@
+'''
+This module contains the JobRegistry class that keeps track of the jobs
+submitted to the server, and the retention policy of their results.
+'''
+from collections import OrderedDict
+from threading import Lock
+import itertools
+import os
+import time
+
+JOB_ID_PREFIX = "job_id_"
+
+
+def format_job_id(task_id: int):
+    '''
+    Returns the job id that is sent to the user for the given task id.
+    '''
+    return JOB_ID_PREFIX + str(task_id)
+
+
+def parse_job_id(job_id: str):
+    '''
+    Returns the task id from a job id of the form "job_id_<n>",
+    or None if the job id is not valid.
+    '''
+    if not job_id.startswith(JOB_ID_PREFIX):
+        return None
+
+    task_id = job_id[len(JOB_ID_PREFIX):]
+    if not task_id.isdigit():
+        return None
+
+    return int(task_id)
+
+
+class RetentionPolicy:
+    '''
+    Limits for the results kept by the server. A limit set to None is not enforced.
+    Attributes:
+        max_jobs: maximum number of done jobs kept
+        max_result_bytes: maximum total size of the kept results, in bytes
+        ttl: number of seconds a result is kept after the job is done
+    '''
+    def __init__(self, max_jobs: int = None, max_result_bytes: int = None, ttl: float = None):
+        self.max_jobs = max_jobs
+        self.max_result_bytes = max_result_bytes
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Creates the policy from the TP_MAX_JOBS, TP_MAX_RESULT_BYTES and
+        TP_JOB_TTL environment variables.
+        '''
+        max_jobs = os.environ.get('TP_MAX_JOBS')
+        max_result_bytes = os.environ.get('TP_MAX_RESULT_BYTES')
+        ttl = os.environ.get('TP_JOB_TTL')
+
+        return cls(int(max_jobs) if max_jobs else None,
+                   int(max_result_bytes) if max_result_bytes else None,
+                   float(ttl) if ttl else None)
+
+    def is_expired(self, done_time: float, now: float):
+        '''
+        Checks if a result that was done at done_time is expired.
+        '''
+        return self.ttl is not None and now - done_time > self.ttl
+
+    def is_exceeded(self, num_jobs: int, result_bytes: int):
+        '''
+        Checks if the kept results go over the count or size limits.
+        '''
+        if self.max_jobs is not None and num_jobs > self.max_jobs:
+            return True
+        return self.max_result_bytes is not None and result_bytes > self.max_result_bytes
+
+
+class JobRegistry:
+    '''
+    Thread-safe registry of the submitted tasks, indexed by their task id.
+    It keeps running counters of the pending and done jobs, so none of the
+    queries has to go through all the tasks.
+    Done jobs are evicted according to the retention policy: the expired ones
+    in the order they were done, then the least recently used ones while the
+    count or size limits are exceeded.
+    Attributes:
+        lock: protects the dictionaries, the id generator and the counters
+        jobs: task id -> Task
+        done_jobs: task id -> size of the result, ordered from the least recently used
+        done_order: the task ids of done_jobs, in the order they were done
+        next_id: the id that will be given to the next task
+        counters: number of pending, done and evicted jobs and the size of the kept results
+        retention: the RetentionPolicy of the done jobs
+        on_evict: function called with the task id of every evicted job
+        done_listeners: functions called with every task that is done
+    '''
+    def __init__(self, retention: RetentionPolicy = None, on_evict=None):
+        self.lock = Lock()
+        self.jobs = {}
+        self.done_jobs = OrderedDict()
+        self.done_order = OrderedDict()
+        self.next_id = 1
+        self.counters = {'pending': 0, 'done': 0, 'evicted': 0, 'result_bytes': 0}
+        self.retention = retention if retention is not None else RetentionPolicy()
+        self.on_evict = on_evict
+        self.done_listeners = []
+
+    def add_done_listener(self, listener):
+        '''
+        Registers a function that is called, on the worker thread, with every task
+        that is done. It must be quick, since it delays the worker.
+        '''
+        # the list is replaced instead of modified, so mark_done can go through
+        # the old list without holding the lock
+        with self.lock:
+            self.done_listeners = self.done_listeners + [listener]
+
+    def remove_done_listener(self, listener):
+        '''
+        Unregisters a function added with add_done_listener.
+        '''
+        with self.lock:
+            self.done_listeners = [other for other in self.done_listeners
+                                   if other is not listener]
+
+    def register(self, make_task):
+        '''
+        Creates a new task and registers it, along with the items of a batch.
+        make_task is called with a function that generates new unique task ids.
+        The ids are given and the tasks registered under the same lock, so an id
+        is never seen as given (see is_expired) before its task is registered.
+        '''
+        with self.lock:
+            new_ids = itertools.count(self.next_id)
+            task = make_task(lambda: next(new_ids))
+            for new_task in getattr(task, 'items', []) + [task]:
+                self.jobs[new_task.task_id] = new_task
+                self.counters['pending'] += 1
+            self.next_id = next(new_ids)
+        return task
+
+    def reserve_ids(self, task_id: int):
+        '''
+        Makes sure the ids up to task_id are not generated again,
+        ex. after restoring the jobs of a previous run.
+        '''
+        with self.lock:
+            self.next_id = max(self.next_id, task_id + 1)
+
+    def add(self, task):
+        '''
+        Registers a task that is not done yet, with the id it was already given,
+        ex. a job restored after a restart.
+        '''
+        with self.lock:
+            self.jobs[task.task_id] = task
+            self.counters['pending'] += 1
+
+    def tasks(self):
+        '''
+        Returns the registered tasks.
+        '''
+        with self.lock:
+            return list(self.jobs.values())
+
+    def get(self, task_id: int):
+        '''
+        Returns the task with the given id or None if there is no such task.
+        Getting a done task marks it as recently used, or evicts it if it expired.
+        '''
+        task = self.jobs.get(task_id)
+        if task is None or not task.done:
+            return task
+
+        evicted = []
+        with self.lock:
+            if task_id in self.done_jobs:
+                if self.retention.is_expired(task.timestamps['done'], time.perf_counter()):
+                    evicted.append(self.evict(task_id))
+                    task = None
+                else:
+                    self.done_jobs.move_to_end(task_id)
+
+        self.notify_evicted(evicted)
+        return task
+
+    def is_expired(self, task_id: int):
+        '''
+        Checks if the task id was given to a job that has since been evicted.
+        '''
+        return 1 <= task_id < self.next_id and task_id not in self.jobs
+
+    def mark_done(self, task, result, result_size: int):
+        '''
+        Stores the result of the task, marks it as done and evicts
+        the jobs that go over the retention limits.
+        '''
+        with self.lock:
+            task.result = result
+            task.timestamps['done'] = time.perf_counter()
+            task.completed.set()
+            self.counters['pending'] -= 1
+            self.counters['done'] += 1
+            self.counters['result_bytes'] += result_size
+            self.done_jobs[task.task_id] = result_size
+            self.done_order[task.task_id] = None
+
+            evicted = self.evict_over_limits(task.timestamps['done'])
+
+        self.notify_evicted(evicted)
+
+        for listener in self.done_listeners:
+            listener(task)
+
+    def evict_expired(self):
+        '''
+        Evicts the jobs that expired while no other job was done,
+        so idle servers also release their results.
+        '''
+        with self.lock:
+            evicted = self.evict_over_limits(time.perf_counter())
+
+        self.notify_evicted(evicted)
+
+    def evict_over_limits(self, now: float):
+        '''
+        Evicts the expired jobs, then the least recently used jobs while the
+        limits are exceeded. Must be called with the lock held.
+        '''
+        evicted = []
+
+        # a job polled recently is still expired, so the expiry follows the done order
+        while self.done_order:
+            task_id = next(iter(self.done_order))
+            if not self.retention.is_expired(self.jobs[task_id].timestamps['done'], now):
+                break
+            evicted.append(self.evict(task_id))
+
+        while self.done_jobs and self.retention.is_exceeded(len(self.done_jobs),
+                                                            self.counters['result_bytes']):
+            evicted.append(self.evict(next(iter(self.done_jobs))))
+
+        return evicted
+
+    def evict(self, task_id: int):
+        '''
+        Removes a done job from the registry. Must be called with the lock held.
+        '''
+        self.counters['result_bytes'] -= self.done_jobs.pop(task_id)
+        del self.done_order[task_id]
+        self.counters['evicted'] += 1
+        del self.jobs[task_id]
+        return task_id
+
+    def notify_evicted(self, evicted: list):
+        '''
+        Lets the owner of the registry clean up after the evicted jobs.
+        '''
+        if self.on_evict is not None:
+            for task_id in evicted:
+                self.on_evict(task_id)
+
+    def pending(self):
+        '''
+        Returns the number of jobs that are not done yet.
+        '''
+        return self.counters['pending']
+
+    def stats(self):
+        '''
+        Returns the counters of the registry and the number of kept jobs.
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+            stats['kept_jobs'] = len(self.jobs)
+            stats['kept_results'] = len(self.done_jobs)
+        return stats
+
+    def page(self, start: int, limit: int):
+        '''
+        Returns a list with the status of at most limit jobs,
+        starting with the task id start.
+        '''
+        statuses = []
+
+        with self.lock:
+            end = min(start + limit, self.next_id)
+            for task_id in range(max(start, 1), end):
+                task = self.jobs.get(task_id)
+                if task is not None:
+                    statuses.append((format_job_id(task_id), "done" if task.done else "running"))
+
+        return statuses
+
+    def last_id(self):
+        '''
+        Returns the id of the last generated task.
+        '''
+        return self.next_id - 1
@@ -0,0 +1,209 @@
+'''
+This module contains the JobJournal class, a write-ahead journal of the submitted
+and done jobs, used to restore them when the server restarts.
+'''
+from queue import Queue, Empty
+from threading import Thread
+import json
+import os
+import time
+from .encoding import response_data
+
+
+class JobJournal(Thread):
+    '''
+    Thread that appends the journal records to a file, one JSON object per line.
+    The records are group committed: the thread collects them for at most interval
+    seconds or batch_size records, then writes them and calls fsync once, so the
+    requests never wait for the disk. A crash loses at most one interval of records.
+    When the file grows over max_bytes, it is compacted to the records of the jobs
+    that are still kept, which live_state returns as (tasks, next id).
+    Attributes:
+        path: path of the journal file
+        interval: maximum number of seconds a record waits to be committed
+        batch_size: maximum number of records committed together
+        max_bytes: size of the file after which it is compacted
+        live_state: function that returns the tasks to keep and the next task id
+        records: queue of the records that are not committed yet
+        compact_bytes: size of the file at which the next compaction happens
+    '''
+    def __init__(self, path: str, interval: float, batch_size: int, max_bytes: int,
+                 live_state=None):
+        Thread.__init__(self, daemon=True)
+
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.live_state = live_state
+        self.records = Queue()
+        self.compact_bytes = max_bytes
+
+    @staticmethod
+    def submit_record(task):
+        '''
+        Returns the record of a submitted task. A batch records the ids of its items.
+        '''
+        record = {'op': 'submit', 'id': task.task_id, 'route': task.route,
+                  'question': task.question, 'state': task.state_name}
+        if task.years is not None:
+            record['years'] = task.years
+        if task.query is not None:
+            record['query'] = task.query
+        if task.percentile is not None:
+            record['percentile'] = task.percentile
+        if task.route == 'batch':
+            record['items'] = [item.task_id for item in task.items]
+        return json.dumps(record)
+
+    @staticmethod
+    def done_record(task_id: int, data: str):
+        '''
+        Returns the record of the JSON result of a done task.
+        '''
+        return f'{{"op": "done", "id": {task_id}, "result": {data}}}'
+
+    @staticmethod
+    def error_record(task_id: int, reason: str):
+        '''
+        Returns the record of a task that failed.
+        '''
+        return json.dumps({'op': 'error', 'id': task_id, 'reason': reason})
+
+    def record_submit(self, task):
+        '''
+        Records a submitted task.
+        '''
+        self.records.put(self.submit_record(task))
+
+    def record_done(self, task_id: int, data: str):
+        '''
+        Records the JSON result of a done task.
+        '''
+        self.records.put(self.done_record(task_id, data))
+
+    def record_error(self, task_id: int, reason: str):
+        '''
+        Records a task that failed, so it isn't run again after a restart.
+        '''
+        self.records.put(self.error_record(task_id, reason))
+
+    def replay(self):
+        '''
+        Reads the journal and returns the submit records, in the order of the ids,
+        the done records as a task id -> result dictionary, the failed tasks as a
+        task id -> reason dictionary, and the first task id that was never given,
+        so the ids of the evicted jobs aren't given again.
+        A line cut by a crash is ignored.
+        '''
+        submits = {}
+        results = {}
+        errors = {}
+        next_id = 1
+
+        if not os.path.exists(self.path):
+            return [], results, errors, next_id
+
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['op'] == 'submit':
+                    submits[record['id']] = record
+                    next_id = max(next_id, record['id'] + 1)
+                elif record['op'] == 'next_id':
+                    next_id = max(next_id, record['id'])
+                elif record['op'] == 'error':
+                    errors[record['id']] = record['reason']
+                else:
+                    results[record['id']] = record['result']
+
+        return [submits[task_id] for task_id in sorted(submits)], results, errors, next_id
+
+    def compact(self, tasks: list, next_id: int):
+        '''
+        Rewrites the journal with only the records of the given tasks, in the order
+        of their ids, so it doesn't keep the jobs that were evicted. The next task id
+        is recorded first, since the ids of the evicted jobs are not in the journal anymore.
+        The tasks with a result get their done or error record, so the records committed before
+        the compaction aren't lost, and the ones still queued are committed after it.
+        Called before the thread starts, or by the thread itself.
+        '''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps({'op': 'next_id', 'id': next_id}) + '\n')
+            for task in tasks:
+                file.write(self.submit_record(task) + '\n')
+                if task.error is not None:
+                    file.write(self.error_record(task.task_id, task.error) + '\n')
+                elif task.response is not None:
+                    file.write(self.done_record(task.task_id, response_data(task.response))
+                               + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+
+        os.replace(tmp_path, self.path)
+        # if most of the jobs are kept, the file isn't compacted again right away
+        self.compact_bytes = max(self.max_bytes, 2 * size)
+
+    def stop(self):
+        '''
+        Commits the queued records and stops the thread.
+        '''
+        self.records.put(None)
+        self.join()
+
+    def run(self):
+        '''
+        Loop that group commits the records, and compacts the file when it gets too big.
+        '''
+        file = open(self.path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        try:
+            while True:
+                record = self.records.get()
+                batch = []
+                deadline = time.monotonic() + self.interval
+
+                while record is not None:
+                    batch.append(record)
+                    if len(batch) == self.batch_size:
+                        break
+                    try:
+                        record = self.records.get(timeout=max(deadline - time.monotonic(), 0))
+                    except Empty:
+                        break
+
+                if batch:
+                    file.write('\n'.join(batch) + '\n')
+                    file.flush()
+                    os.fsync(file.fileno())
+                if record is None:
+                    break
+
+                if self.live_state is not None and file.tell() >= self.compact_bytes:
+                    file.close()
+                    self.compact(*self.live_state())
+                    # pylint: disable-next=consider-using-with
+                    file = open(self.path, 'a', encoding='utf-8')
+        finally:
+            file.close()
+
+
+def journal_from_env(live_state=None):
+    '''
+    Creates the journal if the TP_JOURNAL environment variable gives its path.
+    The records are committed every TP_JOURNAL_INTERVAL milliseconds (50 by default)
+    or every TP_JOURNAL_BATCH records (1024 by default), and the file is compacted
+    when it grows over TP_JOURNAL_MAX_BYTES (64 MiB by default).
+    '''
+    if not os.environ.get('TP_JOURNAL'):
+        return None
+
+    return JobJournal(os.environ['TP_JOURNAL'],
+                      int(os.environ.get('TP_JOURNAL_INTERVAL', 50)) / 1000,
+                      int(os.environ.get('TP_JOURNAL_BATCH', 1024)),
+                      int(os.environ.get('TP_JOURNAL_MAX_BYTES', 64 << 20)),
+                      live_state)
@@ -0,0 +1,213 @@
+'''
+This module contains the Metrics class that aggregates the timestamps of the tasks
+into per-route latency histograms and renders them in the Prometheus text format.
+'''
+from bisect import bisect_left
+from threading import Lock, local
+import time
+
+# upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# the stages of a task: name -> (start timestamp, end timestamp)
+STAGES = {
+    'queue_wait': ('enqueue', 'dequeue'),
+    'compute': ('compute_start', 'compute_end'),
+    'persist': ('compute_end', 'persisted'),
+    'total': ('enqueue', 'persisted'),
+}
+
+# the quantiles estimated from the histograms
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    '''
+    Class that counts the observed values in the LATENCY_BUCKETS buckets.
+    The last bucket counts the values over the largest bound.
+    '''
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        '''
+        Counts the value in its bucket.
+        '''
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        '''
+        Adds the counts of the other histogram to this one.
+        '''
+        for bucket, bucket_count in enumerate(other.buckets):
+            self.buckets[bucket] += bucket_count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, quantile: float):
+        '''
+        Estimates the quantile by interpolating inside the bucket it falls in,
+        the same way Prometheus' histogram_quantile does.
+        '''
+        if self.count == 0:
+            return float('nan')
+
+        rank = quantile * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            if seen + bucket_count >= rank and bucket_count > 0:
+                if bucket == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]
+                lower = LATENCY_BUCKETS[bucket - 1] if bucket > 0 else 0.0
+                upper = LATENCY_BUCKETS[bucket]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+
+        return LATENCY_BUCKETS[-1]
+
+
+class Metrics:
+    '''
+    Class that collects the metrics of the workers.
+    Every thread writes to its own shard, so recording a task never takes a lock,
+    and the shards are merged only when the metrics are rendered. The lock only
+    protects the list of shards, when a thread records its first task.
+    Attributes:
+        lock: protects the list of shards
+        shards: the shards of all the threads that recorded a task
+        local: the shard of the current thread
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.shards = []
+        self.local = local()
+
+    def shard(self):
+        '''
+        Returns the shard of the current thread, creating it on the first call.
+        A shard has the histograms of every (route, stage), the seconds the thread
+        spent running tasks and the start of the task it runs, if any.
+        '''
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = {'histograms': {}, 'busy_seconds': 0.0, 'busy_since': None}
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def task_started(self):
+        '''
+        Marks the current worker as busy.
+        '''
+        self.shard()['busy_since'] = time.perf_counter()
+
+    def task_finished(self):
+        '''
+        Marks the current worker as idle and counts the time it was busy.
+        '''
+        shard = self.shard()
+        shard['busy_seconds'] += time.perf_counter() - shard['busy_since']
+        shard['busy_since'] = None
+
+    def record(self, task):
+        '''
+        Observes the duration of every stage of the task that has both timestamps.
+        '''
+        histograms = self.shard()['histograms']
+        for stage, (start, end) in STAGES.items():
+            if start in task.timestamps and end in task.timestamps:
+                histogram = histograms.get((task.route, stage))
+                if histogram is None:
+                    histogram = histograms[(task.route, stage)] = Histogram()
+                histogram.observe(task.timestamps[end] - task.timestamps[start])
+
+    def merged(self):
+        '''
+        Returns the histograms of all the shards merged by (route, stage),
+        the total busy seconds and the number of busy workers.
+        '''
+        with self.lock:
+            shards = list(self.shards)
+
+        histograms = {}
+        busy_seconds = 0.0
+        busy_workers = 0
+        now = time.perf_counter()
+        for shard in shards:
+            for key, histogram in list(shard['histograms'].items()):
+                histograms.setdefault(key, Histogram()).merge(histogram)
+            busy_seconds += shard['busy_seconds']
+            busy_since = shard['busy_since']
+            if busy_since is not None:
+                busy_workers += 1
+                busy_seconds += now - busy_since
+
+        return histograms, busy_seconds, busy_workers
+
+    def render(self, gauges: dict, cache_stats: dict, num_workers: int):
+        '''
+        Renders the metrics in the Prometheus text format, along with the
+        given gauges (name -> value) and the counters of the result cache.
+        '''
+        histograms, busy_seconds, busy_workers = self.merged()
+        lines = histogram_lines(histograms)
+
+        lines.append('# HELP tp_worker_busy_seconds_total Seconds the workers spent running tasks.')
+        lines.append('# TYPE tp_worker_busy_seconds_total counter')
+        lines.append(f'tp_worker_busy_seconds_total {busy_seconds}')
+        lines.append('# HELP tp_workers Number of workers.')
+        lines.append('# TYPE tp_workers gauge')
+        lines.append(f'tp_workers {num_workers}')
+        lines.append('# HELP tp_workers_busy Number of workers running a task.')
+        lines.append('# TYPE tp_workers_busy gauge')
+        lines.append(f'tp_workers_busy {busy_workers}')
+
+        for name, value in gauges.items():
+            lines.append(f'# TYPE tp_{name} gauge')
+            lines.append(f'tp_{name} {value}')
+
+        for name, value in cache_stats.items():
+            if name in ('hits', 'misses', 'coalesced', 'evictions'):
+                lines.append(f'# TYPE tp_cache_{name}_total counter')
+                lines.append(f'tp_cache_{name}_total {value}')
+        # the coalesced requests are counted as hits once the result is computed
+        lookups = cache_stats.get('hits', 0) + cache_stats.get('misses', 0)
+        if lookups:
+            lines.append('# TYPE tp_cache_hit_ratio gauge')
+            lines.append(f'tp_cache_hit_ratio {cache_stats["hits"] / lookups}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_lines(histograms: dict):
+    '''
+    Returns the lines of the (route, stage) -> Histogram histograms, along with
+    the quantiles estimated from them.
+    '''
+    lines = ['# HELP tp_task_stage_seconds Duration of the stages of the tasks.']
+    lines.append('# TYPE tp_task_stage_seconds histogram')
+    for (route, stage), histogram in sorted(histograms.items()):
+        labels = f'route="{route}",stage="{stage}"'
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, histogram.buckets):
+            cumulative += bucket_count
+            lines.append(f'tp_task_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'tp_task_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f'tp_task_stage_seconds_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'tp_task_stage_seconds_count{{{labels}}} {histogram.count}')
+
+    lines.append('# HELP tp_task_stage_seconds_quantile Quantiles estimated from the '
+                 'histograms.')
+    lines.append('# TYPE tp_task_stage_seconds_quantile gauge')
+    for (route, stage), histogram in sorted(histograms.items()):
+        for quantile in QUANTILES:
+            lines.append(f'tp_task_stage_seconds_quantile{{route="{route}",stage="{stage}",'
+                         f'quantile="{quantile}"}} {histogram.quantile(quantile)}')
+
+    return lines
@@ -0,0 +1,192 @@
+'''
+This module contains the QueryIndex class, which answers the generic queries
+with per-value row ids of the dataset.
+'''
+import numpy as np
+import pandas as pd
+from .aggregate_index import key_to_str
+
+# the columns the generic queries can filter and group by: name -> column
+QUERY_COLUMNS = {
+    'question': 'Question',
+    'state': 'LocationDesc',
+    'stratification_category': 'StratificationCategory1',
+    'stratification': 'Stratification1',
+    'year': 'YearStart',
+}
+
+# the aggregates of Data_Value the generic queries can compute
+AGGREGATES = ('mean', 'count', 'min', 'max', 'sum')
+
+
+def column_codes(column: pd.Series):
+    '''
+    Returns the sorted distinct values of the column and the position of the value
+    of every row among them, -1 for the missing values.
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # the categories aren't necessarily sorted, so the codes are renumbered
+        categories = list(column.cat.categories)
+        order = np.argsort(np.array(categories, dtype=object))
+        ranks = np.empty(len(categories) + 1, dtype=np.int32)
+        ranks[order] = np.arange(len(categories), dtype=np.int32)
+        ranks[-1] = -1
+        return [categories[position] for position in order], ranks[column.cat.codes.to_numpy()]
+
+    values, codes = np.unique(column.to_numpy(), return_inverse=True)
+    return values.tolist(), codes.astype(np.int32)
+
+
+def reduce_groups(groups: np.ndarray, values: np.ndarray, size: int, aggregate: str):
+    '''
+    Returns the aggregate of the non-missing values of every one of the size groups,
+    where groups is the group of every value.
+    '''
+    valid = ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+
+    counts = np.bincount(groups, minlength=size)
+    if aggregate == 'count':
+        return counts
+
+    if aggregate in ('sum', 'mean'):
+        sums = np.bincount(groups, weights=values, minlength=size)
+        if aggregate == 'sum':
+            return sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    # the values are sorted by group, then every run of a group is reduced at once
+    result = np.full(size, np.nan)
+    if len(values):
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        reduce = np.minimum if aggregate == 'min' else np.maximum
+        result[sorted_groups[starts]] = reduce.reduceat(values[order], starts)
+    return result
+
+
+class QueryIndex:
+    '''
+    Class that answers the generic queries: filters on any of QUERY_COLUMNS,
+    a group-by on some of them and an aggregate of Data_Value.
+    The values of every column are numbered in sorted order and the ids of the rows
+    of every value are kept sorted, so a filter takes the row ids of the column that
+    selects the fewest rows and checks only the codes of those rows for the others.
+    The groups and aggregates are then computed with NumPy on the selected rows.
+    Attributes:
+        values: column -> the sorted distinct values of the column
+        positions: column -> {value: its position in values}
+        codes: column -> the position of the value of every row, -1 when it is missing
+        rows: column -> the sorted ids of the rows of every value
+        data_values: the Data_Value of every row
+    '''
+    def __init__(self, panda_data: pd.DataFrame):
+        self.values = {}
+        self.positions = {}
+        self.codes = {}
+        self.rows = {}
+
+        for name, column in QUERY_COLUMNS.items():
+            values, codes = column_codes(panda_data[column])
+            # a stable sort keeps the row ids of every value in ascending order
+            order = np.argsort(codes, kind='stable').astype(np.int32)
+            bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+
+            self.values[name] = values
+            self.positions[name] = {value: position for position, value in enumerate(values)}
+            self.codes[name] = codes
+            self.rows[name] = [order[bounds[position]:bounds[position + 1]]
+                               for position in range(len(values))]
+
+        self.data_values = panda_data['Data_Value'].to_numpy()
+
+    def allowed_values(self, filters: dict, years: list):
+        '''
+        Returns column -> a mask of the values that pass the filters of the column.
+        The masks have an extra False at the end, where the code -1 of the missing
+        values points to.
+        '''
+        allowed = {}
+        for name, values in filters.items():
+            mask = np.zeros(len(self.values[name]) + 1, dtype=bool)
+            mask[[self.positions[name][value] for value in values
+                  if value in self.positions[name]]] = True
+            allowed[name] = mask
+
+        if years is not None:
+            start, end = years
+            year_values = self.values['year']
+            first = 0 if start is None else np.searchsorted(year_values, start, 'left')
+            last = len(year_values) if end is None else np.searchsorted(year_values, end, 'right')
+            mask = np.zeros(len(year_values) + 1, dtype=bool)
+            mask[first:max(first, last)] = True
+            allowed['year'] = allowed['year'] & mask if 'year' in allowed else mask
+
+        return allowed
+
+    def select(self, filters: dict, years: list):
+        '''
+        Returns the sorted ids of the rows that pass the filters, or None for all the rows.
+        '''
+        allowed = self.allowed_values(filters, years)
+        if not allowed:
+            return None
+
+        row_lists = {name: [self.rows[name][position]
+                            for position in np.flatnonzero(mask[:-1])]
+                     for name, mask in allowed.items()}
+        first = min(row_lists, key=lambda name: sum(len(rows) for rows in row_lists[name]))
+
+        if not row_lists[first]:
+            return np.empty(0, dtype=np.int32)
+        rows = row_lists[first][0] if len(row_lists[first]) == 1 else \
+            np.sort(np.concatenate(row_lists[first]))
+
+        for name, mask in allowed.items():
+            if name != first:
+                rows = rows[mask[self.codes[name][rows]]]
+        return rows
+
+    def run(self, query: dict):
+        '''
+        Returns the result of the query, a dictionary with:
+            filters: column -> the list of values it can have
+            years: [start, end] range of YearStart, a None end isn't bounded, or None
+            group_by: the list of columns the rows are grouped by
+            aggregate: one of AGGREGATES
+        Without a group-by the result is {aggregate: value}, otherwise it is
+        {group: value} in the order of the groups, where a group of one column is
+        its value and a group of more columns is a tuple string, like in mean_by_category.
+        '''
+        rows = self.select(query['filters'], query['years'])
+        values = self.data_values if rows is None else self.data_values[rows]
+        aggregate = query['aggregate']
+
+        if not query['group_by']:
+            groups = np.zeros(len(values), dtype=np.intp)
+            return {aggregate: reduce_groups(groups, values, 1, aggregate).tolist()[0]}
+
+        # the group of a row is numbered from the codes of its values, so sorting
+        # the numbers sorts the groups by their values
+        groups = np.zeros(len(values), dtype=np.int64)
+        present = np.ones(len(values), dtype=bool)
+        for name in query['group_by']:
+            codes = self.codes[name] if rows is None else self.codes[name][rows]
+            present &= codes >= 0
+            groups = groups * len(self.values[name]) + codes
+
+        group_ids, groups = np.unique(groups[present], return_inverse=True)
+        results = reduce_groups(groups, values[present], len(group_ids), aggregate).tolist()
+
+        keys = []
+        for name in reversed(query['group_by']):
+            size = len(self.values[name])
+            keys.append([str(self.values[name][code]) for code in (group_ids % size).tolist()])
+            group_ids = group_ids // size
+        keys.reverse()
+
+        if len(keys) == 1:
+            return dict(zip(keys[0], results))
+        return {key_to_str(key): result for key, result in zip(zip(*keys), results)}
@@ -0,0 +1,94 @@
+'''
+This module sets up the logging of the webserver. The records are formatted as JSON
+and written to a rotating file by a background thread, so the request threads
+only put them in a queue.
+'''
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+import atexit
+import json
+import logging
+import os
+import time
+import zlib
+
+# the fields that can be given to a record with the extra argument
+LOG_FIELDS = ('job_id', 'route', 'question', 'state', 'years', 'query', 'percentile',
+              'items', 'queue_wait', 'compute_time')
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Class that formats a record as a JSON object with the UTC time, the level,
+    the message and the fields from LOG_FIELDS that were given to the record.
+    '''
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Filter that keeps only a rate (between 0 and 1) of the INFO records.
+    The records of a job are all kept or all dropped, depending on its id,
+    and the warnings and errors are always kept.
+    '''
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.kept = 0.0
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or self.rate >= 1:
+            return True
+
+        job_id = getattr(record, 'job_id', None)
+        if job_id is not None:
+            return zlib.crc32(job_id.encode()) < self.rate * 2 ** 32
+
+        # the records without a job id are kept once every 1 / rate records
+        self.kept += self.rate
+        if self.kept >= 1:
+            self.kept -= 1
+            return True
+        return False
+
+
+def setup_logging(logger: logging.Logger):
+    '''
+    Function that sends the records of the logger to a background thread, which
+    writes them as JSON to the TP_LOG_FILE file ("webserver.log" by default).
+    The file is rotated once it has TP_LOG_MAX_BYTES bytes (10 MiB by default),
+    keeping TP_LOG_BACKUPS old files (5 by default).
+    Only a TP_LOG_SAMPLE rate of the INFO records is kept (1 by default).
+    Returns the listener that writes the records, which is stopped at exit
+    after it writes all the queued records.
+    '''
+    file_handler = RotatingFileHandler(
+        os.environ.get('TP_LOG_FILE', "webserver.log"),
+        maxBytes=int(os.environ.get('TP_LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        backupCount=int(os.environ.get('TP_LOG_BACKUPS', 5)))
+    file_handler.setFormatter(JsonFormatter())
+
+    records = SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(float(os.environ.get('TP_LOG_SAMPLE', 1))))
+
+    logger.setLevel(logging.INFO)
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(records, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
@@ -0,0 +1,107 @@
+'''
+This module contains the ResultCache class that memoizes the results
+of the tasks, so identical requests are computed only once.
+'''
+from collections import OrderedDict
+from threading import Lock, Event
+
+
+class ResultCache:
+    '''
+    Thread-safe LRU cache of task results. TaskRunner.compute_task keys them by
+    (revision, route, question, state, years, query, percentile), where revision is
+    the dataset version that last changed the question, so an append only misses
+    the results of the questions it changed.
+    Identical tasks that arrive while the result is being computed wait for
+    that computation instead of starting their own.
+    Attributes:
+        lock: protects the entries, the in-flight computations and the counters
+        entries: key -> result, ordered from the least recently used
+        in_flight: key -> Event set when the computation of the key finishes
+        max_entries: maximum number of results kept, 0 disables the cache
+        generation: incremented on invalidation, so stale computations aren't stored
+        counters: number of hits, misses, coalesced requests and evictions
+    '''
+    def __init__(self, max_entries: int):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.max_entries = max_entries
+        self.generation = 0
+        self.counters = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    def get_or_compute(self, key: tuple, compute):
+        '''
+        Returns the cached result for the key, or calls compute() to obtain it.
+        The returned result is shared, so it must not be modified.
+        '''
+        if self.max_entries <= 0:
+            return compute()
+
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.counters['hits'] += 1
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+
+                event = self.in_flight.get(key)
+                if event is None:
+                    # we are the first to ask for this key, so we compute it
+                    self.counters['misses'] += 1
+                    self.in_flight[key] = Event()
+                    generation = self.generation
+                    break
+                self.counters['coalesced'] += 1
+
+            # somebody else is computing the same key, we wait for its result
+            event.wait()
+
+        try:
+            result = compute()
+            self.store(key, result, generation)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key).set()
+
+        return result
+
+    def store(self, key: tuple, result, generation: int):
+        '''
+        Stores a result computed for the given generation of the cache and
+        evicts the least recently used entries over the limit.
+        '''
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.entries[key] = result
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self):
+        '''
+        Drops all the cached results, ex. when the dataset is reloaded.
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def discard(self, matches):
+        '''
+        Drops the cached results whose key matches, ex. the results of the questions
+        changed by appended rows.
+        '''
+        with self.lock:
+            for key in [key for key in self.entries if matches(key)]:
+                del self.entries[key]
+
+    def stats(self):
+        '''
+        Returns the counters of the cache and the number of cached results.
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        return stats
@@ -0,0 +1,301 @@
+'''
+This module contains the stores that persist the results of the jobs.
+The results are written by a background thread, in batches, so the workers
+never wait for the disk.
+'''
+from abc import ABC, abstractmethod
+from queue import Queue, Empty
+from threading import Thread, Lock
+import os
+
+RESULTS_DIR = 'results'
+
+# the log segments kept by default are bounded, so their files and the index of
+# their results don't grow with the number of jobs served
+DEFAULT_SEGMENT_BYTES = 16 << 20
+DEFAULT_MAX_SEGMENTS = 8
+
+
+class ResultStore(Thread, ABC):
+    '''
+    Base class of the stores: a thread that takes the write and remove operations
+    from a queue and applies them in batches of at most batch_size operations.
+    Attributes:
+        directory: directory where the results are persisted
+        batch_size: maximum number of operations applied together
+        operations: queue of (operation, task id, JSON data) tuples
+    '''
+    def __init__(self, directory: str, batch_size: int):
+        Thread.__init__(self, daemon=True)
+
+        self.directory = directory
+        self.batch_size = batch_size
+        self.operations = Queue()
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, task_id: int, data: str):
+        '''
+        Queues the JSON result of the task to be persisted.
+        '''
+        self.operations.put(('write', task_id, data))
+
+    def discard(self, task_id: int):
+        '''
+        Queues the removal of the result of an evicted task. Stores that can
+        serve evicted results keep them.
+        '''
+        self.operations.put(('remove', task_id, None))
+
+    def stop(self):
+        '''
+        Persists the queued results and stops the thread.
+        '''
+        self.operations.put(None)
+        self.join()
+
+    def run(self):
+        '''
+        Loop that waits for an operation, then takes all the queued operations
+        up to the batch size and applies them together.
+        '''
+        while True:
+            operation = self.operations.get()
+            batch = []
+
+            while operation is not None:
+                batch.append(operation)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    operation = self.operations.get_nowait()
+                except Empty:
+                    break
+
+            if batch:
+                self.apply(batch)
+            if operation is None:
+                break
+
+    @abstractmethod
+    def apply(self, batch: list):
+        '''
+        Applies a batch of operations.
+        '''
+
+    @abstractmethod
+    def read(self, task_id: int):
+        '''
+        Returns the persisted JSON result of the task, or None.
+        '''
+
+
+class FileResultStore(ResultStore):
+    '''
+    Store that writes every result in its own results/job_id_<n>.json file
+    and removes the files of the evicted jobs.
+    '''
+    def path(self, task_id: int):
+        '''
+        Returns the path of the file of the task.
+        '''
+        return os.path.join(self.directory, f"job_id_{task_id}.json")
+
+    def apply(self, batch: list):
+        for operation, task_id, data in batch:
+            if operation == 'write':
+                with open(self.path(task_id), 'w', encoding='utf-8') as file:
+                    file.write(data)
+            else:
+                try:
+                    os.remove(self.path(task_id))
+                except FileNotFoundError:
+                    pass
+
+    def read(self, task_id: int):
+        # the file of an evicted job is removed, so there is nothing to serve
+        return None
+
+
+class LogResultStore(ResultStore):
+    '''
+    Store that appends the results to segment files, one "<task id>\\t<json>" line
+    per result, and keeps an index of where every result is. A batch is written
+    with a single write call, and the evicted results can still be served from it.
+    When a segment reaches segment_bytes a new one is started, and the oldest
+    segments are removed when there are more than max_segments.
+    With keep, the segments of the previous run are kept and their index is rebuilt,
+    for when the job ids are restored by the journal; otherwise they are removed.
+    Attributes:
+        segment_bytes: size after which a new segment is started
+        max_segments: maximum number of segments kept, None for no limit
+        lock: protects the index and the list of segments
+        index: task id -> (segment number, offset, length) of the result
+        segments: segment number -> list of the task ids it contains, oldest first
+        segment_size: size of the current segment
+    '''
+    def __init__(self, directory: str, batch_size: int, segment_bytes: int,
+                 max_segments: int = None, keep: bool = False):
+        super().__init__(directory, batch_size)
+
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock = Lock()
+        self.index = {}
+        self.segments = {}
+        self.segment_size = 0
+
+        for name in sorted(os.listdir(directory)):
+            if not name.startswith('segment_'):
+                continue
+            if keep:
+                self.load_segment(int(name[len('segment_'):-len('.log')]))
+            else:
+                # without the journal the task ids start again from 1, so the old
+                # results would be served for the new jobs
+                os.remove(os.path.join(directory, name))
+
+        # the results are appended to a new segment, after the kept ones
+        self.start_segment(max(self.segments, default=-1) + 1)
+
+    def segment_path(self, segment: int):
+        '''
+        Returns the path of the segment file.
+        '''
+        return os.path.join(self.directory, f"segment_{segment:06d}.log")
+
+    def load_segment(self, segment: int):
+        '''
+        Adds the results of a segment written by a previous run to the index.
+        A line cut by a crash is ignored.
+        '''
+        with open(self.segment_path(segment), 'rb') as file:
+            content = file.read()
+
+        task_ids = []
+        offset = 0
+        while True:
+            end = content.find(b'\n', offset)
+            if end < 0:
+                break
+            task_id, _, _ = content[offset:end].partition(b'\t')
+            prefix = len(task_id) + 1
+            self.index[int(task_id)] = (segment, offset + prefix, end - offset - prefix)
+            task_ids.append(int(task_id))
+            offset = end + 1
+
+        self.segments[segment] = task_ids
+
+    def start_segment(self, segment: int):
+        '''
+        Starts a new segment and removes the oldest ones over the limit.
+        '''
+        with self.lock:
+            self.segments[segment] = []
+            self.segment_size = 0
+
+            while self.max_segments is not None and len(self.segments) > self.max_segments:
+                oldest = min(self.segments)
+                for task_id in self.segments.pop(oldest):
+                    self.index.pop(task_id, None)
+                os.remove(self.segment_path(oldest))
+
+        open(self.segment_path(segment), 'ab').close()
+
+    def apply(self, batch: list):
+        segment = max(self.segments)
+        chunks = []
+        entries = []
+        offset = self.segment_size
+
+        for operation, task_id, data in batch:
+            if operation != 'write':
+                continue
+            record = f"{task_id}\t{data}\n".encode('utf-8')
+            prefix = len(str(task_id)) + 1
+            entries.append((task_id, (segment, offset + prefix, len(record) - prefix - 1)))
+            chunks.append(record)
+            offset += len(record)
+
+        if not chunks:
+            return
+
+        with open(self.segment_path(segment), 'ab') as file:
+            file.write(b''.join(chunks))
+
+        with self.lock:
+            self.index.update(entries)
+            self.segments[segment].extend(task_id for task_id, _ in entries)
+            self.segment_size = offset
+
+        if self.segment_size >= self.segment_bytes:
+            self.start_segment(segment + 1)
+
+    def read(self, task_id: int):
+        with self.lock:
+            location = self.index.get(task_id)
+        if location is None:
+            return None
+
+        segment, offset, length = location
+        try:
+            with open(self.segment_path(segment), 'rb') as file:
+                file.seek(offset)
+                return file.read(length).decode('utf-8')
+        except FileNotFoundError:
+            # the segment was removed after we looked up the index
+            return None
+
+
+class NullResultStore:
+    '''
+    Store used when the results are not persisted.
+    '''
+    def put(self, task_id: int, data: str):
+        '''
+        The results are not persisted.
+        '''
+
+    def discard(self, task_id: int):
+        '''
+        There is nothing to remove.
+        '''
+
+    def read(self, task_id: int):
+        '''
+        There is nothing to serve, so the result is always None.
+        '''
+
+    def start(self):
+        '''
+        There is no thread to start.
+        '''
+
+    def stop(self):
+        '''
+        There is no thread to stop.
+        '''
+
+
+def store_from_env():
+    '''
+    Creates the store selected by the TP_RESULTS_STORE environment variable:
+    "files" (the default), "log" or "none". The writes are batched by at most
+    TP_WRITE_BATCH operations; the log segments have TP_SEGMENT_BYTES bytes (16 MiB
+    by default) and at most TP_MAX_SEGMENTS of them are kept (8 by default, 0 for
+    no limit). When TP_JOURNAL restores the jobs, the segments are kept across
+    restarts so the evicted results can still be served.
+    '''
+    kind = os.environ.get('TP_RESULTS_STORE', 'files')
+    batch_size = int(os.environ.get('TP_WRITE_BATCH', 256))
+
+    if kind == 'none':
+        return NullResultStore()
+
+    if kind == 'log':
+        max_segments = int(os.environ.get('TP_MAX_SEGMENTS', DEFAULT_MAX_SEGMENTS))
+        return LogResultStore(RESULTS_DIR, batch_size,
+                              int(os.environ.get('TP_SEGMENT_BYTES', DEFAULT_SEGMENT_BYTES)),
+                              max_segments or None,
+                              bool(os.environ.get('TP_JOURNAL')))
+
+    return FileResultStore(RESULTS_DIR, batch_size)
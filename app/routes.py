@@ -1,33 +1,241 @@
 '''
 This module contains the endpoints that will be used by the webserver
 '''
-from flask import request, jsonify
+from flask import request, jsonify, Response
 from app import webserver
 
-from .data_ingestor import Task
+from .data_ingestor import Task, BatchTask, read_csv_rows, read_rows
+from .query_index import QUERY_COLUMNS, AGGREGATES
+from .task_runner import ROUTES
+from .job_registry import format_job_id, parse_job_id
+from .admission import Overloaded
+from .encoding import done_response, with_fields
 
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+from queue import Queue, Empty
 import time
 
-def formatting_utc():
+from .request_log import setup_logging
+
+# the records are written as JSON by a background thread (see request_log)
+logger = logging.getLogger("webserver")
+log_listener = setup_logging(logger)
+
+logger.info(f"Loaded dataset: {webserver.tasks_runner.data_ingestor.load_stats}")
+
+
+def log_done(task):
     '''
-    Function that returns the current time in UTC format
+    Function that logs, for every task that is done, how long it waited in the
+    queue and how long it took to compute, in seconds.
+    It is called by the job registry on the worker thread that completed the task.
     '''
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    timestamps = task.timestamps
+    compute_time = None
+    if 'dequeue' in timestamps:
+        compute_time = timestamps['done'] - timestamps['dequeue']
+
+    logger.info("Job done", extra={
+        'job_id': format_job_id(task.task_id),
+        'route': task.route,
+        'queue_wait': task.queue_wait(),
+        'compute_time': compute_time,
+    })
 
-# implementing logger with INFO module
-logger = logging.getLogger("webserver")
-logger.setLevel(logging.INFO)
 
-# creating file handler
-handler = RotatingFileHandler("webserver.log", maxBytes=10000, backupCount=5)
-handler.setLevel(logging.INFO)
+webserver.tasks_runner.jobs.add_done_listener(log_done)
+
+# number of jobs put in every chunk of the /api/jobs streamed response
+JOBS_CHUNK_SIZE = 1000
+
+# maximum number of milliseconds a request can wait for the result of its job
+MAX_WAIT_MS = 5000
+
+# maximum number of seconds a stream of results is kept open
+MAX_STREAM_SECONDS = 60
+
+
+class InvalidRequest(Exception):
+    '''
+    Exception raised when the fields of a request have the wrong type.
+    '''
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def check_fields(route: str, question, state):
+    '''
+    Function that checks that the question and the state of a request are strings.
+    The query route has no question, and the state is optional.
+    Raises InvalidRequest otherwise.
+    '''
+    if route != 'query' and not isinstance(question, str):
+        raise InvalidRequest("Invalid question")
+    if state is not None and not isinstance(state, str):
+        raise InvalidRequest("Invalid state")
+
+
+def submit_task(route: str, question: str, state: str = None, years: tuple = None,
+                query: dict = None, percentile: float = None):
+    '''
+    Function that creates a task for the given route, registers it in the tasks
+    runner and returns it.
+    Raises InvalidRequest if the question or the state is not a string, and
+    Overloaded if the job goes over the limits of the admission control.
+    '''
+    check_fields(route, question, state)
+    webserver.tasks_runner.admission.admit(route)
+
+    new_task = webserver.tasks_runner.submit(
+        lambda new_id: Task(question, state, new_id(), route, years, query, percentile))
+
+    logger.info("Job submitted", extra={
+        'job_id': format_job_id(new_task.task_id),
+        'route': route,
+        'question': question,
+        'state': state,
+        'years': years,
+        'query': query,
+        'percentile': percentile,
+    })
+
+    return new_task
+
+
+def requested_years(data: dict):
+    '''
+    Function that returns the (start_year, end_year) range given in a request,
+    or None if it doesn't give one. A missing year leaves that side of the range open.
+    Raises ValueError if the years are not integers.
+    '''
+    start_year, end_year = data.get('start_year'), data.get('end_year')
+    if start_year is None and end_year is None:
+        return None
+
+    return tuple(None if year is None else int(year) for year in (start_year, end_year))
+
+
+def requested_percentile(data: dict):
+    '''
+    Function that returns the percentile given in a request, between 0 and 100,
+    or None if it doesn't give one (the median is computed then).
+    Raises ValueError if the percentile is not a number in that range.
+    '''
+    percentile = data.get('percentile')
+    if percentile is None:
+        return None
+
+    if isinstance(percentile, bool) or not isinstance(percentile, (int, float)) \
+            or not 0 <= percentile <= 100:
+        raise ValueError("Invalid percentile")
+    return percentile
+
+
+def requested_query(data: dict):
+    '''
+    Function that checks a generic query request and returns the query in the form
+    used by QueryIndex.run, with the values of every filter sorted.
+    The request has "filters" ({column: value or list of values}), "group_by"
+    (a list of columns), "aggregate" (the mean by default) and optionally
+    "start_year" and "end_year", where the columns are the keys of QUERY_COLUMNS.
+    Raises ValueError with the reason if the query is invalid.
+    '''
+    aggregate = data.get('aggregate', 'mean')
+    if aggregate not in AGGREGATES:
+        raise ValueError(f"Invalid aggregate: {aggregate}")
+
+    group_by = data.get('group_by') or []
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    for column in group_by:
+        if column not in QUERY_COLUMNS:
+            raise ValueError(f"Invalid group_by column: {column}")
+    if len(set(group_by)) != len(group_by):
+        raise ValueError("Duplicate group_by column")
+
+    filters = data.get('filters') or {}
+    if not isinstance(filters, dict):
+        raise ValueError("Invalid filters")
+
+    query_filters = {}
+    for column, values in filters.items():
+        if column not in QUERY_COLUMNS:
+            raise ValueError(f"Invalid filter column: {column}")
+        if not isinstance(values, list):
+            values = [values]
+        # the years are numbers and the other columns are strings
+        value_type = int if column == 'year' else str
+        if not all(isinstance(value, value_type) and not isinstance(value, bool)
+                   for value in values):
+            raise ValueError(f"Invalid filter values for {column}")
+        query_filters[column] = sorted(set(values))
+
+    try:
+        years = requested_years(data)
+    except (TypeError, ValueError) as error:
+        raise ValueError("Invalid year range") from error
+
+    return {
+        'filters': query_filters,
+        'years': list(years) if years is not None else None,
+        'group_by': group_by,
+        'aggregate': aggregate,
+    }
+
+
+def requested_wait():
+    '''
+    Function that returns how many milliseconds the user is willing to wait for the
+    result, given by the "wait" query parameter or the "X-Wait-Ms" header.
+    '''
+    wait_ms = request.args.get('wait', type=int)
+    if wait_ms is None:
+        wait_ms = request.headers.get('X-Wait-Ms', 0, type=int)
+
+    return min(max(wait_ms, 0), MAX_WAIT_MS)
+
 
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt=formatting_utc())
-handler.setFormatter(formatter)
+def job_response(task, response: dict = None):
+    '''
+    Function that builds the response for a submitted task, starting from the
+    given response fields.
+    If the user asked to wait for the result and the task is done in time,
+    the result is returned directly, along with the job id so it can still be polled.
+    '''
+    response = dict(response) if response is not None else {}
+    response["job_id"] = format_job_id(task.task_id)
 
-logger.addHandler(handler)
+    wait_ms = requested_wait()
+    if wait_ms > 0 and task.wait(wait_ms / 1000):
+        # the response of the task was encoded once, when it was done
+        return Response(with_fields(response, task.response), mimetype='application/json')
+
+    return jsonify(response)
+
+
+@webserver.errorhandler(InvalidRequest)
+def invalid_request(error):
+    '''
+    Function that rejects a request with fields of the wrong type.
+    '''
+    logger.info(f"Invalid request: {error.reason}")
+    return jsonify({"reason": error.reason, "status": "error"})
+
+
+@webserver.errorhandler(Overloaded)
+def overloaded(error):
+    '''
+    Function that rejects a job that goes over the limits of the admission control,
+    telling the user when to try again.
+    '''
+    logger.info(f"Rejected job: {error.reason}")
+
+    response = jsonify({"reason": error.reason, "status": "error"})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 
 # Example endpoint definition
@@ -62,29 +270,33 @@ def states_mean_request():
     # Get request data
     data = request.json
 
-    # writting to log file
-    logger.info(f"Received request for states mean with question: {data['question']}")
+    # Creating the task that will be executed and registering it in the tasks runner
+    new_task = submit_task('states_mean', data['question'])
 
-    # Creating the task that will be executed
-    new_task = Task(data['question'], None, webserver.job_counter, 'states_mean')
+    return job_response(new_task)
 
-    # Registering the task in the tasks runner
-    # Incrementing the job counter
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
 
-    # Sending back a JSON response
-    return_value = "job_id_" + str(new_task.task_id)
+@webserver.route('/api/state_mean', methods=['POST'])
+def state_mean_request():
+    '''
+    Function that handles the state_mean request
+    '''
+
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    logger.info(f"Job id for request: {return_value}")
+    data = request.json
 
-    return jsonify({"job_id": return_value})
+    new_task = submit_task('state_mean', data['question'], data['state'])
 
+    return job_response(new_task)
 
-@webserver.route('/api/state_mean', methods=['POST'])
-def state_mean_request():
+
+@webserver.route('/api/best5', methods=['POST'])
+def best5_request():
     '''
-    Function that handles the state_mean request
+    Function that handles the best5 request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -93,25 +305,32 @@ def state_mean_request():
 
     data = request.json
 
-    logger.info(f"Received request for state mean with question: {data['question']} \
-                and state: {data['state']}")
+    new_task = submit_task('best5', data['question'])
 
-    new_task = Task(data['question'], data['state'], webserver.job_counter, 'state_mean')
+    return job_response(new_task)
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
 
-    return_value = "job_id_" + str(new_task.task_id)
+@webserver.route('/api/worst5', methods=['POST'])
+def worst5_request():
+    '''
+    Function that handles the worst5 request
+    '''
 
-    logger.info(f"Job id for request: {return_value}")
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    return jsonify({"job_id": return_value})
+    data = request.json
 
+    new_task = submit_task('worst5', data['question'])
 
-@webserver.route('/api/best5', methods=['POST'])
-def best5_request():
+    return job_response(new_task)
+
+
+@webserver.route('/api/global_mean', methods=['POST'])
+def global_mean_request():
     '''
-    Function that handles the best5 request
+    Function that handles the global_mean request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -120,24 +339,32 @@ def best5_request():
 
     data = request.json
 
-    logger.info(f"Received request for states mean with question: {data['question']}")
+    new_task = submit_task('global_mean', data['question'])
 
-    new_task = Task(data['question'], None, webserver.job_counter, 'best5')
+    return job_response(new_task)
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
 
-    return_value = "job_id_" + str(new_task.task_id)
+@webserver.route('/api/diff_from_mean', methods=['POST'])
+def diff_from_mean_request():
+    '''
+    Function that handles the diff_from_mean request
+    '''
 
-    logger.info(f"Job id for request: {return_value}")
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    return jsonify({"job_id": return_value})
+    data = request.json
 
+    new_task = submit_task('diff_from_mean', data['question'])
 
-@webserver.route('/api/worst5', methods=['POST'])
-def worst5_request():
+    return job_response(new_task)
+
+
+@webserver.route('/api/state_diff_from_mean', methods=['POST'])
+def state_diff_from_mean_request():
     '''
-    Function that handles the worst5 request
+    Function that handles the state_diff_from_mean request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -146,24 +373,32 @@ def worst5_request():
 
     data = request.json
 
-    logger.info(f"Received request for states mean with question: {data['question']}")
+    new_task = submit_task('state_diff_from_mean', data['question'], data['state'])
 
-    new_task = Task(data['question'], None, webserver.job_counter, 'worst5')
+    return job_response(new_task)
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
 
-    return_value = "job_id_" + str(new_task.task_id)
+@webserver.route('/api/mean_by_category', methods=['POST'])
+def mean_by_category_request():
+    '''
+    Function that handles the mean_by_category request
+    '''
 
-    logger.info(f"Job id for request: {return_value}")
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    return jsonify({"job_id": return_value})
+    data = request.json
 
+    new_task = submit_task('mean_by_category', data['question'])
 
-@webserver.route('/api/global_mean', methods=['POST'])
-def global_mean_request():
+    return job_response(new_task)
+
+
+@webserver.route('/api/state_mean_by_category', methods=['POST'])
+def state_mean_by_category_request():
     '''
-    Function that handles the global_mean request
+    Function that handles the state_mean_by_category request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -172,24 +407,37 @@ def global_mean_request():
 
     data = request.json
 
-    logger.info(f"Received request for states mean with question: {data['question']}")
+    new_task = submit_task('state_mean_by_category', data['question'], data['state'])
+
+    return job_response(new_task)
+
+
+@webserver.route('/api/states_mean_range', methods=['POST'])
+def states_mean_range_request():
+    '''
+    Function that handles the states_mean_range request
+    '''
 
-    new_task = Task(data['question'], None, webserver.job_counter, 'global_mean')
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
+    data = request.json
 
-    return_value = "job_id_" + str(new_task.task_id)
+    try:
+        years = requested_years(data)
+    except (TypeError, ValueError):
+        return jsonify({"reason": "Invalid year range", "status": "error"})
 
-    logger.info(f"Job id for request: {return_value}")
+    new_task = submit_task('states_mean_range', data['question'], None, years)
 
-    return jsonify({"job_id": return_value})
+    return job_response(new_task)
 
 
-@webserver.route('/api/diff_from_mean', methods=['POST'])
-def diff_from_mean_request():
+@webserver.route('/api/state_mean_range', methods=['POST'])
+def state_mean_range_request():
     '''
-    Function that handles the diff_from_mean request
+    Function that handles the state_mean_range request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -198,24 +446,42 @@ def diff_from_mean_request():
 
     data = request.json
 
-    logger.info(f"Received request for states mean with question: {data['question']}")
+    try:
+        years = requested_years(data)
+    except (TypeError, ValueError):
+        return jsonify({"reason": "Invalid year range", "status": "error"})
+
+    new_task = submit_task('state_mean_range', data['question'], data['state'], years)
+
+    return job_response(new_task)
 
-    new_task = Task(data['question'], None, webserver.job_counter, 'diff_from_mean')
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
+@webserver.route('/api/global_mean_range', methods=['POST'])
+def global_mean_range_request():
+    '''
+    Function that handles the global_mean_range request
+    '''
 
-    return_value = "job_id_" + str(new_task.task_id)
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    logger.info(f"Job id for request: {return_value}")
+    data = request.json
 
-    return jsonify({"job_id": return_value})
+    try:
+        years = requested_years(data)
+    except (TypeError, ValueError):
+        return jsonify({"reason": "Invalid year range", "status": "error"})
 
+    new_task = submit_task('global_mean_range', data['question'], None, years)
 
-@webserver.route('/api/state_diff_from_mean', methods=['POST'])
-def state_diff_from_mean_request():
+    return job_response(new_task)
+
+
+@webserver.route('/api/state_trend', methods=['POST'])
+def state_trend_request():
     '''
-    Function that handles the state_diff_from_mean request
+    Function that handles the state_trend request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -224,26 +490,42 @@ def state_diff_from_mean_request():
 
     data = request.json
 
-    logger.info(f"Received request for state mean with question: {data['question']} \
-                and state: {data['state']}")
+    try:
+        years = requested_years(data)
+    except (TypeError, ValueError):
+        return jsonify({"reason": "Invalid year range", "status": "error"})
 
-    new_task = Task(data['question'], data['state'], webserver.job_counter,
-                    'state_diff_from_mean')
+    new_task = submit_task('state_trend', data['question'], data['state'], years)
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
+    return job_response(new_task)
 
-    return_value = "job_id_" + str(new_task.task_id)
 
-    logger.info(f"Job id for request: {return_value}")
+@webserver.route('/api/states_percentile', methods=['POST'])
+def states_percentile_request():
+    '''
+    Function that handles the states_percentile request
+    '''
 
-    return jsonify({"job_id": return_value})
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
+    data = request.json
 
-@webserver.route('/api/mean_by_category', methods=['POST'])
-def mean_by_category_request():
+    try:
+        percentile = requested_percentile(data)
+    except ValueError as error:
+        return jsonify({"reason": str(error), "status": "error"})
+
+    new_task = submit_task('states_percentile', data['question'], percentile=percentile)
+
+    return job_response(new_task)
+
+
+@webserver.route('/api/state_percentile', methods=['POST'])
+def state_percentile_request():
     '''
-    Function that handles the mean_by_category request
+    Function that handles the state_percentile request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -252,24 +534,61 @@ def mean_by_category_request():
 
     data = request.json
 
-    logger.info(f"Received request for states mean with question: {data['question']}")
+    try:
+        percentile = requested_percentile(data)
+    except ValueError as error:
+        return jsonify({"reason": str(error), "status": "error"})
 
-    new_task = Task(data['question'], None, webserver.job_counter, 'mean_by_category')
+    new_task = submit_task('state_percentile', data['question'], data['state'],
+                           percentile=percentile)
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
+    return job_response(new_task)
 
-    return_value = "job_id_" + str(new_task.task_id)
 
-    logger.info(f"Job id for request: {return_value}")
+@webserver.route('/api/state_percentile_by_category', methods=['POST'])
+def state_percentile_by_category_request():
+    '''
+    Function that handles the state_percentile_by_category request
+    '''
 
-    return jsonify({"job_id": return_value})
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
+    data = request.json
 
-@webserver.route('/api/state_mean_by_category', methods=['POST'])
-def state_mean_by_category_request():
+    try:
+        percentile = requested_percentile(data)
+    except ValueError as error:
+        return jsonify({"reason": str(error), "status": "error"})
+
+    new_task = submit_task('state_percentile_by_category', data['question'], data['state'],
+                           percentile=percentile)
+
+    return job_response(new_task)
+
+
+@webserver.route('/api/states_stddev', methods=['POST'])
+def states_stddev_request():
     '''
-    Function that handles the state_mean_by_category request
+    Function that handles the states_stddev request
+    '''
+
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
+
+    data = request.json
+
+    new_task = submit_task('states_stddev', data['question'])
+
+    return job_response(new_task)
+
+
+@webserver.route('/api/state_stddev', methods=['POST'])
+def state_stddev_request():
+    '''
+    Function that handles the state_stddev request
     '''
 
     # If the server is shutting down, we can't accept more requests
@@ -278,20 +597,106 @@ def state_mean_by_category_request():
 
     data = request.json
 
-    logger.info(f"Received request for state mean with question: {data['question']} \
-                and state: {data['state']}")
+    new_task = submit_task('state_stddev', data['question'], data['state'])
 
-    new_task = Task(data['question'], data['state'], webserver.job_counter,
-                    'state_mean_by_category')
+    return job_response(new_task)
 
-    webserver.tasks_runner.add_task(new_task)
-    webserver.job_counter += 1
 
-    return_value = "job_id_" + str(new_task.task_id)
+@webserver.route('/api/query', methods=['POST'])
+def query_request():
+    '''
+    Function that handles a generic query: filters on any of the columns, a group-by
+    and an aggregate of the values, see requested_query
+    '''
+
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
 
-    logger.info(f"Job id for request: {return_value}")
+    data = request.json
 
-    return jsonify({"job_id": return_value})
+    try:
+        query = requested_query(data)
+    except ValueError as error:
+        return jsonify({"reason": str(error), "status": "error"})
+
+    new_task = submit_task('query', None, query=query)
+
+    return job_response(new_task)
+
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    '''
+    Function that handles a batch of requests, given as a list of
+    {"route", "question", "state"} objects in the "requests" field, with the
+    "start_year" and "end_year" of the routes that take a year range, the
+    "percentile" of the percentile routes and the fields of requested_query
+    for the query route.
+    The batch is queued as a single job, but every request also gets its own job id
+    and is admitted as a job of its route. A batch has at most TP_MAX_BATCH requests.
+    '''
+
+    # If the server is shutting down, we can't accept more requests
+    if webserver.tasks_runner.graceful_shutdown.is_set():
+        return jsonify({"message": "Can't send anymore requests. Server is shutting down."})
+
+    data = request.json
+    requests = data.get('requests') if isinstance(data, dict) else None
+
+    if not isinstance(requests, list):
+        return jsonify({"reason": "Invalid requests", "status": "error"})
+
+    max_batch = webserver.tasks_runner.admission.max_batch
+    if len(requests) > max_batch:
+        logger.info(f"Batch request with {len(requests)} requests")
+        return jsonify({
+            "reason": f"Too many requests in the batch, the limit is {max_batch}",
+            "status": "error"
+            })
+
+    # Checking the routes, the year ranges and the queries before registering any of the tasks
+    years = []
+    queries = []
+    percentiles = []
+    for item in requests:
+        if not isinstance(item, dict):
+            return jsonify({"reason": "Invalid request in batch", "status": "error"})
+        if item.get('route') not in ROUTES:
+            logger.info(f"Invalid route in batch request: {item.get('route')}")
+            return jsonify({
+                "reason": f"Invalid route: {item.get('route')}",
+                "status": "error"
+                })
+        check_fields(item['route'], item.get('question'), item.get('state'))
+        try:
+            years.append(requested_years(item))
+        except (TypeError, ValueError):
+            return jsonify({"reason": "Invalid year range", "status": "error"})
+        try:
+            queries.append(requested_query(item) if item['route'] == 'query' else None)
+            percentiles.append(requested_percentile(item))
+        except ValueError as error:
+            return jsonify({"reason": str(error), "status": "error"})
+
+    webserver.tasks_runner.admission.admit_all(['batch'] + [item['route'] for item in requests])
+
+    # the ids of the items come before the id of the batch
+    batch = webserver.tasks_runner.submit(lambda new_id: BatchTask(
+        [Task(item.get('question'), item.get('state'), new_id(), item['route'],
+              item_years, query, percentile)
+         for item, item_years, query, percentile in zip(requests, years, queries, percentiles)],
+        new_id()))
+
+    job_ids = [format_job_id(item.task_id) for item in batch.items]
+
+    logger.info("Batch submitted", extra={
+        'job_id': format_job_id(batch.task_id),
+        'route': 'batch',
+        'items': job_ids,
+    })
+
+    return job_response(batch, {"job_ids": job_ids})
 
 
 # You can check localhost in your browser to see what this displays
@@ -333,45 +738,160 @@ def graceful_shutdown():
 def get_response(job_id):
     '''
     Function that returns the result of a task.
+    If the user asked to wait (see requested_wait), the response is sent as soon
+    as the task is done instead of answering "running" right away.
     '''
 
-    # Going through the tasks we have
-    for task in webserver.tasks_runner.tasks_list:
-        job_id_str = "job_id_" + str(task.task_id)
+    # Looking up the task by its id
+    task_id = parse_job_id(job_id)
+    task = webserver.tasks_runner.jobs.get(task_id) if task_id is not None else None
+
+    if task is not None:
+        # If the task is done, we return its result
+        wait_ms = requested_wait()
+        if task.done or (wait_ms > 0 and task.wait(wait_ms / 1000)):
+            logger.info(f"Returning result for job_id: {job_id}", extra={'job_id': job_id})
+            # the response was encoded once, when the task was done
+            return Response(task.response, mimetype='application/json')
+        # Otherwise, we let the user know the task is still running
+        logger.info(f"Task with job_id: {job_id} is still running", extra={'job_id': job_id})
+        return jsonify({
+        "status": "running"
+        })
 
-        if job_id_str == job_id:
-            # If the task is done, we return its result
-            if task.done:
-                logger.info(f"Returning result for job_id: {job_id}")
-                return jsonify({
-                "data": task.result,
-                "status": "done"
-                })
-            # Otherwise, we let the user know the task is still running
-            logger.info(f"Task with job_id: {job_id} is still running")
-            return jsonify({
-            "status": "running"
+    # The task was registered, but its result was evicted
+    if task_id is not None and webserver.tasks_runner.jobs.is_expired(task_id):
+        # The result may still be served from the store
+        if (data := webserver.tasks_runner.store.read(task_id)) is not None:
+            logger.info(f"Returning stored result for job_id: {job_id}", extra={'job_id': job_id})
+            return Response(done_response(data), mimetype='application/json')
+
+        logger.info(f"Expired job_id: {job_id}", extra={'job_id': job_id})
+        return jsonify({
+            "reason": "Expired job_id",
+            "status": "expired"
             })
 
-    # If we get here, it means the task is not in the list
-    logger.info(f"Invalid job_id: {job_id}")
+    # If we get here, it means the task is not registered
+    logger.info(f"Invalid job_id: {job_id}", extra={'job_id': job_id})
     return jsonify({
         "reason": "Invalid job_id",
         "status": "error"
         })
 
 
+@webserver.route('/api/stream_results', methods=['GET'])
+def stream_results_request():
+    '''
+    Function that streams, as server-sent events, the results of the jobs given in
+    the comma separated "job_ids" query parameter, in the order they are done.
+    The stream ends when all the jobs are done or after "timeout" seconds.
+    The jobs whose result was evicted are answered like get_results does.
+    '''
+    job_ids = [job_id for job_id in request.args.get('job_ids', '').split(',') if job_id]
+    timeout = min(max(request.args.get('timeout', MAX_STREAM_SECONDS, type=float), 0),
+                  MAX_STREAM_SECONDS)
+
+    logger.info(f"Streaming results for job_ids: {job_ids}")
+
+    jobs = webserver.tasks_runner.jobs
+    tasks = {}
+    events = []
+    for job_id in job_ids:
+        task_id = parse_job_id(job_id)
+        task = jobs.get(task_id) if task_id is not None else None
+        if task is not None:
+            tasks[task_id] = task
+        elif task_id is not None and jobs.is_expired(task_id):
+            events.append(expired_event(job_id, webserver.tasks_runner.store.read(task_id)))
+        else:
+            events.append(sse_event("error", {"job_id": job_id, "reason": "Invalid job_id",
+                                              "status": "error"}))
+
+    return Response(stream_results(jobs, tasks, events, timeout), mimetype='text/event-stream')
+
+
+def sse_event(event: str, data: dict):
+    '''
+    Function that formats a server-sent event.
+    '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def response_event(event: str, job_id: str, response: bytes):
+    '''
+    Function that formats a server-sent event from the encoded response of a job.
+    '''
+    data = with_fields({"job_id": job_id}, response).decode()
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def done_event(task):
+    '''
+    Function that formats the event of a task that is done, or that failed,
+    from the response encoded when it was done.
+    '''
+    return response_event("error" if task.error is not None else "done",
+                          format_job_id(task.task_id), task.response)
+
+
+def expired_event(job_id: str, data: str):
+    '''
+    Function that formats the event of a job whose result was evicted: the result
+    if it is still persisted (data), or the expired status.
+    '''
+    if data is not None:
+        return response_event("done", job_id, done_response(data))
+    return sse_event("expired", {"job_id": job_id, "reason": "Expired job_id",
+                                 "status": "expired"})
+
+
+def stream_results(jobs, tasks: dict, events: list, timeout: float):
+    '''
+    Generator that yields the given events of the jobs that are not registered,
+    then an event for every task as soon as it is done.
+    A done listener puts the tasks that are done in a queue, so the stream
+    doesn't poll them.
+    '''
+    done_tasks = Queue()
+
+    def listener(task):
+        if task.task_id in tasks:
+            done_tasks.put(task)
+
+    jobs.add_done_listener(listener)
+    try:
+        yield from events
+
+        # The tasks done before the listener was added won't be put in the queue
+        for task in [done_task for done_task in tasks.values() if done_task.done]:
+            del tasks[task.task_id]
+            yield done_event(task)
+
+        deadline = time.monotonic() + timeout
+        while tasks:
+            try:
+                task = done_tasks.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
+                break
+            # The task may have been sent already, before the loop
+            if tasks.pop(task.task_id, None) is not None:
+                yield done_event(task)
+
+        for task_id in tasks:
+            yield sse_event("running", {"job_id": format_job_id(task_id), "status": "running"})
+    finally:
+        jobs.remove_done_listener(listener)
+
+
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs():
     '''
     Function that returns the number of jobs currently running
     '''
 
-    # Count the number of jobs running
-    jobs_running = 0
-    for task in webserver.tasks_runner.tasks_list:
-        if not task.done:
-            jobs_running += 1
+    # The registry keeps a running counter of the jobs that are not done
+    jobs_running = webserver.tasks_runner.jobs.pending()
 
     logger.info(f"Number of jobs running: {jobs_running}")
     return jsonify({'num_jobs': jobs_running})
@@ -380,25 +900,182 @@ def get_num_jobs():
 @webserver.route('/api/jobs', methods=['GET'])
 def get_jobs():
     '''
-    Function that returns the status of all jobs
+    Function that returns the status of the jobs.
+    If the start or limit query parameters are given, only that page of jobs is
+    returned, along with the id to ask for next. Otherwise, the status of all
+    jobs is streamed in chunks, so we never build one huge dictionary.
     '''
+    jobs = webserver.tasks_runner.jobs
 
-    jobs = {}
+    if 'start' in request.args or 'limit' in request.args:
+        start = request.args.get('start', 1, type=int)
+        limit = request.args.get('limit', JOBS_CHUNK_SIZE, type=int)
+
+        logger.info(f"Returning status of jobs starting from {start}, limit {limit}")
+        return jsonify({
+            'data': dict(jobs.page(start, limit)),
+            'next': start + limit if start + limit <= jobs.last_id() else None,
+            'status': 'done'
+        })
+
+    logger.info("Returning status of all jobs")
+    return Response(stream_jobs(jobs, jobs.last_id()), mimetype='application/json')
 
-    # Get the status of all jobs
-    for task in webserver.tasks_runner.tasks_list:
-        task_id = "job_id_" + str(task.task_id)
-        if task.done:
-            jobs[task_id] = "done"
-        else:
-            jobs[task_id] = "running"
 
-    logger.info(f"Returning status of all jobs")
+@webserver.route('/api/jobs_stats', methods=['GET'])
+def get_jobs_stats():
+    '''
+    Function that returns the counters of the job registry
+    (pending, done and evicted jobs, kept jobs and the size of the kept results)
+    '''
+    stats = webserver.tasks_runner.jobs.stats()
+
+    logger.info(f"Returning jobs stats: {stats}")
     return jsonify({
-        'data': jobs,
+        'data': stats,
         'status': 'done'
     })
 
+
+@webserver.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+    '''
+    Function that returns the counters of the result cache
+    (hits, misses, coalesced requests, evictions and cached results)
+    '''
+    stats = webserver.tasks_runner.cache.stats()
+
+    logger.info(f"Returning cache stats: {stats}")
+    return jsonify({
+        'data': stats,
+        'status': 'done'
+    })
+
+
+@webserver.route('/api/reload', methods=['POST'])
+def reload_request():
+    '''
+    Function that starts reloading the dataset in the background, from the
+    "path" given in the request or from the current csv file. The path is
+    relative to the data directory (see Dataset.data_path).
+    The jobs keep being served from the old data until the new one is loaded.
+    '''
+    data = request.get_json(silent=True) or {}
+    path = data.get('path')
+
+    logger.info(f"Received reload request with path: {path}")
+
+    dataset = webserver.tasks_runner.dataset
+    if path is not None:
+        path = dataset.data_path(path)
+        if path is None:
+            return jsonify({"reason": "Invalid path", "status": "error"})
+
+    if not dataset.start_reload(path):
+        logger.info("A reload is already running")
+        return jsonify({"message": "A reload is already running.", "status": "error"})
+
+    logger.info("Started reloading the dataset")
+    return jsonify({"message": "Started reloading the dataset.", "status": "reloading"})
+
+
+@webserver.route('/api/append', methods=['POST'])
+def append_request():
+    '''
+    Function that appends rows to the dataset, in memory, given as a list of
+    {column: value} objects in the "rows" field or as the "path" of a csv file
+    of the data directory (see Dataset.data_path).
+    Only the aggregates and the cached results of the changed questions are updated.
+    '''
+    data = request.get_json(silent=True) or {}
+
+    if 'path' in data:
+        path = webserver.tasks_runner.dataset.data_path(data['path'])
+        if path is None:
+            return jsonify({"reason": "Invalid path", "status": "error"})
+        try:
+            rows = read_csv_rows(path)
+        except (OSError, ValueError) as error:
+            logger.info(f"Invalid append request: {error}")
+            # the details of the error aren't sent back, they may describe the server files
+            return jsonify({"reason": "Can't read the csv file", "status": "error"})
+    else:
+        try:
+            rows = read_rows(data.get('rows', []))
+        except (TypeError, ValueError) as error:
+            logger.info(f"Invalid append request: {error}")
+            return jsonify({"reason": str(error), "status": "error"})
+
+    # an append without rows would only invalidate the cached results
+    if rows.empty:
+        logger.info("Invalid append request: no rows")
+        return jsonify({"reason": "No rows to append", "status": "error"})
+
+    version, questions = webserver.tasks_runner.dataset.append(rows)
+
+    logger.info(f"Appended {len(rows)} rows, version {version}")
+    return jsonify({
+        'data': {'rows': len(rows), 'version': version, 'questions': sorted(questions)},
+        'status': 'done'
+    })
+
+
+@webserver.route('/api/data_stats', methods=['GET'])
+def get_data_stats():
+    '''
+    Function that returns how long loading the dataset took and how much memory it uses
+    '''
+    dataset = webserver.tasks_runner.dataset
+    stats = dict(dataset.data_ingestor.load_stats)
+    stats['path'] = dataset.path
+    stats['version'] = dataset.current[0]
+    stats['last_reload'] = dataset.reload_stats
+
+    logger.info(f"Returning data stats: {stats}")
+    return jsonify({
+        'data': stats,
+        'status': 'done'
+    })
+
+
+@webserver.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Function that returns, in the Prometheus text format, the latency histograms
+    of every route and stage, the utilization of the workers, the depth of the
+    queue and the counters of the result cache
+    '''
+    tasks_runner = webserver.tasks_runner
+    admission = tasks_runner.admission.stats()
+    gauges = {
+        'queue_depth': tasks_runner.tasks.qsize(),
+        'jobs_pending': tasks_runner.jobs.pending(),
+        'jobs_in_flight': admission['in_flight'],
+        'jobs_rejected_429': admission['rejected_429'],
+        'jobs_rejected_503': admission['rejected_503'],
+    }
+
+    # not logged, since the metrics are scraped periodically
+    metrics = tasks_runner.metrics.render(gauges, tasks_runner.cache.stats(),
+                                          tasks_runner.num_threads)
+    return Response(metrics, mimetype='text/plain; version=0.0.4')
+
+
+def stream_jobs(jobs, last_id: int):
+    '''
+    Generator that yields the JSON with the status of the jobs up to last_id,
+    one chunk of jobs at a time.
+    '''
+    yield '{"data": {'
+
+    separator = ''
+    for start in range(1, last_id + 1, JOBS_CHUNK_SIZE):
+        for job_id, status in jobs.page(start, min(JOBS_CHUNK_SIZE, last_id + 1 - start)):
+            yield f'{separator}"{job_id}": "{status}"'
+            separator = ', '
+
+    yield '}, "status": "done"}'
+
 def get_defined_routes():
     '''
     Function that returns the list of defined routes
@@ -0,0 +1,157 @@
+'''
+This module saves and loads binary snapshots of the dataset, so the server
+doesn't have to parse the csv file again on every start.
+A snapshot is a directory with one .npy file per column, memory-mapped on load
+so the pages are shared between the processes that use the same snapshot, and
+the pickled aggregates precomputed from the data.
+'''
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.pickle'
+
+# incremented when the columns or the aggregates change, so the old snapshots are rebuilt
+SNAPSHOT_FORMAT = 5
+
+
+def file_sha256(path: str):
+    '''
+    Returns the sha256 hash of the content of the file.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_path(csv_path: str, snapshot_dir: str):
+    '''
+    Returns the directory of the snapshot of the given csv file. The name has a
+    hash of the absolute path, so the csv files with the same name in different
+    directories don't share a snapshot.
+    '''
+    path_hash = hashlib.sha256(os.path.abspath(csv_path).encode()).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f"{os.path.basename(csv_path)}-{path_hash}.snapshot")
+
+
+def write_meta(path: str, meta: dict):
+    '''
+    Writes the meta file of the snapshot in a temporary file first, then replaces
+    the old one, so a snapshot being loaded never sees a half written file.
+    '''
+    descriptor, tmp_path = tempfile.mkstemp(prefix=META_FILE + '.tmp-', dir=path)
+    with open(descriptor, 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+
+def is_valid(meta: dict, csv_path: str):
+    '''
+    Checks if the snapshot described by meta was made from the current csv file,
+    in the current format.
+    If the size and the modification time match, the file is not hashed again.
+    '''
+    if meta.get('format') != SNAPSHOT_FORMAT:
+        return False
+
+    stat = os.stat(csv_path)
+    if meta['size'] != stat.st_size:
+        return False
+    if meta['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    return meta['sha256'] == file_sha256(csv_path)
+
+
+def refresh_mtime(meta: dict, path: str, csv_path: str):
+    '''
+    Records the current modification time of the csv file in the snapshot,
+    so a file that was touched but not changed isn't hashed on every start.
+    '''
+    mtime_ns = os.stat(csv_path).st_mtime_ns
+    if meta['mtime_ns'] == mtime_ns:
+        return
+
+    meta['mtime_ns'] = mtime_ns
+    write_meta(path, meta)
+
+
+def load_snapshot(csv_path: str, snapshot_dir: str):
+    '''
+    Returns the dataframe and the aggregates from the snapshot of the csv file,
+    or None if there is no valid snapshot.
+    '''
+    path = snapshot_path(csv_path, snapshot_dir)
+    try:
+        with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        if not is_valid(meta, csv_path):
+            return None
+        refresh_mtime(meta, path, csv_path)
+
+        columns = {}
+        for column, categories in meta['columns'].items():
+            # the arrays are memory-mapped, so they are only read when needed
+            values = np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+            if categories is not None:
+                values = pd.Categorical.from_codes(values, categories)
+            columns[column] = values
+
+        with open(os.path.join(path, INDEX_FILE), 'rb') as file:
+            index = pickle.load(file)
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError):
+        return None
+
+    return pd.DataFrame(columns, copy=False), index
+
+
+def save_snapshot(csv_path: str, snapshot_dir: str, panda_data: pd.DataFrame, index):
+    '''
+    Saves the dataframe and the aggregates of the csv file as a snapshot.
+    The snapshot is written in a temporary directory first, so a crash
+    never leaves a half written snapshot behind. Raises OSError if it can't
+    be written.
+    '''
+    path = snapshot_path(csv_path, snapshot_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # every save has its own directory, so concurrent saves don't mix their files
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.tmp-', dir=snapshot_dir)
+
+    stat = os.stat(csv_path)
+    meta = {
+        'format': SNAPSHOT_FORMAT,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': file_sha256(csv_path),
+        'columns': {},
+    }
+
+    for column in panda_data.columns:
+        values = panda_data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            meta['columns'][column] = values.cat.categories.tolist()
+            values = values.cat.codes
+        else:
+            meta['columns'][column] = None
+        np.save(os.path.join(tmp_path, column + '.npy'), values.to_numpy())
+
+    with open(os.path.join(tmp_path, INDEX_FILE), 'wb') as file:
+        pickle.dump(index, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    with open(os.path.join(tmp_path, META_FILE), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+
+    # replacing the old snapshot, if there is one; when another save of the same
+    # file replaced it in between, os.replace fails and its snapshot is kept
+    try:
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -1,11 +1,35 @@
 '''
 This module contains the ThreadPool and TaskRunner classes.
 '''
-from queue import Queue, Empty
+from queue import Empty
 from threading import Thread, Event
-import os
 import json
-from .data_ingestor import DataIngestor
+import logging
+import os
+import time
+from .dataset import Dataset, DatasetWatcher
+from .executor import backend_from_env
+from .result_store import store_from_env
+from .job_registry import JobRegistry, RetentionPolicy, format_job_id
+from .journal import journal_from_env
+from .data_ingestor import Task, BatchTask
+from .result_cache import ResultCache
+from .metrics import Metrics
+from .admission import AdmissionControl, PriorityTaskQueue, job_routes
+from .encoding import encode_result, done_response, error_response, response_data
+
+# the records go to the structured log set up by the routes (see request_log)
+logger = logging.getLogger("webserver")
+
+# how long an idle worker blocks on the queue before checking the shutdown event
+QUEUE_TIMEOUT = 1.0
+
+# the routes the workers know how to compute
+ROUTES = ('states_mean', 'state_mean', 'best5', 'worst5', 'global_mean', 'diff_from_mean',
+          'state_diff_from_mean', 'mean_by_category', 'state_mean_by_category',
+          'states_mean_range', 'state_mean_range', 'global_mean_range', 'state_trend', 'query',
+          'states_percentile', 'state_percentile', 'state_percentile_by_category',
+          'states_stddev', 'state_stddev')
 
 
 class ThreadPool:
@@ -18,6 +42,20 @@ class ThreadPool:
         specified in the TP_NUM_OF_THREADS environment variable.
         If the environment variable is not set, use the number of
         CPUs on the machine.
+        The results are cached in a cache with at most TP_CACHE_SIZE entries
+        (1024 by default, 0 disables the cache).
+        The dataset is read from TP_DATASET_PATH and its snapshots are kept in the
+        TP_SNAPSHOT_DIR directory ("snapshots" by default, an empty value disables them).
+        If TP_DATASET_WATCH is set, the csv file is checked for changes every
+        TP_DATASET_WATCH seconds and reloaded when it changes.
+        The results are computed on the worker threads, or on a pool of processes
+        if TP_EXECUTOR is set to "processes", and persisted by the store selected
+        by TP_RESULTS_STORE.
+        If TP_JOURNAL is set, the jobs are recorded in that journal file and the
+        ones recorded by a previous run are restored.
+        The jobs that can wait or run at the same time are limited by TP_MAX_QUEUE
+        and TP_ROUTE_LIMITS, and TP_ROUTE_PRIORITIES lets some routes skip ahead
+        in the queue (see admission).
         The ThreadPool will be used to run tasks in parallel.
         The ThreadPool will also create a DataIngestor object to
         ingest the data from the CSV file.
@@ -28,130 +66,330 @@ class ThreadPool:
         else:
             self.num_threads = os.cpu_count()
 
-        # create a queue to store the tasks
-        self.tasks = Queue()
-        # create a list to store the tasks so we can iterate through them and manipulate that data
-        self.tasks_list = []
+        # create a queue to store the tasks, ordered by the priorities of their routes
+        self.tasks = PriorityTaskQueue.from_env()
+        # create the counters that limit the jobs waiting or running
+        self.admission = AdmissionControl.from_env()
+        # create the store that persists the results in the background
+        self.store = store_from_env()
+        # create a registry to look up the tasks by their id, which also evicts
+        # the results according to the TP_MAX_JOBS, TP_MAX_RESULT_BYTES and
+        # TP_JOB_TTL environment variables
+        self.jobs = JobRegistry(RetentionPolicy.from_env(), self.store.discard)
         # create an event to signal the threads to stop
         self.graceful_shutdown = Event()
+        # create a cache for the results of identical tasks
+        self.cache = ResultCache(int(os.environ.get('TP_CACHE_SIZE', 1024)))
         # create a list to store the threads
         self.pool = []
-        self.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+        # the cached results are computed from the old data after a reload,
+        # and only the ones of the changed questions after an append
+        self.dataset = Dataset.from_env(self.cache.invalidate, self.discard_cached)
+        # create the backend that computes the results
+        self.backend = backend_from_env(self.dataset.snapshot_dir)
+        # create the journal of the jobs and restore the jobs of the previous run
+        self.journal = journal_from_env(self.journal_state)
+        if self.journal is not None:
+            self.recover()
+        # collect the timestamps of the tasks that are done
+        self.metrics = Metrics()
+
+    def discard_cached(self, questions: set):
+        '''
+        Drop the cached results of the given questions.
+        The cache keys are (revision, route, question, state, years, query, percentile), see
+        TaskRunner.run_task. The queries aren't limited to a question, so they are dropped too.
+        '''
+        self.cache.discard(lambda key: key[2] in questions or key[2] is None)
+
+    def recover(self):
+        '''
+        Restore the jobs recorded in the journal: the done ones get their result
+        back, the failed ones their error, and the unfinished ones are queued again.
+        The items of an unfinished batch are run by the batch, so they aren't queued
+        on their own.
+        The items of a batch missing from the journal (ex. a line cut by a crash)
+        are left out of the batch.
+        '''
+        submits, results, errors, next_id = self.journal.replay()
+        restored = {}
+        batched = set()
+
+        for record in submits:
+            if record['route'] == 'batch':
+                task = BatchTask([restored[item] for item in record['items'] if item in restored],
+                                 record['id'])
+                batched.update(record['items'])
+            else:
+                years = record.get('years')
+                task = Task(record['question'], record['state'], record['id'], record['route'],
+                            tuple(years) if years else None, record.get('query'),
+                            record.get('percentile'))
+
+            task.timestamps['enqueue'] = time.perf_counter()
+            self.jobs.add(task)
+            restored[task.task_id] = task
+            self.jobs.reserve_ids(task.task_id)
 
-        # create results directory
-        os.makedirs('results', exist_ok=True)
+        for task_id, task in restored.items():
+            if task_id in errors:
+                task.error = errors[task_id]
+                task.response = error_response(task.error)
+                self.jobs.mark_done(task, None, len(task.response))
+            elif task_id in results:
+                data = encode_result(results[task_id])
+                task.response = done_response(data)
+                self.jobs.mark_done(task, results[task_id], len(data))
+            elif task_id not in batched:
+                # the restored jobs are run even if they go over the limits
+                self.admission.add_all(job_routes(task))
+                self.tasks.put(task)
+
+        # the ids of the jobs evicted before the restart aren't given again
+        self.jobs.reserve_ids(next_id - 1)
+
+        # the evicted jobs are not kept in the new journal
+        for task_id in restored:
+            self.jobs.get(task_id)
+        self.journal.compact(*self.journal_state())
+
+    def journal_state(self):
+        '''
+        Returns the tasks the journal keeps, in the order of their ids, and the next
+        task id. The tasks are the registered jobs and the items of the registered
+        batches, which a batch needs to be restored even once its items are evicted.
+        '''
+        tasks = {}
+        for task in self.jobs.tasks():
+            tasks[task.task_id] = task
+            for item in getattr(task, 'items', ()):
+                tasks[item.task_id] = item
+
+        return [tasks[task_id] for task_id in sorted(tasks)], self.jobs.last_id() + 1
 
     def start(self):
         '''
-        Start the threads in the thread pool.
+        Start the threads in the thread pool and the thread of the result store.
         '''
+        self.store.start()
+        if self.journal is not None:
+            self.journal.start()
+
         for _ in range(self.num_threads):
-            task_runner = TaskRunner(self.tasks, self.graceful_shutdown, self.data_ingestor)
+            task_runner = TaskRunner(self)
             self.pool.append(task_runner)
             task_runner.start()
 
-    def add_task(self, task):
+        if 'TP_DATASET_WATCH' in os.environ:
+            DatasetWatcher(self.dataset, float(os.environ['TP_DATASET_WATCH']),
+                           self.graceful_shutdown).start()
+
+    @property
+    def data_ingestor(self):
+        '''
+        The DataIngestor of the currently loaded dataset.
+        '''
+        return self.dataset.data_ingestor
+
+    def submit(self, make_task):
         '''
-        Add a task to the ThreadPool's task queue and list.
+        Create a task with make_task and add it to the ThreadPool's registry
+        (see JobRegistry.register), journal and task queue, then return it.
+        The items of a batch are registered too, and the batch is queued
+        as a single unit of work.
+        The task must have been admitted (see AdmissionControl.admit).
         '''
+        task = self.jobs.register(make_task)
+        for new_task in getattr(task, 'items', []) + [task]:
+            new_task.timestamps['enqueue'] = time.perf_counter()
+            if self.journal is not None:
+                self.journal.record_submit(new_task)
+
         self.tasks.put(task)
-        self.tasks_list.append(task)
+        return task
 
     def stop(self):
         '''
         Announce the threads to stop and wait for them to finish.
+        The sentinels are queued after the registered tasks, so the threads
+        finish processing them before stopping (drain mode).
         '''
         self.graceful_shutdown.set()
 
+        for _ in self.pool:
+            self.tasks.put(None)
+
         for task_runner in self.pool:
             task_runner.join()
 
+        self.backend.shutdown()
+        self.store.stop()
+        if self.journal is not None:
+            self.journal.stop()
+
 
 
 class TaskRunner(Thread):
     '''
     Class that will run tasks from the ThreadPool's task queue.
     '''
-    def __init__(self, tasks, graceful_shutdown, data_ingestor):
+    def __init__(self, thread_pool):
         '''
-        Class constructor.
+        Class constructor. The TaskRunner shares the queue, the shutdown event,
+        the data, the job registry, the result cache, the backend, the result store,
+        the journal, the metrics and the admission control of its ThreadPool.
         '''
         Thread.__init__(self)
 
-        self.tasks = tasks
-        self.graceful_shutdown = graceful_shutdown
-        self.data_ingestor = data_ingestor
+        self.tasks = thread_pool.tasks
+        self.graceful_shutdown = thread_pool.graceful_shutdown
+        self.dataset = thread_pool.dataset
+        self.jobs = thread_pool.jobs
+        self.cache = thread_pool.cache
+        self.backend = thread_pool.backend
+        self.store = thread_pool.store
+        self.journal = thread_pool.journal
+        self.metrics = thread_pool.metrics
+        self.admission = thread_pool.admission
 
     def run(self):
         '''
-        Infinite loop that will run tasks from the ThreadPool's task queue
-        until the graceful_shutdown event is set.
-        The function checks the route of the task and calls the appropriate
-        method that will handle the data.
+        Loop that will run tasks from the ThreadPool's task queue until the
+        graceful_shutdown event is set and the queue is drained, or until a
+        stop sentinel is received.
+        The thread blocks on the queue instead of polling it, so an idle
+        worker doesn't use any CPU.
         '''
         while True:
-            if self.graceful_shutdown.is_set():
+            try:
+                task = self.tasks.get(timeout=QUEUE_TIMEOUT)
+            except Empty:
+                # nothing to do, we stop only if the server is shutting down
+                if self.graceful_shutdown.is_set():
+                    break
+                # otherwise we use the idle time to release the expired results
+                self.jobs.evict_expired()
+                continue
+
+            # the sentinel tells the thread that all the tasks were processed
+            if task is None:
                 break
-            if not self.tasks.empty():
-                # getting the tasks from the queue without blocking
-                try:
-                    task = self.tasks.get_nowait()
-                except Empty:
-                    continue
+
+            task.timestamps['dequeue'] = time.perf_counter()
+            self.metrics.task_started()
+            # the slot of the job is given back even if the task raised an error
+            try:
+                if task.route == 'batch':
+                    self.run_batch(task)
                 else:
-                    if task.route == 'states_mean':
-                        result = self.data_ingestor.get_states_mean(task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'state_mean':
-                        result = self.data_ingestor.get_state_mean(task.state_name, task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'best5':
-                        result = self.data_ingestor.get_best5(task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'worst5':
-                        result = self.data_ingestor.get_worst5(task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'global_mean':
-                        result = self.data_ingestor.get_global_mean(task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'diff_from_mean':
-                        result = self.data_ingestor.get_diff_from_mean(task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'state_diff_from_mean':
-                        result = self.data_ingestor.get_state_diff_from_mean(task.state_name, \
-                                                                            task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'mean_by_category':
-                        result = self.data_ingestor.get_mean_by_category(task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    elif task.route == 'state_mean_by_category':
-                        result = self.data_ingestor.get_state_mean_by_category(task.state_name, \
-                                                                            task.question)
-                        task.result = result
-                        task.done = True
-                        self.write_result(task, result)
-                    else:
-                        print("Invalid route")
-
-    def write_result(self, task, result):
-        '''
-        Write the result of the task to a JSON file.
-        '''
-        with open(f"results/job_id_{task.task_id}.json", 'w', encoding='utf-8') as f:
-            json.dump(result, f)
+                    self.run_task(task)
+            finally:
+                self.metrics.task_finished()
+                self.admission.release_all(job_routes(task))
+
+    def run_task(self, task):
+        '''
+        Compute the result of the task, mark it as done and write the result.
+        A task that raises an error fails on its own, without stopping the worker.
+        '''
+        if task.route not in ROUTES:
+            job_id = format_job_id(task.task_id)
+            logger.error(f"Invalid route {task.route!r} for job_id: {job_id}",
+                         extra={'job_id': job_id})
+            self.fail(task, "Invalid route")
+            return
+
+        try:
+            self.compute_task(task)
+        except Exception:  # pylint: disable=broad-exception-caught
+            job_id = format_job_id(task.task_id)
+            logger.exception(f"Task with job_id: {job_id} failed", extra={'job_id': job_id})
+            # the task may have failed after it was marked as done
+            if not task.done:
+                self.fail(task, "Task failed")
+
+    def compute_task(self, task):
+        '''
+        Compute the result of the task through the result cache and write it.
+        '''
+        # the task runs entirely on the dataset that is loaded when it starts
+        data_ingestor = self.dataset.data_ingestor
+
+        # identical tasks have the same result, so we compute it only once; the revision
+        # of the question changes only when its data does, so an append keeps the
+        # cached results of the other questions
+        key = (data_ingestor.revision(task.question), task.route, task.question,
+               task.state_name, task.years,
+               json.dumps(task.query, sort_keys=True) if task.query is not None else None,
+               task.percentile)
+        task.timestamps['compute_start'] = time.perf_counter()
+        # the cache keeps the encoded result too, so a hit isn't encoded again
+        result, data = self.cache.get_or_compute(
+            key, lambda: self.backend.compute(task, data_ingestor))
+        task.timestamps['compute_end'] = time.perf_counter()
+        result_size = self.write_result(task, data)
+        self.jobs.mark_done(task, result, result_size)
+        self.metrics.record(task)
+
+    def run_batch(self, batch):
+        '''
+        Run every item of the batch, then mark the batch as done with
+        the results of all its items.
+        The items with the same route and question share their computation
+        through the result cache.
+        '''
+        for item in batch.items:
+            # the items restored from the journal may be done already
+            if not item.done:
+                item.timestamps['dequeue'] = batch.timestamps['dequeue']
+                self.run_task(item)
+
+        try:
+            self.write_batch(batch)
+        except Exception:  # pylint: disable=broad-exception-caught
+            job_id = format_job_id(batch.task_id)
+            logger.exception(f"Batch with job_id: {job_id} failed", extra={'job_id': job_id})
+            if not batch.done:
+                self.fail(batch, "Task failed")
+
+    def write_batch(self, batch):
+        '''
+        Mark the batch as done with the results of its items. The failed items
+        are given as their error.
+        '''
+        result = {format_job_id(item.task_id): item.result if item.error is None
+                  else {"reason": item.error, "status": "error"} for item in batch.items}
+        # the encoded results of the items are reused instead of encoding them again
+        data = '{' + ','.join(
+            f'"{format_job_id(item.task_id)}":' +
+            (response_data(item.response) if item.error is None else item.response.decode())
+            for item in batch.items) + '}'
+        result_size = self.write_result(batch, data)
+        self.jobs.mark_done(batch, result, result_size)
+        self.metrics.record(batch)
+
+    def fail(self, task, reason: str):
+        '''
+        Mark the task as done with an error instead of a result, so its job
+        doesn't stay running. The error is journaled, so the job isn't run
+        again after a restart.
+        '''
+        task.error = reason
+        task.response = error_response(reason)
+        if self.journal is not None:
+            self.journal.record_error(task.task_id, reason)
+        self.jobs.mark_done(task, None, len(task.response))
+
+    def write_result(self, task, data: str):
+        '''
+        Keep the response of the task, built from its encoded result, queue the
+        result to be persisted and journaled, and return its size.
+        The store writes the result in the background, so the persisted timestamp
+        is taken once the result is handed over to it.
+        '''
+        task.response = done_response(data)
+        self.store.put(task.task_id, data)
+        if self.journal is not None:
+            self.journal.record_done(task.task_id, data)
+        task.timestamps['persisted'] = time.perf_counter()
+        return len(data)
@@ -0,0 +1,378 @@
+'''
+Load generator and benchmark for the webserver API.
+
+It replays a mix of requests against a running server with a fixed concurrency,
+and optionally a fixed rate, then reports the throughput, the latency percentiles
+of the submit requests and of the whole submit -> result round trip, and the CPU
+and memory used by the server. The reports are saved as JSON so two runs can be
+compared to catch performance regressions.
+
+Examples:
+    python checker/benchmark.py --requests 5000 --concurrency 16 --output base.json
+    python checker/benchmark.py --mix synthetic --rate 500 --pid 1234 --output new.json
+    python checker/benchmark.py --compare base.json new.json
+'''
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread, local
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+import requests
+
+# the routes that need a state besides the question
+STATE_ROUTES = ('state_mean', 'state_diff_from_mean', 'state_mean_by_category')
+
+# the metrics compared between two runs: name -> True if a higher value is better
+COMPARED_METRICS = {
+    'throughput': True,
+    'submit.p50': False,
+    'submit.p99': False,
+    'result.p50': False,
+    'result.p99': False,
+    'server.cpu_seconds': False,
+    'server.peak_rss_bytes': False,
+}
+
+
+def load_tests_mix(tests_dir: str):
+    '''
+    Returns the requests from the tests/<route>/input/*.json files.
+    '''
+    mix = []
+    for path in sorted(glob.glob(os.path.join(tests_dir, '*', 'input', '*.json'))):
+        route = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        with open(path, 'r', encoding='utf-8') as file:
+            mix.append({'route': route, 'body': json.load(file)})
+    return mix
+
+
+def load_jsonl_mix(path: str):
+    '''
+    Returns the requests from a file with one {"route", "question", "state"}
+    JSON object per line.
+    '''
+    mix = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                item = json.loads(line)
+                body = {key: value for key, value in item.items() if key != 'route'}
+                mix.append({'route': item['route'], 'body': body})
+    return mix
+
+
+def synthetic_mix(tests_mix: list, size: int, seed: int):
+    '''
+    Returns size requests drawn uniformly from the routes, questions and states
+    seen in the tests, so the mix isn't limited to the exact test inputs.
+    '''
+    rng = random.Random(seed)
+    routes = sorted({item['route'] for item in tests_mix})
+    questions = sorted({item['body']['question'] for item in tests_mix})
+    states = sorted({item['body']['state'] for item in tests_mix if 'state' in item['body']})
+
+    mix = []
+    for _ in range(size):
+        route = rng.choice(routes)
+        body = {'question': rng.choice(questions)}
+        if route in STATE_ROUTES:
+            body['state'] = rng.choice(states)
+        mix.append({'route': route, 'body': body})
+    return mix
+
+
+def percentiles(values: list):
+    '''
+    Returns the mean, the p50, p90, p99 and the maximum of the values, in milliseconds.
+    '''
+    if not values:
+        return {}
+
+    values = sorted(values)
+
+    def percentile(rank):
+        return values[min(int(rank * len(values)), len(values) - 1)] * 1000
+
+    return {
+        'mean': sum(values) / len(values) * 1000,
+        'p50': percentile(0.50),
+        'p90': percentile(0.90),
+        'p99': percentile(0.99),
+        'max': values[-1] * 1000,
+    }
+
+
+class ServerSampler(Thread):
+    '''
+    Thread that samples the CPU time and the resident memory of the server
+    process from /proc, every interval seconds, until it is stopped.
+    '''
+    def __init__(self, pid: int, interval: float = 0.1):
+        Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopped = Event()
+        self.start_cpu = self.cpu_seconds()
+        self.peak_rss = self.rss_bytes()
+
+    def cpu_seconds(self):
+        '''
+        Returns the user and system CPU time of the process.
+        '''
+        with open(f'/proc/{self.pid}/stat', 'r', encoding='utf-8') as file:
+            # the fields after the command name, which may contain spaces
+            fields = file.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss_bytes(self):
+        '''
+        Returns the resident memory of the process.
+        '''
+        with open(f'/proc/{self.pid}/statm', 'r', encoding='utf-8') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss_bytes())
+
+    def stop(self, elapsed: float):
+        '''
+        Stops the sampling and returns the server stats for the run.
+        '''
+        self.stopped.set()
+        self.join()
+        cpu_seconds = self.cpu_seconds() - self.start_cpu
+        return {
+            'cpu_seconds': cpu_seconds,
+            'cpu_percent': cpu_seconds / elapsed * 100,
+            'peak_rss_bytes': max(self.peak_rss, self.rss_bytes()),
+        }
+
+
+class Benchmark:
+    '''
+    Class that replays the mix against the server.
+    Every request is submitted, then its result is polled (with the long-poll
+    wait parameter) until it is done.
+    With a rate, the requests are scheduled at fixed intervals and the round trip
+    is measured from the scheduled time, so a slow server can't hide its queueing
+    delay by slowing down the load generator.
+    '''
+    def __init__(self, args, mix: list):
+        self.url = args.url.rstrip('/')
+        self.mix = mix
+        self.num_requests = args.requests
+        self.concurrency = args.concurrency
+        self.rate = args.rate
+        self.wait_ms = args.wait_ms
+        self.sessions = local()
+        self.start = None
+
+    def session(self):
+        '''
+        Returns the HTTP session of the current thread, so the connections are reused.
+        '''
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        return session
+
+    def run_one(self, index: int):
+        '''
+        Submits the request with the given index and waits for its result.
+        Returns (submit latency, round trip latency, error).
+        '''
+        scheduled = self.start
+        if self.rate > 0:
+            scheduled += index / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            scheduled = time.perf_counter()
+
+        item = self.mix[index % len(self.mix)]
+        session = self.session()
+        try:
+            sent = time.perf_counter()
+            response = session.post(f"{self.url}/api/{item['route']}", json=item['body'])
+            submit_latency = time.perf_counter() - sent
+            data = response.json()
+            if 'job_id' not in data:
+                return submit_latency, None, data.get('message') or data.get('reason')
+
+            while data.get('status') != 'done':
+                response = session.get(f"{self.url}/api/get_results/{data['job_id']}",
+                                       params={'wait': self.wait_ms})
+                result = response.json()
+                if result['status'] not in ('done', 'running'):
+                    return submit_latency, None, result.get('reason')
+                data['status'] = result['status']
+
+            return submit_latency, time.perf_counter() - scheduled, None
+        except (requests.RequestException, ValueError) as error:
+            return None, None, type(error).__name__
+
+    def run(self, sampler: ServerSampler = None):
+        '''
+        Runs all the requests and returns the report.
+        '''
+        if sampler is not None:
+            sampler.start()
+
+        self.start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            outcomes = list(executor.map(self.run_one, range(self.num_requests)))
+        elapsed = time.perf_counter() - self.start
+
+        errors = {}
+        for _, _, error in outcomes:
+            if error is not None:
+                errors[error] = errors.get(error, 0) + 1
+        completed = [outcome for outcome in outcomes if outcome[2] is None]
+
+        report = {
+            'config': {
+                'url': self.url,
+                'requests': self.num_requests,
+                'concurrency': self.concurrency,
+                'rate': self.rate,
+                'wait_ms': self.wait_ms,
+                'mix_size': len(self.mix),
+            },
+            'elapsed_seconds': elapsed,
+            'completed': len(completed),
+            'errors': errors,
+            'throughput': len(completed) / elapsed,
+            'submit': percentiles([outcome[0] for outcome in outcomes
+                                   if outcome[0] is not None]),
+            'result': percentiles([outcome[1] for outcome in completed]),
+        }
+        if sampler is not None:
+            report['server'] = sampler.stop(elapsed)
+
+        return report
+
+
+def print_report(report: dict):
+    '''
+    Prints the report in a readable form.
+    '''
+    print(f"requests: {report['completed']} completed in {report['elapsed_seconds']:.2f}s, "
+          f"errors: {report['errors'] or 'none'}")
+    print(f"throughput: {report['throughput']:.1f} req/s")
+    for name in ('submit', 'result'):
+        stats = report[name]
+        if stats:
+            print(f"{name:>7} latency (ms): " +
+                  ", ".join(f"{key} {value:.2f}" for key, value in stats.items()))
+    if 'server' in report:
+        server = report['server']
+        print(f"server: {server['cpu_seconds']:.2f} CPU seconds ({server['cpu_percent']:.0f}%), "
+              f"peak RSS {server['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def metric(report: dict, name: str):
+    '''
+    Returns the value of a dotted metric name (ex. "submit.p99") from the report.
+    '''
+    value = report
+    for key in name.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(base: dict, new: dict, threshold: float):
+    '''
+    Prints the change of every compared metric between the two reports and
+    returns the metrics that got worse by more than threshold (ex. 0.1 for 10%).
+    '''
+    regressions = []
+    for name, higher_is_better in COMPARED_METRICS.items():
+        old_value, new_value = metric(base, name), metric(new, name)
+        if not old_value or new_value is None:
+            continue
+
+        change = (new_value - old_value) / old_value
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f"{name:>22}: {old_value:12.3f} -> {new_value:12.3f} ({change:+.1%}){flag}")
+
+    return regressions
+
+
+def parse_args():
+    '''
+    Parses the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--mix', default='tests',
+                        help='"tests" (the tests/*/input files), "synthetic" or the path '
+                             'of a file with one {"route", "question", "state"} per line')
+    parser.add_argument('--tests-dir', default=os.path.join(os.path.dirname(__file__),
+                                                            '..', 'tests'))
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='requests per second, 0 sends them as fast as possible')
+    parser.add_argument('--wait-ms', type=int, default=1000,
+                        help='how long every poll of a result waits on the server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pid', type=int, help='pid of the server, to measure its CPU and RSS')
+    parser.add_argument('--output', help='file where the JSON report is saved')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two saved reports instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported as a regression by --compare')
+    return parser.parse_args()
+
+
+def main():
+    '''
+    Runs the benchmark or compares two reports. When comparing, the exit code
+    is 1 if there are regressions.
+    '''
+    args = parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path, 'r', encoding='utf-8') as file:
+                reports.append(json.load(file))
+        regressions = compare(reports[0], reports[1], args.threshold)
+        print(f"regressions: {', '.join(regressions) if regressions else 'none'}")
+        return 1 if regressions else 0
+
+    if args.mix == 'tests':
+        mix = load_tests_mix(args.tests_dir)
+    elif args.mix == 'synthetic':
+        mix = synthetic_mix(load_tests_mix(args.tests_dir), args.requests, args.seed)
+    else:
+        mix = load_jsonl_mix(args.mix)
+    random.Random(args.seed).shuffle(mix)
+
+    sampler = ServerSampler(args.pid) if args.pid else None
+    report = Benchmark(args, mix).run(sampler)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
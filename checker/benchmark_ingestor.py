@@ -0,0 +1,262 @@
+'''
+Micro-benchmarks for the DataIngestor query methods.
+
+Every method is called in-process, for every question (and state), on the csv file
+and on synthetic datasets made by repeating its rows scale times with some noise
+added to Data_Value. For every scale and method it reports the time per call,
+the memory allocated per call and the peak memory, along with the time and memory
+needed to load the dataset. The results are saved as JSON, and the methods over
+the --budget-ms per call are marked, to see which routes stop being viable as
+the dataset grows.
+
+Examples:
+    python checker/benchmark_ingestor.py --output ingestor.json
+    python checker/benchmark_ingestor.py --scales 1,10,100,1000 --repeat 3
+'''
+from statistics import median
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_ingestor():
+    '''
+    Imports app.data_ingestor. Importing the app package would start the webserver,
+    so the package is registered without running its __init__.
+    '''
+    spec = importlib.util.spec_from_file_location(
+        'app', os.path.join(ROOT, 'app', '__init__.py'),
+        submodule_search_locations=[os.path.join(ROOT, 'app')])
+    sys.modules.setdefault('app', importlib.util.module_from_spec(spec))
+    return importlib.import_module('app.data_ingestor')
+
+
+data_ingestor = import_ingestor()
+
+# the methods that take a state besides the question
+STATE_METHODS = ('get_state_mean', 'get_state_diff_from_mean', 'get_state_mean_by_category',
+                 'get_state_mean_range', 'get_state_trend', 'get_state_percentile',
+                 'get_state_percentile_by_category', 'get_state_stddev')
+
+# the methods that take a year range after the question, and the range they are called with
+RANGE_METHODS = ('get_states_mean_range', 'get_state_mean_range', 'get_global_mean_range',
+                 'get_state_trend')
+YEARS = (2015, 2019)
+
+# the methods that take a percentile after the question, and the percentile they are called with
+PERCENTILE_METHODS = ('get_states_percentile', 'get_state_percentile',
+                      'get_state_percentile_by_category')
+PERCENTILE = 90
+
+# the benchmarked methods, in the order of the routes
+METHODS = ('get_states_mean', 'get_state_mean', 'get_best5', 'get_worst5', 'get_global_mean',
+           'get_diff_from_mean', 'get_state_diff_from_mean', 'get_mean_by_category',
+           'get_state_mean_by_category', 'get_states_mean_range', 'get_state_mean_range',
+           'get_global_mean_range', 'get_state_trend', 'get_query', 'get_states_percentile',
+           'get_state_percentile', 'get_state_percentile_by_category', 'get_states_stddev',
+           'get_state_stddev')
+
+
+def write_scaled_csv(csv_path: str, scale: int, directory: str, seed: int):
+    '''
+    Writes a csv file with the rows of csv_path repeated scale times and returns its path.
+    The copies get some noise on Data_Value so the aggregates aren't identical.
+    '''
+    if scale == 1:
+        return csv_path
+
+    data = pd.read_csv(csv_path, usecols=list(data_ingestor.CSV_COLUMNS))
+    rng = np.random.default_rng(seed)
+    path = os.path.join(directory, f'scaled_{scale}.csv')
+
+    # the copies are written in chunks, so the whole scaled dataset is never in memory
+    for copy in range(scale):
+        chunk = data.copy()
+        chunk['Data_Value'] = chunk['Data_Value'] + rng.normal(0, 1, len(chunk)).round(1)
+        chunk.to_csv(path, mode='a', header=copy == 0, index=False)
+
+    return path
+
+
+def call_arguments(ingestor, method: str, states_per_question: int):
+    '''
+    Returns the arguments of every call of the method: every question and,
+    for the methods that take a state, the first states_per_question states.
+    The year range and percentile methods get YEARS and PERCENTILE.
+    '''
+    questions = list(ingestor.index.global_means)
+    if method == 'get_query':
+        return query_arguments(ingestor, states_per_question)
+
+    extra = ()
+    if method in RANGE_METHODS:
+        extra = (YEARS,)
+    elif method in PERCENTILE_METHODS:
+        extra = (PERCENTILE,)
+
+    if method not in STATE_METHODS:
+        return [(question,) + extra for question in questions]
+
+    return [(state, question) + extra for question in questions
+            for state in list(ingestor.index.states_means[question])[:states_per_question]]
+
+
+def query_arguments(ingestor, states_per_question: int):
+    '''
+    Returns the arguments of the generic query calls, in the form given by
+    requested_query: for every question, its means by state over YEARS and the
+    maximum of every stratification in its first states_per_question states.
+    The first call builds the index of the queries, which the median leaves out.
+    '''
+    queries = []
+    for question in ingestor.index.global_means:
+        states = sorted(list(ingestor.index.states_means[question])[:states_per_question])
+        queries.append({'filters': {'question': [question]}, 'years': list(YEARS),
+                        'group_by': ['state'], 'aggregate': 'mean'})
+        queries.append({'filters': {'question': [question], 'state': states}, 'years': None,
+                        'group_by': ['stratification_category', 'stratification'],
+                        'aggregate': 'max'})
+
+    return [(query,) for query in queries]
+
+
+def measure(function, arguments: list, repeat: int):
+    '''
+    Calls the function with every arguments tuple, repeat times, and returns the median
+    and minimum time per call, and the memory allocated per call and the peak memory
+    of one pass, as measured by tracemalloc.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in arguments:
+            function(*args)
+        timings.append((time.perf_counter() - start) / len(arguments))
+
+    # tracemalloc slows down the calls, so the allocations are measured on a separate pass
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for args in arguments:
+        function(*args)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    allocated = [stat for stat in after.compare_to(before, 'filename') if stat.size_diff > 0]
+    return {
+        'calls': len(arguments),
+        'median_us': median(timings) * 1e6,
+        'min_us': min(timings) * 1e6,
+        'alloc_blocks_per_call': sum(stat.count_diff for stat in allocated) / len(arguments),
+        'alloc_bytes_per_call': sum(stat.size_diff for stat in allocated) / len(arguments),
+        'peak_bytes': peak,
+    }
+
+
+def benchmark_scale(csv_path: str, scale: int, args):
+    '''
+    Loads the dataset at the given scale and benchmarks its loading and every method.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    ingestor = data_ingestor.DataIngestor(csv_path)
+    load_seconds = time.perf_counter() - start
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = [{
+        'scale': scale,
+        'rows': ingestor.load_stats['rows'],
+        'method': 'load',
+        'calls': 1,
+        'median_us': load_seconds * 1e6,
+        'min_us': load_seconds * 1e6,
+        'alloc_blocks_per_call': None,
+        'alloc_bytes_per_call': ingestor.load_stats['data_bytes'],
+        'peak_bytes': load_peak,
+    }]
+
+    for method in METHODS:
+        arguments = call_arguments(ingestor, method, args.states)
+        result = measure(getattr(ingestor, method), arguments, args.repeat)
+        results.append({'scale': scale, 'rows': ingestor.load_stats['rows'],
+                        'method': method, **result})
+
+    return results
+
+
+def print_table(results: list, budget_ms: float):
+    '''
+    Prints the median time per call of every method at every scale, marking with *
+    the ones over the budget.
+    '''
+    scales = sorted({result['scale'] for result in results})
+    times = {(result['method'], result['scale']): result['median_us'] for result in results}
+
+    print(f"{'method (us per call)':<34}" + ''.join(f"{f'x{scale}':>14}" for scale in scales))
+    for method in ('load',) + METHODS:
+        cells = []
+        for scale in scales:
+            value = times.get((method, scale))
+            mark = '*' if method != 'load' and value is not None \
+                and value > budget_ms * 1000 else ' '
+            cells.append(f"{value:13.1f}{mark}" if value is not None else f"{'-':>14}")
+        print(f"{method:<34}" + ''.join(cells))
+    print(f"* over the budget of {budget_ms} ms per call")
+
+
+def parse_args():
+    '''
+    Parses the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv',
+                        default=os.path.join(ROOT, 'nutrition_activity_obesity_usa_subset.csv'))
+    parser.add_argument('--scales', default='1,10,100',
+                        help='comma separated dataset scales, ex. 1,10,100,1000')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed passes over the calls of every method')
+    parser.add_argument('--states', type=int, default=5,
+                        help='number of states used for every question by the state methods')
+    parser.add_argument('--budget-ms', type=float, default=1.0,
+                        help='time per call over which a method is marked as not viable')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file where the JSON results are saved')
+    return parser.parse_args()
+
+
+def main():
+    '''
+    Runs the benchmarks for every scale.
+    '''
+    args = parse_args()
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            csv_path = write_scaled_csv(args.csv, scale, directory, args.seed)
+            results.extend(benchmark_scale(csv_path, scale, args))
+            if csv_path != args.csv:
+                os.remove(csv_path)
+
+    print_table(results, args.budget_ms)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'csv': args.csv, 'budget_ms': args.budget_ms, 'results': results},
+                      file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,599 @@
+'''
+Unit tests of the components of the webserver that don't need it to be running.
+
+Run them from the root of the repository:
+    python -m unittest -v unittests/TestWebserver.py
+'''
+from threading import Event, Thread
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import importlib.util
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_app_module(name: str):
+    '''
+    Imports a module of the app package. Importing the package itself would start
+    the webserver, so it is registered without running its __init__.
+    '''
+    spec = importlib.util.spec_from_file_location(
+        'app', os.path.join(ROOT, 'app', '__init__.py'),
+        submodule_search_locations=[os.path.join(ROOT, 'app')])
+    sys.modules.setdefault('app', importlib.util.module_from_spec(spec))
+    return importlib.import_module(f'app.{name}')
+
+
+data_ingestor = import_app_module('data_ingestor')
+aggregate_index = import_app_module('aggregate_index')
+job_registry = import_app_module('job_registry')
+query_index = import_app_module('query_index')
+result_cache = import_app_module('result_cache')
+result_store = import_app_module('result_store')
+task_runner = import_app_module('task_runner')
+
+QUESTIONS = (
+    'Percent of adults aged 18 years and older who have obesity',
+    'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
+)
+STATES = ('Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California')
+STRATIFICATIONS = (('Age (years)', '18 - 24'), ('Age (years)', '25 - 34'),
+                   ('Sex', 'Male'), ('Sex', 'Female'))
+YEARS = (2011, 2012, 2013, 2014, 2015, 2016)
+
+# the arguments of the routes that take more than the question
+YEAR_RANGE = (2012, 2015)
+PERCENTILE = 90
+
+
+def make_rows(seed: int, count: int, states=STATES, years=YEARS):
+    '''
+    Returns count random rows with the columns of the dataset, with some missing values.
+    '''
+    rng = np.random.default_rng(seed)
+    stratifications = rng.integers(len(STRATIFICATIONS), size=count)
+    values = rng.uniform(10, 60, size=count).round(1)
+    values[rng.random(count) < 0.05] = np.nan
+
+    return pd.DataFrame({
+        'Question': rng.choice(QUESTIONS, size=count),
+        'LocationDesc': rng.choice(states, size=count),
+        'StratificationCategory1': [STRATIFICATIONS[i][0] for i in stratifications],
+        'Stratification1': [STRATIFICATIONS[i][1] for i in stratifications],
+        'Data_Value': values,
+        'YearStart': rng.choice(years, size=count),
+    })
+
+
+def route_arguments(route: str, question: str, state: str):
+    '''
+    Returns the arguments of compute_result for a route.
+    '''
+    years = YEAR_RANGE if 'range' in route or 'trend' in route else None
+    percentile = PERCENTILE if 'percentile' in route else None
+    return route, question, state, years, None, percentile
+
+
+class TestWebserver(unittest.TestCase):
+    '''
+    Tests of the components of the webserver that don't need it to be running.
+    '''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.rows = make_rows(0, 600)
+        self.csv_path = self.write_csv('data.csv', self.rows)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_csv(self, name: str, rows: pd.DataFrame):
+        '''
+        Writes the rows to a csv file of the test directory and returns its path.
+        '''
+        path = os.path.join(self.directory.name, name)
+        rows.to_csv(path, index=False)
+        return path
+
+    def assert_results_equal(self, expected, actual, path='result'):
+        '''
+        Checks that two results have the same keys, in the same order, and the same
+        values, up to the rounding of the floating point sums.
+        '''
+        if isinstance(expected, dict):
+            self.assertIsInstance(actual, dict, path)
+            self.assertEqual(list(expected), list(actual), path)
+            for key, value in expected.items():
+                self.assert_results_equal(value, actual[key], f'{path}[{key!r}]')
+        elif isinstance(expected, float) and math.isnan(expected):
+            self.assertTrue(isinstance(actual, float) and math.isnan(actual), path)
+        else:
+            self.assertTrue(math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-9),
+                            f'{path}: {expected} != {actual}')
+
+    def test_appended_index_matches_fresh_load(self):
+        '''
+        The aggregates updated by an append are the ones of the concatenated csv,
+        including the new states and years the appended rows bring.
+        '''
+        delta = make_rows(1, 150, STATES + ('Colorado',), YEARS + (2017,))
+        ingestor = data_ingestor.DataIngestor(self.csv_path)
+        appended, questions = ingestor.appended(
+            data_ingestor.read_csv_rows(self.write_csv('delta.csv', delta)), 1)
+        fresh = data_ingestor.DataIngestor(
+            self.write_csv('all.csv', pd.concat([self.rows, delta], ignore_index=True)))
+
+        self.assertEqual(set(QUESTIONS), questions)
+        for route in task_runner.ROUTES:
+            if route == 'query':
+                continue
+            for question in QUESTIONS:
+                for state in STATES + ('Colorado',):
+                    arguments = route_arguments(route, question, state)
+                    self.assert_results_equal(fresh.compute_result(*arguments),
+                                              appended.compute_result(*arguments),
+                                              f'{route} {state}')
+
+    def test_query_matches_pandas_groupby(self):
+        '''
+        The generic queries give the aggregates of a pandas groupby, in its order.
+        '''
+        data = data_ingestor.read_csv_rows(self.csv_path)
+        index = query_index.QueryIndex(data)
+        selected = data[data['LocationDesc'].isin(STATES[:2])
+                        & data['YearStart'].between(*YEAR_RANGE)]
+
+        for aggregate in query_index.AGGREGATES:
+            query = {'filters': {'state': sorted(STATES[:2])}, 'years': list(YEAR_RANGE),
+                     'group_by': ['question', 'year'], 'aggregate': aggregate}
+            grouped = selected.groupby(['Question', 'YearStart'], observed=True)['Data_Value'] \
+                .agg(aggregate)
+            expected = {aggregate_index.key_to_str((question, str(year))): float(value)
+                        for (question, year), value in grouped.items()}
+            self.assert_results_equal(expected, index.run(query), aggregate)
+
+            query['group_by'] = []
+            self.assert_results_equal({aggregate: float(selected['Data_Value'].agg(aggregate))},
+                                      index.run(query), aggregate)
+
+    def test_percentiles_match_numpy(self):
+        '''
+        The percentiles are the ones of numpy.percentile and the standard deviations
+        the ones of pandas, for every state and every category of a state.
+        '''
+        ingestor = data_ingestor.DataIngestor(self.csv_path)
+        data = self.rows[self.rows['Data_Value'].notna()]
+
+        for question in QUESTIONS:
+            question_data = data[data['Question'] == question]
+            states = ingestor.get_states_percentile(question, PERCENTILE)
+            stddevs = ingestor.get_states_stddev(question)
+
+            for state in STATES:
+                values = question_data[question_data['LocationDesc'] == state]['Data_Value']
+                self.assert_results_equal(np.percentile(values, PERCENTILE), states[state])
+                self.assert_results_equal(
+                    {state: np.percentile(values, PERCENTILE)},
+                    ingestor.get_state_percentile(state, question, PERCENTILE))
+                self.assert_results_equal(values.std(), stddevs[state])
+
+                by_category = ingestor.get_state_percentile_by_category(state, question,
+                                                                        PERCENTILE)[state]
+                state_data = question_data[question_data['LocationDesc'] == state]
+                for (category, stratification), group in state_data.groupby(
+                        ['StratificationCategory1', 'Stratification1']):
+                    self.assert_results_equal(
+                        np.percentile(group['Data_Value'], PERCENTILE),
+                        by_category[aggregate_index.key_to_str((category, stratification))])
+
+    def test_cache_coalesces_identical_computations(self):
+        '''
+        A request for a key that is being computed waits for that computation.
+        '''
+        cache = result_cache.ResultCache(8)
+        started, release = Event(), Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+        first = Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+        first.start()
+        started.wait()
+        second = Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+        second.start()
+        # the second request waits on the computation of the first one
+        while cache.stats()['coalesced'] == 0:
+            second.join(0.01)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(['result', 'result'], results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, cache.stats()['misses'])
+
+    def test_cache_drops_results_computed_before_invalidation(self):
+        '''
+        A result computed from the data of before an invalidation isn't stored.
+        '''
+        cache = result_cache.ResultCache(8)
+        started, release = Event(), Event()
+
+        def compute_old():
+            started.set()
+            release.wait()
+            return 'old'
+
+        thread = Thread(target=cache.get_or_compute, args=('key', compute_old))
+        thread.start()
+        started.wait()
+        cache.invalidate()
+        release.set()
+        thread.join()
+
+        self.assertEqual(0, cache.stats()['entries'])
+        self.assertEqual('new', cache.get_or_compute('key', lambda: 'new'))
+        self.assertEqual('new', cache.get_or_compute('key', lambda: 'other'))
+
+    def test_journal_restores_jobs_after_restart(self):
+        '''
+        After a restart the kept jobs and batches get their results back, the failed
+        jobs their error, the evicted ids stay expired and the new ids continue
+        after the last one given.
+        '''
+        environment = {
+            'TP_DATASET_PATH': self.csv_path,
+            'TP_SNAPSHOT_DIR': '',
+            'TP_JOURNAL': os.path.join(self.directory.name, 'journal.log'),
+            'TP_RESULTS_STORE': 'none',
+            'TP_NUM_OF_THREADS': '1',
+            'TP_MAX_JOBS': '5',
+        }
+        with mock.patch.dict(os.environ, environment):
+            thread_pool = task_runner.ThreadPool()
+            thread_pool.start()
+            # a question that isn't a string makes the last task fail, and its
+            # error is logged without stopping the worker
+            with self.assertLogs('webserver', level='ERROR') as logs:
+                tasks = [self.submit(thread_pool, ['global_mean'],
+                                     lambda new_id, question=question: data_ingestor.Task(
+                                         question, None, new_id(), 'global_mean'))
+                         for question in [QUESTIONS[0]] * 3 + [[QUESTIONS[0]]]]
+                batch = self.submit(
+                    thread_pool, ['batch'] + ['state_mean'] * len(QUESTIONS),
+                    lambda new_id: data_ingestor.BatchTask(
+                        [data_ingestor.Task(question, STATES[0], new_id(), 'state_mean')
+                         for question in QUESTIONS], new_id()))
+                for task in tasks + [batch]:
+                    self.assertTrue(task.wait(5))
+            self.assertEqual([job_registry.format_job_id(tasks[3].task_id)],
+                             [record.job_id for record in logs.records])
+            thread_pool.stop()
+
+            restarted = task_runner.ThreadPool()
+
+        jobs = restarted.jobs
+        self.assertEqual(thread_pool.jobs.next_id, jobs.next_id)
+        self.assertEqual(0, jobs.pending())
+        self.assertEqual(0, restarted.tasks.qsize())
+
+        # the first jobs were evicted by TP_MAX_JOBS before the restart
+        for task in tasks[:2]:
+            self.assertIsNone(jobs.get(task.task_id))
+            self.assertTrue(jobs.is_expired(task.task_id))
+
+        self.assertEqual(tasks[2].result, jobs.get(tasks[2].task_id).result)
+        self.assertEqual('Task failed', jobs.get(tasks[3].task_id).error)
+
+        restored_batch = jobs.get(batch.task_id)
+        self.assertEqual(batch.result, restored_batch.result)
+        self.assertEqual([item.task_id for item in batch.items],
+                         [item.task_id for item in restored_batch.items])
+
+    def test_registry_evicts_expired_and_least_recently_used_jobs(self):
+        '''
+        The done jobs over the count or size limit are evicted from the least recently
+        used, the expired ones in the order they were done even if they were polled
+        since, and the ids of the evicted jobs stay expired.
+        '''
+        for retention in (job_registry.RetentionPolicy(max_jobs=2, ttl=10),
+                          job_registry.RetentionPolicy(max_result_bytes=20, ttl=10)):
+            with self.subTest(max_jobs=retention.max_jobs,
+                              max_result_bytes=retention.max_result_bytes):
+                self.check_eviction(job_registry.JobRegistry(retention))
+
+    def check_eviction(self, registry):
+        '''
+        Checks the eviction of three jobs of 8 bytes, done one second apart, by a
+        registry that keeps two of them for 10 seconds.
+        '''
+        now = [0]
+        with mock.patch.object(job_registry.time, 'perf_counter', lambda: now[0]):
+            tasks = [registry.register(lambda new_id: data_ingestor.Task(
+                QUESTIONS[0], None, new_id(), 'global_mean')) for _ in range(3)]
+            for task in tasks:
+                registry.mark_done(task, 1.0, 8)
+                # polling the first job makes the second one the least recently used
+                registry.get(tasks[0].task_id)
+                now[0] += 1
+
+            self.assertIsNone(registry.get(tasks[1].task_id))
+            self.assertTrue(registry.is_expired(tasks[1].task_id))
+
+            # the first job was done before the last one, so it expires first, even
+            # though it was used since
+            now[0] = 10.5
+            registry.evict_expired()
+            self.assertEqual(1, registry.stats()['kept_results'])
+            self.assertIsNone(registry.get(tasks[0].task_id))
+            self.assertTrue(registry.is_expired(tasks[0].task_id))
+            self.assertIs(tasks[2], registry.get(tasks[2].task_id))
+
+        self.assertEqual(2, registry.stats()['evicted'])
+
+    def test_log_store_serves_evicted_results(self):
+        '''
+        The log store still serves the results of the evicted jobs, until their
+        segment is removed by the segment limit, and after a restart that keeps
+        the segments.
+        '''
+        directory = os.path.join(self.directory.name, 'results')
+        results = {task_id: json.dumps({'global_mean': task_id / 3})
+                   for task_id in range(1, 41)}
+
+        # a result takes about 30 bytes, so a segment of 100 bytes has 4 of them
+        store = result_store.LogResultStore(directory, 8, 100, 3)
+        registry = job_registry.JobRegistry(job_registry.RetentionPolicy(max_jobs=1),
+                                            store.discard)
+        store.start()
+        for task_id, data in results.items():
+            task = registry.register(lambda new_id: data_ingestor.Task(
+                QUESTIONS[0], None, new_id(), 'global_mean'))
+            store.put(task.task_id, data)
+            registry.mark_done(task, json.loads(data), len(data))
+        store.stop()
+
+        kept = [task_id for task_id in results if store.read(task_id) is not None]
+        self.assertTrue(registry.is_expired(kept[0]))
+        self.assertEqual(list(range(kept[0], 41)), kept)
+        self.assertLess(len(kept), 40)
+        for task_id in kept:
+            self.assertEqual(results[task_id], store.read(task_id))
+
+        restarted = result_store.LogResultStore(directory, 8, 100, keep=True)
+        self.assertEqual(kept, [task_id for task_id in results
+                                if restarted.read(task_id) is not None])
+        self.assertEqual(results[40], restarted.read(40))
+
+    def test_snapshot_is_reused_until_the_csv_changes(self):
+        '''
+        A snapshot is reused while its csv file doesn't change, even if the file is
+        touched, and rebuilt when it does. A csv file with the same name in another
+        directory has its own snapshot.
+        '''
+        snapshot_dir = os.path.join(self.directory.name, 'snapshots')
+        other_path = os.path.join(self.directory.name, 'other', 'data.csv')
+        os.makedirs(os.path.dirname(other_path))
+        make_rows(1, 300).to_csv(other_path, index=False)
+
+        def load(path):
+            ingestor = data_ingestor.DataIngestor(path, snapshot_dir)
+            return ingestor.load_stats['from_snapshot'], ingestor.get_states_mean(QUESTIONS[0])
+
+        from_snapshot, first = load(self.csv_path)
+        self.assertFalse(from_snapshot)
+        self.assertFalse(load(other_path)[0])
+
+        from_snapshot, second = load(self.csv_path)
+        self.assertTrue(from_snapshot)
+        self.assert_results_equal(first, second)
+        self.assertTrue(load(other_path)[0])
+
+        stat = os.stat(self.csv_path)
+        os.utime(self.csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertTrue(load(self.csv_path)[0])
+
+        rows = make_rows(2, 600)
+        self.write_csv('data.csv', rows)
+        from_snapshot, changed = load(self.csv_path)
+        self.assertFalse(from_snapshot)
+        self.assert_results_equal(data_ingestor.DataIngestor(self.csv_path)
+                                  .get_states_mean(QUESTIONS[0]), changed)
+        self.assertTrue(load(self.csv_path)[0])
+
+    @staticmethod
+    def submit(thread_pool, routes: list, make_task):
+        '''
+        Admits the jobs of the routes and submits the task to the thread pool,
+        like the routes do.
+        '''
+        thread_pool.admission.admit_all(routes)
+        return thread_pool.submit(make_task)
+
+
+class TestServer(unittest.TestCase):
+    '''
+    Tests of the routes, on a webserver started with the synthetic dataset.
+    '''
+    # the limits of the webserver the tests run on
+    ENVIRONMENT = {
+        'TP_SNAPSHOT_DIR': '',
+        'TP_RESULTS_STORE': 'none',
+        'TP_MAX_JOBS': '4',
+        'TP_MAX_QUEUE': '8',
+        'TP_ROUTE_LIMITS': 'worst5:0',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        csv_path = os.path.join(cls.directory.name, 'data.csv')
+        make_rows(0, 600).to_csv(csv_path, index=False)
+
+        with socket.socket() as free_socket:
+            free_socket.bind(('127.0.0.1', 0))
+            port = free_socket.getsockname()[1]
+        cls.base_url = f'http://127.0.0.1:{port}'
+
+        # the server runs in the test directory, so its log and results stay there
+        environment = dict(os.environ, PYTHONPATH=ROOT, TP_DATASET_PATH=csv_path,
+                           **cls.ENVIRONMENT)
+        cls.server = subprocess.Popen(
+            [sys.executable, '-m', 'flask', '--app', 'api_server', 'run', '--port', str(port)],
+            cwd=cls.directory.name, env=environment,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                cls.request('GET', '/api/num_jobs')
+                break
+            except OSError:
+                if cls.server.poll() is not None or time.monotonic() > deadline:
+                    cls.tearDownClass()
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            cls.request('GET', '/api/graceful_shutdown')
+        except OSError:
+            pass
+        cls.server.terminate()
+        cls.server.wait()
+        cls.directory.cleanup()
+
+    @classmethod
+    def request(cls, method: str, path: str, body: dict = None):
+        '''
+        Sends a request to the webserver and returns the status, the headers and
+        the body of the response, the errors included.
+        '''
+        data = json.dumps(body).encode() if body is not None else None
+        request = Request(cls.base_url + path, data, {'Content-Type': 'application/json'},
+                          method=method)
+        try:
+            with urlopen(request, timeout=10) as response:
+                return response.status, response.headers, response.read()
+        except HTTPError as error:
+            return error.code, error.headers, error.read()
+
+    def post(self, path: str, body: dict):
+        '''
+        Sends a POST request that must succeed and returns its JSON response.
+        '''
+        status, _, content = self.request('POST', path, body)
+        self.assertEqual(200, status, content)
+        return json.loads(content)
+
+    def get(self, path: str):
+        '''
+        Sends a GET request that must succeed and returns its JSON response.
+        '''
+        status, _, content = self.request('GET', path)
+        self.assertEqual(200, status, content)
+        return json.loads(content)
+
+    def test_evicted_job_is_expired(self):
+        '''
+        The result of a job evicted by TP_MAX_JOBS is answered as expired, and the
+        ids that were never given as invalid.
+        '''
+        job_ids = [self.post('/api/global_mean?wait=5000', {'question': QUESTIONS[0]})['job_id']
+                   for _ in range(5)]
+
+        self.assertEqual({'reason': 'Expired job_id', 'status': 'expired'},
+                         self.get(f'/api/get_results/{job_ids[0]}'))
+        self.assertEqual('done', self.get(f'/api/get_results/{job_ids[-1]}')['status'])
+        self.assertEqual({'reason': 'Invalid job_id', 'status': 'error'},
+                         self.get('/api/get_results/job_id_100000'))
+
+    def test_admission_rejects_with_retry_after(self):
+        '''
+        A route at its TP_ROUTE_LIMITS limit is rejected with 429 and a batch that
+        doesn't fit in TP_MAX_QUEUE with 503, both with a Retry-After, without
+        counting any of their jobs.
+        '''
+        status, headers, content = self.request('POST', '/api/worst5',
+                                                {'question': QUESTIONS[0]})
+        self.assertEqual(429, status)
+        self.assertGreaterEqual(int(headers['Retry-After']), 1)
+        self.assertEqual({'reason': 'Too many worst5 jobs', 'status': 'error'},
+                         json.loads(content))
+
+        requests = [{'route': 'global_mean', 'question': QUESTIONS[0]}] * 8
+        status, headers, content = self.request('POST', '/api/batch', {'requests': requests})
+        self.assertEqual(503, status)
+        self.assertGreaterEqual(int(headers['Retry-After']), 1)
+        self.assertEqual({'reason': 'Server is overloaded', 'status': 'error'},
+                         json.loads(content))
+
+        # the batch and its 7 jobs fit once the last request is removed
+        response = self.post('/api/batch?wait=5000', {'requests': requests[:7]})
+        self.assertEqual(7, len(response['job_ids']))
+        self.assertEqual('done', response['status'])
+
+    def test_get_results_waits_for_the_job(self):
+        '''
+        get_results with a wait answers with the result once the job is done,
+        the same result as a submission that waits.
+        '''
+        expected = self.post('/api/states_mean?wait=5000', {'question': QUESTIONS[1]})
+        job_id = self.post('/api/states_mean', {'question': QUESTIONS[1]})['job_id']
+
+        response = self.get(f'/api/get_results/{job_id}?wait=5000')
+        self.assertEqual('done', response['status'])
+        self.assertEqual(expected['data'], response['data'])
+
+    def test_stream_results_sends_every_job(self):
+        '''
+        stream_results sends an event for every job as it is done, and answers the
+        evicted ids as expired and the unknown ones as invalid.
+        '''
+        evicted = self.post('/api/global_mean?wait=5000', {'question': QUESTIONS[0]})['job_id']
+        # the jobs done after it evict it, since TP_MAX_JOBS is 4
+        for state in STATES[:4]:
+            self.post('/api/state_mean?wait=5000', {'question': QUESTIONS[0], 'state': state})
+        self.assertEqual('expired', self.get(f'/api/get_results/{evicted}')['status'])
+
+        job_ids = [self.post('/api/state_mean', {'question': question, 'state': STATES[0]})
+                   ['job_id'] for question in QUESTIONS]
+
+        status, headers, content = self.request(
+            'GET', f"/api/stream_results?timeout=10&job_ids={','.join(job_ids)},"
+                   f"{evicted},job_id_100000")
+        self.assertEqual(200, status)
+        self.assertTrue(headers['Content-Type'].startswith('text/event-stream'))
+
+        events = {}
+        for event in content.decode().strip().split('\n\n'):
+            name, data = event.split('\n')
+            data = json.loads(data[len('data: '):])
+            events[data['job_id']] = (name[len('event: '):], data['status'])
+
+        expected = {job_id: ('done', 'done') for job_id in job_ids}
+        expected[evicted] = ('expired', 'expired')
+        expected['job_id_100000'] = ('error', 'error')
+        self.assertEqual(expected, events)
+
+
+if __name__ == '__main__':
+    unittest.main()